@@ -19,14 +19,15 @@
 # Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
 # Boston, MA 02110-1301, USA.
 
-# TODO reimplement after GES port
 """
 Classes for automatic alignment of L{Clip}s
 """
 
+from gi.repository import GES
+from gi.repository import GLib
 from gi.repository import GObject
 from gi.repository import Gst
-import array
+import multiprocessing
 import time
 from gi.repository import Gtk
 import os
@@ -41,10 +42,14 @@ from gettext import gettext as _
 
 import pitivi.configure as configure
 
+from pitivi.settings import get_dir, xdg_cache_home
 from pitivi.utils.ui import beautify_ETA
 from pitivi.utils.misc import call_false
-from pitivi.utils.extract import Extractee
+from pitivi.utils.extract import Extractee, RandomAccessAudioExtractor
+from pitivi.utils.fingerprint import get_file_hash
+from pitivi.utils.governor import get_governor
 from pitivi.utils.loggable import Loggable
+from pitivi.utils.previewcaches import get_preview_caches_manager
 
 
 def nextpow2(x):
@@ -54,6 +59,32 @@ def nextpow2(x):
     return a
 
 
+def fftsize(x):
+    """
+    Get the smallest size, at least x, for which the FFT is fast.
+
+    The sizes whose only prime factors are 2, 3 and 5 are transformed
+    about as fast as the powers of 2, and need much less padding.
+
+    @param x: the minimum size
+    @type x: L{int}
+    @rtype: L{int}
+
+    """
+    best = nextpow2(x)
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            size = p35
+            while size < x:
+                size *= 2
+            best = min(best, size)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
 def submax(left, middle, right):
     """
     Find the maximum of a quadratic function from three samples.
@@ -94,7 +125,9 @@ def rigidalign(reference, targets):
 
     The algorithm works by subtracting the mean, and then locating
     the maximum of the cross-correlation.  For inputs of length M{N},
-    the running time is M{O(C{len(targets)}*N*log(N))}.
+    the running time is M{O(C{len(targets)}*N*log(N))}.  The targets are
+    processed together, so aligning many of them is not slowed down by
+    the Python overhead.
 
     @param reference: the waveform to regard as fixed
     @type reference: Sequence(Number)
@@ -107,77 +140,179 @@ def rigidalign(reference, targets):
     @rtype: Sequence(Number)
 
     """
+    xcorr = _crosscorrelate(reference, targets)
+    L = xcorr.shape[1]
+    # shift maximizes dotproduct(t[shift:],reference)
+    shift = numpy.argmax(xcorr, axis=1)
+    rows = numpy.arange(len(targets))
+    subsample_shift = submax(xcorr[rows, (shift - 1) % L],
+                             xcorr[rows, shift],
+                             xcorr[rows, (shift + 1) % L])
+    shift = shift + subsample_shift
+    # shift is now a float indicating the interpolated maximum
+    # Negative shifts appear large and positive, this corrects them to be
+    # negative
+    lengths = numpy.array([len(t) for t in targets])
+    shift[shift >= lengths] -= L
+    # Sign reversed to move the target instead of the reference
+    return (-shift).tolist()
+
+
+def _crosscorrelate(reference, targets):
+    # Helper function for rigidalign and pyramidalign
+    # Returns the circular cross-correlations of the mean-subtracted
+    # reference with each of the mean-subtracted targets, one per row.
     # L is the maximum size of a cross-correlation between the
     # reference and any of the targets.
     L = len(reference) + max(len(t) for t in targets) - 1
-    # We round up L to the next power of 2 for speed in the FFT.
-    L = nextpow2(L)
+    # We round up L to a size for which the FFT is fast.
+    L = fftsize(L)
     reference = reference - numpy.mean(reference)
     fref = numpy.fft.rfft(reference, L).conj()
+    # All the targets are transformed at once, one per row.
+    stacked = numpy.zeros((len(targets), L))
+    for i, t in enumerate(targets):
+        stacked[i, :len(t)] = t - numpy.mean(t)
+    return numpy.fft.irfft(fref * numpy.fft.rfft(stacked, L, axis=1), L,
+                           axis=1)
+
+
+PYRAMID_FACTOR = 4
+"""The decimation factor between two levels of the pyramid."""
+PYRAMID_MAX_BLOCKS = 4096
+"""The envelopes are decimated until they are not longer than this."""
+PYRAMID_CANDIDATES = 3
+"""The number of best shifts of the coarsest level which are refined."""
+
+
+def _decimate(envelope):
+    # Helper function for pyramidalign
+    # Sums each PYRAMID_FACTOR consecutive blocks, the incomplete last one
+    # is dropped.
+    n = len(envelope) // PYRAMID_FACTOR
+    return envelope[:n * PYRAMID_FACTOR].reshape(
+        (n, PYRAMID_FACTOR)).sum(axis=1)
+
+
+def _correlate(reference, target, lag):
+    # Helper function for pyramidalign
+    # Returns dotproduct(target[lag:], reference), the value of the
+    # cross-correlation at the specified lag.
+    start = max(0, -lag)
+    end = min(len(reference), len(target) - lag)
+    if end <= start:
+        return 0.0
+    return float(numpy.dot(reference[start:end],
+                           target[start + lag:end + lag]))
+
+
+def pyramidalign(reference, targets):
+    """
+    Estimate the relative shift between reference and targets, coarse to
+    fine.
+
+    Same as L{rigidalign}, but the envelopes are first decimated
+    by PYRAMID_FACTOR repeatedly, to a length of at most PYRAMID_MAX_BLOCKS.
+    The cross-correlation of the coarsest envelopes gives the
+    PYRAMID_CANDIDATES best shifts, which are then refined level by level,
+    by computing the cross-correlation only in a small window around them.
+    The memory and time needed to align long recordings is then roughly
+    proportional to their length, instead of the FFT of their full
+    cross-correlation.
+
+    @param reference: the waveform to regard as fixed
+    @type reference: Sequence(Number)
+    @param targets: the waveforms that should be aligned to reference
+    @type targets: Sequence(Sequence(Number))
+    @returns: The shift necessary to bring each target into alignment
+        with the reference, as returned by L{rigidalign}.
+    @rtype: Sequence(Number)
+
+    """
+    reference = numpy.asarray(reference, dtype=numpy.float64)
+    targets = [numpy.asarray(t, dtype=numpy.float64) for t in targets]
+    # The levels of the pyramid, the finest first.
+    levels = [(reference - numpy.mean(reference),
+               [t - numpy.mean(t) for t in targets])]
+    while max(len(levels[-1][0]),
+              max(len(t) for t in levels[-1][1])) > PYRAMID_MAX_BLOCKS:
+        coarse_reference, coarse_targets = levels[-1]
+        levels.append((_decimate(coarse_reference),
+                       [_decimate(t) for t in coarse_targets]))
+    if len(levels) == 1 or min(len(t) for t in levels[-1][1]) < 2:
+        return rigidalign(reference, targets)
+
+    coarse_reference, coarse_targets = levels[-1]
+    xcorr = _crosscorrelate(coarse_reference, coarse_targets)
+    L = xcorr.shape[1]
     shifts = []
-    for t in targets:
-        t = t - numpy.mean(t)
-        # Compute cross-correlation
-        xcorr = numpy.fft.irfft(fref * numpy.fft.rfft(t, L))
-        # shift maximizes dotproduct(t[shift:],reference)
-        # int() to convert numpy.int32 to python int
-        shift = int(numpy.argmax(xcorr))
-        subsample_shift = submax(xcorr[(shift - 1) % L],
-                                 xcorr[shift],
-                                 xcorr[(shift + 1) % L])
-        shift = shift + subsample_shift
-        # shift is now a float indicating the interpolated maximum
-        if shift >= len(t):  # Negative shifts appear large and positive
-            shift -= L       # This corrects them to be negative
-        shifts.append(-shift)
+    for i, t in enumerate(coarse_targets):
+        # The lags of the best peaks, each one hiding its neighbors so the
+        # candidates are not all on the same peak.
+        candidates = []
+        row = xcorr[i].copy()
+        for unused in range(PYRAMID_CANDIDATES):
+            lag = int(numpy.argmax(row))
+            row[[(lag - 1) % L, lag, (lag + 1) % L]] = -numpy.inf
+            if lag >= len(t):
+                lag -= L
+            candidates.append(lag)
+
+        for level_reference, level_targets in reversed(levels[:-1]):
+            target = level_targets[i]
+            refined = []
+            for lag in candidates:
+                # The shift is known up to a coarse block.
+                window = range(lag * PYRAMID_FACTOR - PYRAMID_FACTOR,
+                               lag * PYRAMID_FACTOR + PYRAMID_FACTOR + 1)
+                values = [_correlate(level_reference, target, fine_lag)
+                          for fine_lag in window]
+                refined.append(window[int(numpy.argmax(values))])
+            candidates = refined
+
+        reference0, targets0 = levels[0]
+        values = [_correlate(reference0, targets0[i], lag)
+                  for lag in candidates]
+        lag = candidates[int(numpy.argmax(values))]
+        left = _correlate(reference0, targets0[i], lag - 1)
+        middle = max(values)
+        right = _correlate(reference0, targets0[i], lag + 1)
+        if middle > left and middle > right:
+            subsample_shift = submax(left, middle, right)
+        else:
+            # Flat, there is nothing to interpolate.
+            subsample_shift = 0.0
         # Sign reversed to move the target instead of the reference
+        shifts.append(-(lag + subsample_shift))
     return shifts
 
 
-def _findslope(a):
-    # Helper function for affinealign
-    # The provided matrix a contains a bright line whose slope we want to know,
-    # against a noisy background.
-    # The line starts at 0,0.  If the slope is positive, it runs toward the
-    # center of the matrix (i.e. toward (-1,-1))
-    # If the slope is negative, it wraps from 0,0 to 0,-1 and continues toward
-    # the center, (i.e. toward (-1,0)).
-    # The line segment terminates at the midline along the X direction.
-    # We locate the line by simply checking the sum along each possible line
-    # up to the Y-max edge of a.  The caller sets the limit by choosing the
-    # size of a.
-    # The function returns a floating-point slope assuming that the matrix
-    # has "square pixels".
-    Y, X = a.shape
-    X /= 2
-    x_pos = numpy.arange(1, X)
-    x_neg = numpy.arange(2 * X - 1, X, -1)
-    best_end = 0
-    max_sum = 0
-    for end in range(Y):
-        y = (x_pos * end) // X
-        s = numpy.sum(a[y, x_pos])
-        if s > max_sum:
-            max_sum = s
-            best_end = end
-        s = numpy.sum(a[y, x_neg])
-        if s > max_sum:
-            max_sum = s
-            best_end = -end
-    return float(best_end) / X
-
-
-def affinealign(reference, targets, max_drift=0.02):
-    """ EXPERIMENTAL FUNCTION.
+AFFINE_BLOCK_SIZE = 500
+"""The length of the blocks of a target which are located in the reference
+by L{affinealign}, 20 seconds at 25 Hz."""
+AFFINE_MAX_RESIDUAL = 2
+"""The blocks located farther than this from the fitted line are ignored."""
+AFFINE_MAX_WINDOW = 250
+"""The maximum distance from its rigidly aligned position at which a block
+is searched by L{affinealign}, 10 seconds at 25 Hz."""
 
+
+def affinealign(reference, targets, max_drift=0.02, shifts=None,
+                max_window=AFFINE_MAX_WINDOW):
+    """
     Perform an affine registration between a reference and a number of
     targets.  Designed for aligning the amplitude envelopes of recordings of
-    the same event by different devices.
-
-    NOTE: This method is currently NOT USED by Pitivi, as it has proven both
-    unnecessary and unusable.  So far every test case has been registered
-    successfully by rigidalign, and until Pitivi supports time-stretching of
-    audio, the drift calculation cannot actually be used.
+    the same event by different devices, whose clocks drift.
+
+    Each target is cut in blocks of AFFINE_BLOCK_SIZE, which are all
+    located at once in the reference, in a window around the rigid
+    alignment allowing for max_drift, but at most max_window samples wide
+    on each side so the cost doesn't grow with the square of the length of
+    the target.  On long targets with a large drift the farthest blocks
+    fall outside their window and are discarded as mismatches.  A line is
+    then fitted through the positions of the blocks, weighted by how well
+    they matched, and the blocks too far from it, for example silent ones,
+    are discarded.
 
     @param reference: the reference signal to which others will be registered
     @type reference: array(number)
@@ -186,117 +321,87 @@ def affinealign(reference, targets, max_drift=0.02):
     @param max_drift: the maximum absolute clock drift rate
                   (i.e. stretch factor) that will be considered during search
     @type max_drift: positive L{float}
+    @param shifts: the rigid shifts of the targets, as returned by
+        L{pyramidalign}, which computes them if not specified.
+    @type shifts: Sequence(Number)
+    @param max_window: the maximum number of samples by which a block is
+        searched before and after its rigidly aligned position.
+    @type max_window: L{int}
     @return: (offsets, drifts).  offsets[i] is the point in reference at which
            targets[i] starts.  drifts[i] is the speed of targets[i] relative to
            the reference (positive is faster, meaning the target should be
-           slowed down to be in sync with the reference)
+           slowed down to be in sync with the reference), so the point x of
+           targets[i] is at offsets[i] + (1 + drifts[i]) * x in reference.
     """
-    L = len(reference) + max(len(t) for t in targets) - 1
-    L2 = nextpow2(L)
-    bsize = int(20. / max_drift)  # NEEDS TUNING
-    num_blocks = nextpow2(1.0 * len(reference) // bsize)  # NEEDS TUNING
-    bspace = (len(reference) - bsize) // num_blocks
-    reference -= numpy.mean(reference)
-
-    # Construct FFT'd reference blocks
-    freference_blocks = numpy.zeros((L2 / 2 + 1, num_blocks),
-                                    dtype=numpy.complex)
-    for i in range(num_blocks):
-        s = i * bspace
-        tmp = numpy.zeros((L2,))
-        tmp[s:s + bsize] = reference[s:s + bsize]
-        freference_blocks[:, i] = numpy.fft.rfft(tmp, L2).conj()
-    freference_blocks[:10, :] = 0  # High-pass to ignore slow volume variations
-
+    reference = numpy.asarray(reference, dtype=numpy.float64)
+    reference = reference - numpy.mean(reference)
+    targets = [numpy.asarray(t, dtype=numpy.float64) for t in targets]
+    if shifts is None:
+        shifts = pyramidalign(reference, targets)
     offsets = []
     drifts = []
-    for t in targets:
-        t -= numpy.mean(t)
-        ft = numpy.fft.rfft(t, L2)
-        # fxcorr is the FFT'd cross-correlation with the reference blocks
-        fxcorr_blocks = numpy.zeros((L2 / 2 + 1, num_blocks),
-                                    dtype=numpy.complex)
-        for i in range(num_blocks):
-            fxcorr_blocks[:, i] = ft * freference_blocks[:, i]
-            fxcorr_blocks[:, i] /= numpy.sqrt(
-                numpy.sum(fxcorr_blocks[:, i] ** 2))
-        del ft
-        # At this point xcorr_blocks would show a distinct bright line, nearly
-        # orthogonal to time, indicating where each of these blocks found their
-        # peak.  Each point on this line represents the time in t where block i
-        # found its match.  The time-intercept gives the time in b at which the
-        # reference starts, and the slope gives the amount by which the
-        # reference is faster relative to b.
-
-        # The challenge now is to find this line.  Our strategy is to reduce the
-        # search to one dimension by first finding the slope.
-        # The Fourier Transform of a smooth real line in 2D is an orthogonal
-        # line through the origin, with phase that gives its position.
-        # Unfortunately this line is not clearly visible in fxcorr_blocks, so
-        # we discard the phase (by taking the absolute value) and then inverse
-        # transform.  This places the line at the origin, so we can find its
-        # slope.
-
-        # Construct the half-autocorrelation matrix
-        # (A true autocorrelation matrix would be ifft(abs(fft(x))**2), but this
-        # is just ifft(abs(fft(x))).)
-        # Construction is stepwise partly in an attempt to save memory
-        # The width is 2*num_blocks in order to avoid overlapping positive and
-        # negative correlations
-        halfautocorr = numpy.fft.fft(fxcorr_blocks, 2 * num_blocks, 1)
-        halfautocorr = numpy.abs(halfautocorr)
-        halfautocorr = numpy.fft.ifft(halfautocorr, None, 1)
-        halfautocorr = numpy.fft.irfft(halfautocorr, None, 0)
-        # Now it's actually the half-autocorrelation.
-        # Chop out the bit we don't care about
-        halfautocorr = halfautocorr[:bspace * num_blocks * max_drift, :]
-        # Remove the local-correlation peak.
-        halfautocorr[-1:2, -1:2] = 0  # NEEDS TUNING
-        # Normalize each column (appears to be necessary)
-        for i in range(2 * num_blocks):
-            halfautocorr[:, i] /= numpy.sqrt(
-                numpy.sum(halfautocorr[:, i] ** 2))
-        # from matplotlib.pyplot import imshow,show
-        # imshow(halfautocorr,interpolation='nearest',aspect='auto');show()
-        drift = _findslope(halfautocorr) / bspace
-        del halfautocorr
-
-        # inverse transform and shift everything into alignment
-        xcorr_blocks = numpy.fft.irfft(fxcorr_blocks, None, 0)
-        del fxcorr_blocks
-        # TODO: see if phase ramps are worthwhile here
-        for i in range(num_blocks):
-            blockcenter = i * bspace + bsize / 2
-            shift = int(blockcenter * drift)
-            if shift > 0:
-                temp = xcorr_blocks[:shift, i].copy()
-                xcorr_blocks[:-shift, i] = xcorr_blocks[shift:, i].copy()
-                xcorr_blocks[-shift:, i] = temp
-            elif shift < 0:
-                temp = xcorr_blocks[shift:, i].copy()
-                xcorr_blocks[-shift:, i] = xcorr_blocks[:shift, i].copy()
-                xcorr_blocks[:-shift, i] = temp
-
-        # from matplotlib.pyplot import imshow,show
-        # imshow(xcorr_blocks,interpolation='nearest',aspect='auto');show()
-
-        # xcorr is the drift-compensated cross-correlation
-        xcorr = numpy.sum(xcorr_blocks, axis=1)
-        del xcorr_blocks
-
-        offset = numpy.argmax(xcorr)
-        # from matplotlib.pyplot import plot,show
-        # plot(xcorr);show()
-        del xcorr
-        if offset >= len(t):
-            offset -= L2
-
-        # now offset is the point in target at which reference starts and
-        # drift is the speed with which the reference drifts relative to the
-        # target.  We reverse these relationships for the caller.
-        slope = 1 + drift
-        offsets.append(-offset / slope)
-        drifts.append(1 / slope - 1)
+    for t, shift in zip(targets, shifts):
+        t = t - numpy.mean(t)
+        num_blocks = len(t) // AFFINE_BLOCK_SIZE
+        if num_blocks < 2:
+            # Too short for the drift to be measured.
+            offsets.append(shift)
+            drifts.append(0.0)
+            continue
+        # The positions of the blocks in the target.
+        starts = numpy.arange(num_blocks) * AFFINE_BLOCK_SIZE
+        blocks = t[:num_blocks * AFFINE_BLOCK_SIZE].reshape(
+            (num_blocks, AFFINE_BLOCK_SIZE))
+        # The drift moves the blocks by at most this much around their
+        # rigidly aligned position.
+        window = min(int(numpy.ceil(max_drift * len(t))), max_window) + 2
+        segment_starts = starts + int(round(shift)) - window
+        segment_size = AFFINE_BLOCK_SIZE + 2 * window
+        indexes = segment_starts[:, numpy.newaxis] + \
+            numpy.arange(segment_size)[numpy.newaxis, :]
+        inside = (indexes >= 0) & (indexes < len(reference))
+        segments = numpy.where(
+            inside, reference[numpy.clip(indexes, 0, len(reference) - 1)], 0)
+
+        # Cross-correlate each block with its segment of the reference.
+        L = fftsize(segment_size + AFFINE_BLOCK_SIZE - 1)
+        xcorr = numpy.fft.irfft(numpy.fft.rfft(segments, L, axis=1) *
+                                numpy.fft.rfft(blocks, L, axis=1).conj(),
+                                L, axis=1)[:, :2 * window + 1]
+        lag = numpy.argmax(xcorr, axis=1)
+        rows = numpy.arange(num_blocks)
+        peak = xcorr[rows, lag]
+        left = xcorr[rows, numpy.maximum(lag - 1, 0)]
+        right = xcorr[rows, numpy.minimum(lag + 1, 2 * window)]
+        interpolable = (peak > left) & (peak > right)
+        subsample_lag = numpy.zeros(num_blocks)
+        subsample_lag[interpolable] = submax(left[interpolable],
+                                             peak[interpolable],
+                                             right[interpolable])
+        # Where the center of each block is in the reference. The drift
+        # inside a block is averaged by the correlation, so the centers
+        # match best.
+        centers = starts + AFFINE_BLOCK_SIZE / 2
+        positions = segment_starts + lag + subsample_lag + \
+            AFFINE_BLOCK_SIZE / 2
+        # How well each block matched, as a correlation coefficient.
+        norms = numpy.sqrt(numpy.sum(blocks ** 2, axis=1) *
+                           numpy.sum(segments ** 2, axis=1))
+        weights = numpy.where(norms > 0, peak / numpy.maximum(norms, 1e-30),
+                              0)
+        weights = numpy.maximum(weights, 0)
+
+        used = weights > 0
+        slope, offset = 1.0, float(shift)
+        for unused in range(3):
+            if numpy.count_nonzero(used) < 2:
+                break
+            slope, offset = numpy.polyfit(centers[used], positions[used], 1,
+                                          w=weights[used])
+            residuals = numpy.abs(positions - (offset + slope * centers))
+            used = (weights > 0) & (residuals <= AFFINE_MAX_RESIDUAL)
+        offsets.append(float(offset))
+        drifts.append(float(slope) - 1)
     return offsets, drifts
 
 
@@ -307,14 +412,76 @@ def getAudioTrack(clip):
     @param clip: The Clip from which to locate an audio track
     @type clip: L{Clip}
     @returns: An audio track from clip, or None if clip has no audio track
+        or is not backed by a media file
     @rtype: audio L{TrackElement} or L{NoneType}
     """
-    for track in clip.track_elements:
-        if track.stream_type == AudioStream:
-            return track
+    if not isinstance(clip, GES.UriClip):
+        return None
+    for track_element in clip.get_children(False):
+        if track_element.get_track_type() == GES.TrackType.AUDIO:
+            return track_element
     return None
 
 
+def get_sample_rate(clip):
+    """
+    Get the sample rate of the audio stream of the media file of a clip.
+    """
+    info = clip.get_asset().get_info()
+    return info.get_audio_streams()[0].get_sample_rate()
+
+
+def get_envelope_location_for_uri(uri, blockrate):
+    """
+    Get the file caching the envelope of the specified media file.
+
+    @param blockrate: The number of blocks per second of the envelope.
+    """
+    filehash = get_file_hash(Gst.uri_get_location(uri))
+    cache_dir = get_dir(os.path.join(xdg_cache_home(), "envelopes"))
+    return os.path.join(cache_dir, "%s-%d.npy" % (filehash, blockrate))
+
+
+def load_envelope(path):
+    """
+    Load a cached envelope.
+
+    @returns: The envelope of the whole stream, or None if not cached.
+    """
+    try:
+        return numpy.load(path)
+    except (IOError, ValueError):
+        return None
+
+
+def save_envelope(path, envelope):
+    """
+    Cache the envelope of a whole stream.
+
+    The file is created atomically, as another Pitivi process can load it
+    at any time.
+    """
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as tmp_file:
+        numpy.save(tmp_file, envelope)
+    os.rename(tmp_path, path)
+
+
+def slice_envelope(envelope, in_point, duration, blockrate):
+    """
+    Get the part of the envelope of a stream used by a clip.
+
+    @param envelope: The envelope of the whole stream.
+    @param in_point: The position in the stream where the clip starts
+        (nanoseconds)
+    @param duration: The duration of the clip (nanoseconds)
+    @param blockrate: The number of blocks per second of the envelope.
+    """
+    start = int(round(in_point * blockrate / Gst.SECOND))
+    end = int(round((in_point + duration) * blockrate / Gst.SECOND))
+    return envelope[start:end]
+
+
 class ProgressMeter:
 
     """Abstract interface representing a progress meter."""
@@ -401,11 +568,14 @@ class EnvelopeExtractee(Extractee, Loggable):
 
     The envelope is defined as the sum of the absolute value of the signal
     over each block.  This class computes the envelope incrementally,
-    so that the entire signal does not ever need to be stored.
+    as the chunks of the signal are received, so that the entire signal
+    does not ever need to be stored.  Only the samples of the incomplete
+    block at the end of the received signal are kept, in a buffer of the
+    size of a block.
 
     """
 
-    def __init__(self, blocksize, callback, *cbargs):
+    def __init__(self, blocksize, callback, *cbargs, error_callback=None):
         """
         @param blocksize: the number of samples in a block
         @type blocksize: L{int}
@@ -413,27 +583,52 @@ class EnvelopeExtractee(Extractee, Loggable):
             The function's first argument will be a numpy array
             representing the envelope, and any later argument to this
             function will be passed as subsequent arguments to callback.
+        @param error_callback: a function to call when the extraction
+            fails, with the same subsequent arguments as callback.
 
         """
         Loggable.__init__(self)
         self._blocksize = blocksize
         self._cb = callback
         self._cbargs = cbargs
-        self._blocks = numpy.zeros((0,), dtype=numpy.float32)
-        self._empty = array.array('f', [])
-        # self._samples buffers up to self._threshold samples, before
-        # their envelope is computed and store in self._blocks, in order
-        # to amortize some of the function call overheads.
-        self._samples = array.array('f', [])
+        self._error_cb = error_callback
+        # The envelope, whose capacity is doubled when full.
+        self._blocks = numpy.zeros((1024,), dtype=numpy.float32)
+        self._num_blocks = 0
+        # The samples of the incomplete block.
+        self._pending = numpy.empty((blocksize,), dtype=numpy.float32)
+        self._num_pending = 0
+        # Reused for computing the absolute values of the samples.
+        self._scratch = numpy.empty((0,), dtype=numpy.float32)
+        # The progress watchers are called each time this many samples
+        # have been received.
         self._threshold = 2000 * blocksize
+        self._num_samples = 0
+        self._notified_samples = 0
         self._progress_watchers = []
 
     def receive(self, a):
-        self._samples.extend(a)
-        if len(self._samples) < self._threshold:
-            return
-        else:
-            self._process_samples()
+        self._num_samples += len(a)
+        if self._num_pending:
+            count = min(len(a), self._blocksize - self._num_pending)
+            self._pending[self._num_pending:self._num_pending + count] = \
+                a[:count]
+            self._num_pending += count
+            a = a[count:]
+            if self._num_pending < self._blocksize:
+                return
+            self._addBlocks(self._pending)
+            self._num_pending = 0
+        excess = len(a) % self._blocksize
+        if len(a) > excess:
+            self._addBlocks(a[:len(a) - excess])
+        if excess:
+            self._pending[:excess] = a[len(a) - excess:]
+            self._num_pending = excess
+        if self._num_samples - self._notified_samples >= self._threshold:
+            self._notified_samples = self._num_samples
+            for w in self._progress_watchers:
+                w(self._num_samples)
 
     def addWatcher(self, w):
         """
@@ -445,30 +640,34 @@ class EnvelopeExtractee(Extractee, Loggable):
         """
         self._progress_watchers.append(w)
 
-    def _process_samples(self):
-        excess = len(self._samples) % self._blocksize
-        if excess != 0:
-            samples_to_process = self._samples[:-excess]
-            self._samples = self._samples[-excess:]
-        else:
-            samples_to_process = self._samples
-            self._samples = array.array('f', [])
-        self.debug("Adding %s samples to %s blocks",
-                   len(samples_to_process), len(self._blocks))
-        newblocks = len(samples_to_process) // self._blocksize
-        samples_abs = numpy.abs(
-            samples_to_process).reshape((newblocks, self._blocksize))
-        self._blocks.resize((len(self._blocks) + newblocks,))
+    def _addBlocks(self, samples):
+        newblocks = len(samples) // self._blocksize
+        if len(self._scratch) < len(samples):
+            self._scratch = numpy.empty((len(samples),), dtype=numpy.float32)
+        samples_abs = numpy.abs(samples, out=self._scratch[:len(samples)])
+        if self._num_blocks + newblocks > len(self._blocks):
+            blocks = numpy.zeros(
+                (max(2 * len(self._blocks), self._num_blocks + newblocks),),
+                dtype=numpy.float32)
+            blocks[:self._num_blocks] = self._blocks[:self._num_blocks]
+            self._blocks = blocks
         # This numpy.sum() call relies on samples_abs being a
         # floating-point type. If samples_abs.dtype is int16
         # then the sum may overflow.
-        self._blocks[-newblocks:] = numpy.sum(samples_abs, 1)
-        for w in self._progress_watchers:
-            w(self._blocksize * len(self._blocks) + excess)
+        numpy.sum(samples_abs.reshape((newblocks, self._blocksize)), axis=1,
+                  out=self._blocks[self._num_blocks:
+                                   self._num_blocks + newblocks])
+        self._num_blocks += newblocks
 
     def finalize(self):
-        self._process_samples()  # absorb any remaining buffered samples
-        self._cb(self._blocks, *self._cbargs)
+        # The incomplete block at the end is dropped.
+        self._cb(self._blocks[:self._num_blocks].copy(), *self._cbargs)
+
+    def fail(self):
+        self.warning("The envelope extraction failed after %d samples",
+                     self._num_samples)
+        if self._error_cb:
+            self._error_cb(*self._cbargs)
 
 
 class AutoAligner(Loggable):
@@ -499,15 +698,23 @@ class AutoAligner(Loggable):
 
     """
 
-    def __init__(self, clips, callback):
+    def __init__(self, clips, callback, max_jobs=None, estimate_drift=False):
         """
         @param clips: an iterable of L{Clip}s.
             In this implementation, only L{Clip}s with at least one
             audio track will be aligned.
         @type clips: iter(L{Clip})
         @param callback: A function to call when alignment is complete.  No
-            arguments will be provided.
+            arguments will be provided.  It is not called if the alignment
+            is cancelled.  The clips which could not be decoded are left
+            untouched and listed in L{failed}.
         @type callback: function
+        @param max_jobs: The maximum number of envelopes extracted
+            concurrently, by default the number of cores.
+        @type max_jobs: L{int}
+        @param estimate_drift: Whether to estimate the clock drift of the
+            aligned clips relative to the reference, see L{affinealign}.
+        @type estimate_drift: L{bool}
 
         """
         Loggable.__init__(self)
@@ -515,11 +722,22 @@ class AutoAligner(Loggable):
         # are initially None prior to envelope extraction.
         self._clips = dict.fromkeys(clips)
         self._callback = callback
-        # stack of (Track, Extractee) pairs waiting to be processed
-        # When start() is called, the stack will be populated, and then
-        # processed sequentially.  Only one item from the stack will be
-        # actively in process at a time.
-        self._extraction_stack = []
+        self._max_jobs = max_jobs or multiprocessing.cpu_count()
+        # queue of (Clip, Extractee) waiting to be processed.
+        # When start() is called, the queue will be populated, and then
+        # processed by at most _max_jobs extractors at a time, each one
+        # decoding its stream in its own pipeline.
+        self._extraction_queue = []
+        # Maps the Clips being processed to their extractor.
+        self._extractors = {}
+        # Maps the Clips being processed to their audio track.
+        self._tracks = {}
+        self._cancelled = False
+        self._estimate_drift = estimate_drift
+        # Maps the aligned Clips to their drift rate, when estimated.
+        self.drifts = {}
+        # The Clips whose envelope could not be extracted.
+        self.failed = []
 
     @staticmethod
     def canAlign(clips):
@@ -540,22 +758,79 @@ class AutoAligner(Loggable):
         # use the AutoAligner, which will crash immediately.
         return all(getAudioTrack(t) is not None for t in clips)
 
-    def _extractNextEnvelope(self):
-        audiotrack, extractee = self._extraction_stack.pop()
-        r = RandomAccessAudioExtractor(audiotrack.factory,
-                                       audiotrack.stream)
-        r.extract(extractee, audiotrack.in_point,
-                  audiotrack.out_point - audiotrack.in_point)
+    def _startExtractions(self):
+        while self._extraction_queue and \
+                len(self._extractors) < self._max_jobs:
+            clip, extractee = self._extraction_queue.pop(0)
+            extractor = RandomAccessAudioExtractor(clip.props.uri,
+                                                   get_sample_rate(clip))
+            self._extractors[clip] = extractor
+            # The whole stream is extracted, so the cached envelope can be
+            # used for any in/out point.
+            extractor.extract(extractee, 0, clip.get_asset().get_duration())
         return False
 
     def _envelopeCb(self, array, clip):
+        # Called from the extraction thread of the extractor, which cannot
+        # be stopped from there.
+        GLib.idle_add(self._envelopeExtractedCb, array, clip)
+
+    def _envelopeExtractedCb(self, array, clip):
+        if self._cancelled:
+            return False
+        self._extractors.pop(clip).stop()
         self.debug("Receiving envelope for %s", clip)
-        self._clips[clip] = array
-        if self._extraction_stack:
-            self._extractNextEnvelope()
-        else:  # This was the last envelope
-            self._performShifts()
+        path = get_envelope_location_for_uri(clip.props.uri, self.BLOCKRATE)
+        save_envelope(path, array)
+        get_preview_caches_manager().touch(path, clip.props.uri)
+        self._setEnvelope(clip, array)
+        self._continueExtractions()
+        return False
+
+    def _envelopeFailedCb(self, clip):
+        # Called from the main loop, the extractor is already stopped.
+        if self._cancelled:
+            return
+        self.warning("Could not extract the envelope of %s, not aligning it",
+                     clip.props.uri)
+        self._extractors.pop(clip)
+        self._tracks.pop(clip)
+        self._clips.pop(clip)
+        self.failed.append(clip)
+        self._continueExtractions()
+
+    def _continueExtractions(self):
+        if self._extraction_queue:
+            self._startExtractions()
+        elif not self._extractors:  # This was the last envelope
+            self._finishCb()
+
+    def _setEnvelope(self, clip, envelope):
+        audiotrack = self._tracks[clip]
+        self._clips[clip] = slice_envelope(
+            envelope, audiotrack.props.in_point, audiotrack.props.duration,
+            self.BLOCKRATE)
+
+    def _finishCb(self):
+        get_governor().setPoolSize(self, 0)
+        if not self._cancelled:
+            # At least two clips are needed, some might have failed.
+            if len(self._clips) >= 2:
+                self._performShifts()
             self._callback()
+        return False
+
+    def cancel(self):
+        """
+        Stop the extraction of the envelopes, the clips are left untouched.
+        """
+        self.debug("Cancelling the alignment")
+        self._cancelled = True
+        get_governor().setPoolSize(self, 0)
+        self._extraction_queue = []
+        extractors, self._extractors = self._extractors, {}
+        for extractor in extractors.values():
+            extractor.stop()
 
     def start(self):
         """
@@ -576,28 +851,44 @@ class AutoAligner(Loggable):
                 self._clips.pop(clip)
         if len(pairs) >= 2:
             for clip, audiotrack in pairs:
+                self._tracks[clip] = audiotrack
+                uri = clip.props.uri
+                path = get_envelope_location_for_uri(uri, self.BLOCKRATE)
+                envelope = load_envelope(path)
+                if envelope is not None:
+                    self.debug("Using the cached envelope of %s", uri)
+                    get_preview_caches_manager().touch(path, uri)
+                    self._setEnvelope(clip, envelope)
+                    continue
                 # blocksize is the number of samples per block
-                blocksize = audiotrack.stream.rate // self.BLOCKRATE
+                rate = get_sample_rate(clip)
+                blocksize = rate // self.BLOCKRATE
                 extractee = EnvelopeExtractee(
-                    blocksize, self._envelopeCb, clip)
-                # numsamples is the total number of samples in the track,
+                    blocksize, self._envelopeCb, clip,
+                    error_callback=self._envelopeFailedCb)
+                # numsamples is the total number of samples in the stream,
                 # which is used by progress_aggregator to determine
                 # the percent completion.
-                numsamples = ((audiotrack.duration / Gst.SECOND) *
-                              audiotrack.stream.rate)
+                numsamples = ((clip.get_asset().get_duration() / Gst.SECOND) *
+                              rate)
                 extractee.addWatcher(
                     progress_aggregator.getPortionCB(numsamples))
-                self._extraction_stack.append((audiotrack, extractee))
-            # After we return, start the extraction cycle.
-            # This GLib.idle_add call should not be necessary;
-            # we should be able to invoke _extractNextEnvelope directly
-            # here.  However, there is some as-yet-unexplained
-            # race condition between the Python GIL, GTK UI updates,
-            # GLib mainloop, and pygst multithreading, resulting in
-            # occasional deadlocks during autoalignment.
-            # This call to idle_add() reportedly eliminates the deadlock.
-            # No one knows why.
-            GLib.idle_add(self._extractNextEnvelope)
+                self._extraction_queue.append((clip, extractee))
+            if not self._extraction_queue:
+                # All the envelopes are cached.
+                GLib.idle_add(self._finishCb)
+            else:
+                # After we return, start the extraction cycle.
+                # This GLib.idle_add call should not be necessary;
+                # we should be able to invoke _startExtractions directly
+                # here.  However, there is some as-yet-unexplained
+                # race condition between the Python GIL, GTK UI updates,
+                # GLib mainloop, and pygst multithreading, resulting in
+                # occasional deadlocks during autoalignment.
+                # This call to idle_add() reportedly eliminates the
+                # deadlock.  No one knows why.
+                get_governor().setPoolSize(self, self._max_jobs)
+                GLib.idle_add(self._startExtractions)
         else:  # We can't do anything without at least two audio tracks
             # After we return, call the callback function (once)
             GLib.idle_add(call_false, self._callback)
@@ -607,8 +898,8 @@ class AutoAligner(Loggable):
         """
         Chooses the timeline object to use as a reference.
 
-        This function currently selects the one with lowest priority,
-        i.e. appears highest in the GUI.  The behavior of this function
+        This function currently selects the one in the layer with the
+        lowest priority, i.e. appears highest in the GUI.  The behavior of this function
         affects user interaction, because the user may want to
         determine which object moves and which stays put.
 
@@ -617,7 +908,7 @@ class AutoAligner(Loggable):
 
         """
         def priority(clip):
-            return clip.priority
+            return clip.get_layer().get_priority()
         return min(iter(self._clips.keys()), key=priority)
 
     def _performShifts(self):
@@ -625,38 +916,49 @@ class AutoAligner(Loggable):
         reference = self._chooseReference()
         # By using pop(), this line also removes the reference
         # Clip and its envelope from further consideration,
-        # saving some CPU time in rigidalign.
+        # saving some CPU time in pyramidalign.
         reference_envelope = self._clips.pop(reference)
         # We call list() because we need a reliable ordering of the pairs
         # (In python 3, dict.items() returns an unordered dictview)
         pairs = list(self._clips.items())
         envelopes = [p[1] for p in pairs]
-        offsets = rigidalign(reference_envelope, envelopes)
+        offsets = pyramidalign(reference_envelope, envelopes)
+        if self._estimate_drift:
+            unused_offsets, drifts = affinealign(reference_envelope,
+                                                 envelopes, shifts=offsets)
+            for (movable, envelope), drift in zip(pairs, drifts):
+                self.info("%s drifts by %.3f%% relative to %s",
+                          movable, drift * 100, reference)
+                self.drifts[movable] = drift
         for (movable, envelope), offset in zip(pairs, offsets):
             # tshift is the offset rescaled to units of nanoseconds
             tshift = int((offset * Gst.SECOND) / self.BLOCKRATE)
             self.debug("Shifting %s to %i ns from %i",
-                       movable, tshift, reference.start)
-            newstart = reference.start + tshift
+                       movable, tshift, reference.props.start)
+            newstart = reference.props.start + tshift
             if newstart >= 0:
-                movable.start = newstart
+                movable.set_start(newstart)
             else:
                 # Timeline objects always must have a positive start point, so
                 # if alignment would move an object to start at negative time,
                 # we instead make it start at zero and chop off the required
                 # amount at the beginning.
-                movable.start = 0
-                movable.in_point = movable.in_point - newstart
-                movable.duration += newstart
+                movable.set_start(0)
+                movable.set_inpoint(movable.props.in_point - newstart)
+                movable.set_duration(movable.props.duration + newstart)
 
 
 class AlignmentProgressDialog:
 
     """ Dialog indicating the progress of the auto-alignment process.
         Code derived from L{RenderingProgressDialog}, but greatly simplified
-        (read-only, no buttons)."""
+        (read-only, only a cancel button)."""
 
-    def __init__(self, app):
+    def __init__(self, app, cancel_cb):
+        """
+        @param cancel_cb: Called when the user cancels the alignment.
+        """
+        self._cancel_cb = cancel_cb
         self.builder = Gtk.Builder()
         self.builder.add_from_file(
             os.path.join(configure.get_ui_dir(), "alignmentprogress.ui"))
@@ -672,7 +974,8 @@ class AlignmentProgressDialog:
         # RenderingProgressDialog (bug #652917)
         self.window.set_transient_for(app.gui)
 
-        # FIXME: Add a cancel button
+    def _cancelButtonClickedCb(self, unused_button):
+        self._cancel_cb()
 
     def updatePosition(self, fraction, estimated):
         self.progressbar.set_fraction(fraction)
@@ -1,90 +1,166 @@
 #include <Python.h>
 #include <stdio.h>
+#include <string.h>
 #include <cairo.h>
 #include <py3cairo.h>
 
 static Pycairo_CAPI_t *Pycairo_CAPI;
 
 /*
- * This function must be called with a range of samples, and a desired
- * width and height.
- * It will average samples if needed.
+ * Whether the format of a buffer is native float32.
  */
-static PyObject* py_fill_surface(PyObject* self, PyObject* args)
+static int is_float32_format(const char *format)
 {
-  PyObject *samples;
-  PyObject *sampleObj;
-  int length, i;
-  double sample;
+  if (format == NULL)
+    return 0;
+  if (*format == '@' || *format == '=')
+    format++;
+#if PY_BIG_ENDIAN
+  else if (*format == '>' || *format == '!')
+    format++;
+#else
+  else if (*format == '<')
+    format++;
+#endif
+  return strcmp(format, "f") == 0;
+}
+
+/*
+ * Returns the value of a block of a 2D float32 buffer.
+ */
+static inline float get_block_value(Py_buffer* blocks, Py_ssize_t block, int column)
+{
+  return *(float *) ((char *) blocks->buf + block * blocks->strides[0] +
+                     column * blocks->strides[1]);
+}
+
+/*
+ * Maps a percentage of the full scale to a y coordinate, 0 being
+ * in the middle of the surface.
+ */
+static inline double value_to_y(float value, int height)
+{
+  double half = height / 2.;
+
+  if (value > 100.)
+    value = 100.;
+  else if (value < -100.)
+    value = -100.;
+  return half - value * half / 100.;
+}
+
+/*
+ * This function must be called with the waveform blocks to draw, which
+ * can be any object supporting the buffer protocol, such as a NumPy array
+ * or memmap of float32 with two or three columns: the min and the max
+ * values and optionally the RMS value, in percents of the full scale.
+ *
+ * For each pixel, the min/max envelope of the blocks drawn on it is
+ * filled, and the RMS value on top of it. The GIL is released while
+ * drawing, so this can be called from another thread.
+ */
+static PyObject* py_fill_envelope_surface(PyObject* self, PyObject* args)
+{
+  PyObject *blocksObj;
+  Py_buffer blocks;
+  Py_ssize_t length, start, end, i;
   cairo_surface_t *surface;
   cairo_t *ctx;
-  int width, height;
-  float pixelsPerSample;
-  float currentPixel;
-  int samplesInAccum;
-  float x = 0.;
-  float lastX = 0.;
-  double accum;
-  double lastAccum = 0.;
-
-  if (!PyArg_ParseTuple(args, "O!ii", &PyList_Type, &samples, &width, &height))
+  int width, height, x;
+  int has_rms;
+  float min, max, value;
+  double rms;
+
+  if (!PyArg_ParseTuple(args, "Oii", &blocksObj, &width, &height))
     return NULL;
 
-  length = PyList_Size(samples);
+  if (PyObject_GetBuffer(blocksObj, &blocks, PyBUF_RECORDS_RO) < 0)
+    return NULL;
 
-  surface = cairo_image_surface_create(CAIRO_FORMAT_ARGB32, width, height);
+  if (blocks.ndim != 2 || blocks.shape[1] < 2 ||
+      !is_float32_format(blocks.format))
+    {
+      PyBuffer_Release(&blocks);
+      PyErr_SetString(PyExc_ValueError,
+                      "expected a 2D float32 buffer with min and max columns");
+      return NULL;
+    }
 
-  ctx = cairo_create(surface);
+  if (width <= 0 || height <= 0)
+    {
+      PyBuffer_Release(&blocks);
+      PyErr_SetString(PyExc_ValueError, "invalid surface size");
+      return NULL;
+    }
 
-  cairo_set_source_rgb(ctx, 0.2, 0.6, 0.0);
-  cairo_set_line_width(ctx, 0.5);
-  cairo_move_to(ctx, 0, height);
+  length = blocks.shape[0];
+  has_rms = blocks.shape[1] > 2;
 
-  pixelsPerSample = width / (float) length;
-  currentPixel = 0.;
-  samplesInAccum = 0;
-  accum = 0.;
+  Py_BEGIN_ALLOW_THREADS;
 
-  for (i = 0; i < length; i++)
+  surface = cairo_image_surface_create(CAIRO_FORMAT_ARGB32, width, height);
+  ctx = cairo_create(surface);
+
+  if (length > 0)
     {
-      /* Guaranteed to return something */
-      sampleObj = PyList_GetItem(samples, i);
-      sample = PyFloat_AsDouble(sampleObj);
-
-      /* If the object was not a float or convertible to float */
-      if (PyErr_Occurred())
-	{
-	  cairo_surface_finish(surface);
-	  Py_DECREF(samples);
-	  return NULL;
-	}
-
-      currentPixel += pixelsPerSample;
-      samplesInAccum += 1;
-      accum += sample;
-      if (currentPixel > 1.0)
-	{
-	  accum /= samplesInAccum;
-	  cairo_line_to(ctx, x, height - accum);
-	  lastAccum = accum;
-	  accum = 0;
-	  currentPixel -= 1.0;
-	  samplesInAccum = 0;
-	  lastX = x;
-	}
-      x += pixelsPerSample;
+      /* The envelope. */
+      for (x = 0; x < width; x++)
+        {
+          start = length * x / width;
+          end = length * (x + 1) / width;
+          if (end <= start)
+            end = start + 1;
+
+          min = get_block_value(&blocks, start, 0);
+          max = get_block_value(&blocks, start, 1);
+          for (i = start + 1; i < end; i++)
+            {
+              value = get_block_value(&blocks, i, 0);
+              if (value < min)
+                min = value;
+              value = get_block_value(&blocks, i, 1);
+              if (value > max)
+                max = value;
+            }
+          cairo_rectangle(ctx, x, value_to_y(max, height), 1,
+                          value_to_y(min, height) - value_to_y(max, height) + 1);
+        }
+      cairo_set_source_rgb(ctx, 0.2, 0.6, 0.0);
+      cairo_fill(ctx);
+
+      /* The RMS, in a lighter color. */
+      if (has_rms)
+        {
+          for (x = 0; x < width; x++)
+            {
+              start = length * x / width;
+              end = length * (x + 1) / width;
+              if (end <= start)
+                end = start + 1;
+
+              rms = 0.;
+              for (i = start; i < end; i++)
+                rms += get_block_value(&blocks, i, 2);
+              rms /= end - start;
+              cairo_rectangle(ctx, x, value_to_y(rms, height), 1,
+                              value_to_y(-rms, height) - value_to_y(rms, height));
+            }
+          cairo_set_source_rgb(ctx, 0.4, 0.8, 0.2);
+          cairo_fill(ctx);
+        }
     }
 
-  Py_DECREF(samples);
-  cairo_line_to(ctx, width, height);
-  cairo_close_path(ctx);
-  cairo_fill_preserve(ctx);
+  cairo_destroy(ctx);
+
+  Py_END_ALLOW_THREADS;
+
+  PyBuffer_Release(&blocks);
 
   return PycairoSurface_FromSurface(surface, NULL);
 }
 
 static PyMethodDef renderer_methods[] = {
-  {"fill_surface", py_fill_surface, METH_VARARGS},
+  {"fill_envelope_surface", py_fill_envelope_surface, METH_VARARGS},
   {NULL, NULL}
 };
 
@@ -31,6 +31,7 @@ from gi.repository import GES
 from gi.repository import Gdk
 from gi.repository import GdkPixbuf
 from gi.repository import Gio
+from gi.repository import GLib
 from gi.repository import Gst
 from gi.repository import Gtk
 from gi.repository import GstPbutils
@@ -47,6 +48,7 @@ from pitivi.titleeditor import TitleEditor
 from pitivi.transitions import TransitionsListWidget
 from pitivi.utils.loggable import Loggable
 from pitivi.utils.misc import show_user_manual, path_from_uri
+from pitivi.utils.previewcaches import get_preview_caches_manager
 from pitivi.utils.ui import info_name, beautify_time_delta, SPACING, \
     beautify_length
 from pitivi.viewer import ViewerContainer
@@ -592,6 +594,25 @@ class PitiviMainWindow(Gtk.ApplicationWindow, Loggable):
             self.log("Project couldn't be exported")
         return result
 
+    def _prunePreviewCachesCb(self, unused_action):
+        # Scanning the caches can take a while, don't let it be started twice.
+        self._menubutton_items["menu_prune_preview_caches"].set_sensitive(False)
+        get_preview_caches_manager().pruneMissingInBackground(
+            self._previewCachesPrunedCb)
+
+    def _previewCachesPrunedCb(self, freed):
+        self.info("Pruned the preview caches, freed %d bytes", freed)
+        self._menubutton_items["menu_prune_preview_caches"].set_sensitive(True)
+        dialog = Gtk.MessageDialog(transient_for=self,
+                                   modal=True,
+                                   message_type=Gtk.MessageType.INFO,
+                                   buttons=Gtk.ButtonsType.OK,
+                                   text=_("The preview caches have been cleaned"))
+        dialog.set_property("secondary-text",
+                            _("%s of disk space has been freed.") % GLib.format_size(freed))
+        dialog.run()
+        dialog.destroy()
+
     def _projectSettingsCb(self, unused_action):
         self.showProjectSettingsDialog()
 
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+# Pitivi video editor
+#
+#       pitivi/previewdaemon.py
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""
+The preview daemon, generating the thumbnails and the waveforms in the
+background for all the running Pitivi instances.
+
+See pitivi.utils.previewclient for the protocol. The daemon is started by
+the first client needing it and exits when it has been idle for a while.
+"""
+
+import errno
+import multiprocessing
+import os
+import socket
+
+from gi.repository import GLib
+from gi.repository import Gst
+
+from pitivi.utils import loggable
+from pitivi.utils.governor import get_governor
+from pitivi.utils.loggable import Loggable
+from pitivi.utils.misc import filename_from_uri, quantize
+from pitivi.utils.previewcaches import get_preview_caches_manager
+from pitivi.utils.previewclient import JOB_THUMBNAILS, JOB_TYPES, \
+    JOB_WAVEFORM, STATUS_DONE, STATUS_ERROR, decode_messages, \
+    encode_message, get_socket_path
+from pitivi.utils.thumbnails import THUMB_HEIGHT, THUMB_PERIOD, \
+    get_cache_for_uri, get_thumbnails_pipeline_description
+from pitivi.utils.waveforms import WaveformExtractor, \
+    get_wavefile_location_for_uri, import_legacy_wavefile
+
+
+# Exit after this many seconds without clients and jobs.
+IDLE_TIMEOUT_S = 60
+
+
+class PreviewJob(Loggable):
+
+    """
+    Base class for the jobs generating the previews of a media file.
+
+    @ivar key: The (type, uri) identifying the job.
+    """
+
+    def __init__(self, job_type, uri, done_cb):
+        """
+        @param done_cb: Called with the job and whether it succeeded.
+        """
+        Loggable.__init__(self)
+        self.key = (job_type, uri)
+        self.uri = uri
+        self.pipeline = None
+        self._done_cb = done_cb
+        self._prerolled = False
+
+    def start(self):
+        self.pipeline = Gst.parse_launch(self._getPipelineDescription())
+        decode = self.pipeline.get_by_name("decode")
+        decode.connect("autoplug-select", self._autoplugSelectCb)
+        bus = self.pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message", self._busMessageCb)
+        self.pipeline.set_state(Gst.State.PAUSED)
+
+    def _finish(self, success):
+        get_governor().unregister(self)
+        if self.pipeline:
+            self.pipeline.get_bus().remove_signal_watch()
+            self.pipeline.set_state(Gst.State.NULL)
+            self.pipeline = None
+        self._done_cb(self, success)
+
+    def _busMessageCb(self, unused_bus, message):
+        if message.type == Gst.MessageType.ASYNC_DONE and \
+                message.src == self.pipeline and not self._prerolled:
+            self._prerolled = True
+            duration = self.pipeline.query_duration(Gst.Format.TIME)[1]
+            if self._prepare(duration):
+                self.pipeline.set_state(Gst.State.PLAYING)
+                get_governor().register(self)
+            else:
+                self.debug("Nothing to do for %s", self.uri)
+                self._finish(True)
+        elif message.type == Gst.MessageType.EOS:
+            self._finish(self._complete())
+        elif message.type == Gst.MessageType.ERROR:
+            self.warning("Failed generating previews for %s: %s",
+                         self.uri, message.parse_error())
+            self._finish(False)
+        else:
+            self._handleMessage(message)
+
+    def pauseWork(self):
+        self.pipeline.set_state(Gst.State.PAUSED)
+
+    def resumeWork(self):
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def _autoplugSelectCb(self, unused_decode, unused_pad, unused_caps, factory):
+        if self._skippedKlass in factory.get_klass():
+            return True
+        return False
+
+    # Subclasses API
+
+    _skippedKlass = None
+
+    def _getPipelineDescription(self):
+        raise NotImplementedError
+
+    def _prepare(self, duration):
+        """
+        Called when the pipeline is prerolled.
+
+        @return: Whether the media file has to be decoded.
+        """
+        raise NotImplementedError
+
+    def _handleMessage(self, message):
+        pass
+
+    def _complete(self):
+        """
+        Called when the media file has been decoded.
+
+        @return: Whether the previews have been saved.
+        """
+        raise NotImplementedError
+
+
+class ThumbnailsJob(PreviewJob):
+
+    """
+    Decodes a video linearly and caches an exact thumbnail for each period.
+    """
+
+    _skippedKlass = "Audio"
+
+    def __init__(self, job_type, uri, done_cb):
+        PreviewJob.__init__(self, job_type, uri, done_cb)
+        self._cache = get_cache_for_uri(uri)
+        self._todo = set()
+
+    def _getPipelineDescription(self):
+        return get_thumbnails_pipeline_description(self.uri, THUMB_HEIGHT)
+
+    def _prepare(self, duration):
+        self.pipeline.get_by_name("gdkpixbufsink").props.sync = False
+        if duration <= 0:
+            return False
+        self._todo = set(self._cache.missing(range(0, duration, THUMB_PERIOD)))
+        self._todo.update(self._cache.approximate())
+        return bool(self._todo)
+
+    def _handleMessage(self, message):
+        if message.type != Gst.MessageType.ELEMENT:
+            return
+        struct = message.get_structure()
+        if struct.get_name() != "pixbuf":
+            return
+        stream_time = struct.get_value("stream-time")
+        time = quantize(stream_time + THUMB_PERIOD // 2, THUMB_PERIOD)
+        if time not in self._todo:
+            return
+        self._todo.remove(time)
+        # Committed in batches, so the clients can display the thumbnails
+        # before the job is done.
+        self._cache.put(time, struct.get_value("pixbuf"), True)
+
+    def _complete(self):
+        self._cache.commit()
+        return True
+
+
+class WaveformJob(PreviewJob):
+
+    """
+    Extracts the waveform of an audio stream and saves it in the cache.
+
+    The decoding is done by a WaveformExtractor instead of the pipeline of
+    the base class.
+    """
+
+    def __init__(self, job_type, uri, done_cb):
+        PreviewJob.__init__(self, job_type, uri, done_cb)
+        self._wavefile = get_wavefile_location_for_uri(uri)
+        self._extractor = None
+
+    def start(self):
+        import_legacy_wavefile(self._wavefile)
+        if os.path.isdir(self._wavefile):
+            self.debug("Nothing to do for %s", self.uri)
+            self._finish(True)
+            return
+        self._extractor = WaveformExtractor(self.uri, self._wavefile,
+                                            self._extractedCb)
+        self._extractor.start()
+
+    def _extractedCb(self, success):
+        self._extractor = None
+        if success:
+            get_preview_caches_manager().touch(self._wavefile, self.uri)
+        self._finish(success)
+
+
+JOB_CLASSES = {
+    JOB_THUMBNAILS: ThumbnailsJob,
+    JOB_WAVEFORM: WaveformJob,
+}
+
+
+class PreviewDaemon(Loggable):
+
+    """
+    Serves the requests of the clients connected to the socket.
+
+    The identical requests of several clients share the same job.
+    """
+
+    def __init__(self, socket_path, max_jobs=None):
+        Loggable.__init__(self)
+        self._socket_path = socket_path
+        self._max_jobs = max_jobs or multiprocessing.cpu_count()
+        get_governor().setPoolSize(self, self._max_jobs)
+        self._server = None
+        self._mainloop = GLib.MainLoop()
+        # Maps the client sockets to the data received but not handled yet.
+        self._clients = {}
+        # Maps the key of the requested jobs to the waiting clients.
+        self._waiting = {}
+        # The keys of the jobs not started yet.
+        self._queue = []
+        self._running = []
+
+    def run(self):
+        """
+        Serve until idle.
+
+        @return: False if the socket is already served by another daemon.
+        """
+        if not self._listen():
+            return False
+        GLib.io_add_watch(self._server.fileno(), GLib.PRIORITY_DEFAULT,
+                          GLib.IO_IN, self._acceptCb)
+        GLib.timeout_add_seconds(IDLE_TIMEOUT_S, self._idleCb)
+        self.info("Serving on %s", self._socket_path)
+        self._mainloop.run()
+        self._server.close()
+        try:
+            os.unlink(self._socket_path)
+        except OSError:
+            pass
+        return True
+
+    def _listen(self):
+        if os.path.exists(self._socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self._socket_path)
+                self.info("Another daemon is running")
+                return False
+            except OSError:
+                # Left behind by a crashed daemon.
+                os.unlink(self._socket_path)
+            finally:
+                probe.close()
+
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._server.bind(self._socket_path)
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE:
+                raise
+            # Another daemon has just been started.
+            self._server.close()
+            return False
+        self._server.listen(5)
+        return True
+
+    def _acceptCb(self, unused_fd, unused_condition):
+        conn, unused_address = self._server.accept()
+        self.debug("New client")
+        self._clients[conn] = b""
+        GLib.io_add_watch(conn.fileno(), GLib.PRIORITY_DEFAULT,
+                          GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+                          self._clientCb, conn)
+        return True
+
+    def _clientCb(self, unused_fd, condition, conn):
+        data = b""
+        if condition & GLib.IO_IN:
+            try:
+                data = conn.recv(4096)
+            except OSError:
+                data = b""
+        if not data:
+            self._dropClient(conn)
+            return False
+
+        messages, self._clients[conn] = decode_messages(
+            self._clients[conn] + data)
+        for message in messages:
+            self._request(conn, message.get("type"), message.get("uri"))
+        return True
+
+    def _dropClient(self, conn):
+        self.debug("Client gone")
+        del self._clients[conn]
+        for waiting in self._waiting.values():
+            if conn in waiting:
+                waiting.remove(conn)
+        conn.close()
+
+    def _request(self, conn, job_type, uri):
+        key = (job_type, uri)
+        if job_type not in JOB_TYPES or not uri:
+            self._reply(conn, key, STATUS_ERROR)
+            return
+        waiting = self._waiting.get(key)
+        if waiting is not None:
+            # Already queued or running.
+            if conn not in waiting:
+                waiting.append(conn)
+            return
+        self.debug("Queuing %s job for %s", job_type, filename_from_uri(uri))
+        self._waiting[key] = [conn]
+        self._queue.append(key)
+        self._startJobs()
+
+    def _startJobs(self):
+        while self._queue and len(self._running) < self._max_jobs:
+            job_type, uri = self._queue.pop(0)
+            job = JOB_CLASSES[job_type](job_type, uri, self._jobDoneCb)
+            self._running.append(job)
+            job.start()
+
+    def _jobDoneCb(self, job, success):
+        self.debug("Job %s done, success: %s", job.key, success)
+        self._running.remove(job)
+        status = STATUS_DONE if success else STATUS_ERROR
+        for conn in self._waiting.pop(job.key, []):
+            self._reply(conn, job.key, status)
+        # Start the next job from the main loop, we're in a bus callback of
+        # the job's pipeline.
+        GLib.idle_add(self._startJobsCb)
+
+    def _startJobsCb(self):
+        self._startJobs()
+        return False
+
+    def _reply(self, conn, key, status):
+        job_type, uri = key
+        try:
+            conn.sendall(encode_message(
+                {"type": job_type, "uri": uri, "status": status}))
+        except OSError:
+            # The client will be dropped when its socket is hung up.
+            pass
+
+    def _idleCb(self):
+        if self._clients or self._running or self._queue:
+            return True
+        self.info("Idle, exiting")
+        self._mainloop.quit()
+        return False
+
+
+def main():
+    loggable.init("PITIVI_DEBUG", False, False)
+    Gst.init(None)
+    # Leave the CPU to the applications the user is interacting with.
+    os.nice(10)
+    PreviewDaemon(get_socket_path()).run()
+
+
+if __name__ == "__main__":
+    main()
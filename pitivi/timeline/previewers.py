@@ -20,20 +20,20 @@
 # Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
 # Boston, MA 02110-1301, USA.
 
-from datetime import datetime, timedelta
-from random import randrange
+from collections import OrderedDict
 import cairo
+import heapq
+import math
+import multiprocessing
 import numpy
 import os
-import pickle
-import sqlite3
+import threading
 
 from gi.repository import Clutter
 from gi.repository import Cogl
 from gi.repository import GES
 from gi.repository import GObject
 from gi.repository import GLib
-from gi.repository import GdkPixbuf
 from gi.repository import Gst
 
 # Our C module optimizing waveforms rendering
@@ -43,25 +43,79 @@ except ImportError:
     # Running uninstalled?
     import renderer
 
-from pitivi.settings import get_dir, xdg_cache_home
+from pitivi.settings import GlobalSettings
 from pitivi.utils.loggable import Loggable
-from pitivi.utils.misc import binary_search, filename_from_uri, quantize, quote_uri, hash_file, format_ns
-from pitivi.utils.system import CPUUsageTracker
+from pitivi.utils.governor import get_governor
+from pitivi.utils.misc import filename_from_uri, quantize, quote_uri
+from pitivi.utils.previewcaches import get_preview_caches_manager
+from pitivi.utils.previewclient import JOB_THUMBNAILS, JOB_WAVEFORM, \
+    get_daemon_client
+from pitivi.utils.thumbnails import THUMB_HEIGHT, THUMB_LEVELS, \
+    THUMB_PERIOD, PixbufMemoryCache, get_cache_for_uri, \
+    get_thumbnails_pipeline_description
 from pitivi.utils.timeline import Zoomable
 from pitivi.utils.ui import CONTROL_WIDTH
 from pitivi.utils.ui import EXPANDED_SIZE
+from pitivi.utils.waveforms import WAVEFORM_BLOCK_DURATION, \
+    WAVEFORM_CLIPPED, Waveform, WaveformExtractor, \
+    get_wavefile_location_for_uri, import_legacy_wavefile, mix_waveform
 
 
-WAVEFORMS_CPU_USAGE = 30
-
-# A little lower as it's more fluctuating
-THUMBNAILS_CPU_USAGE = 20
-
+# The margin around the thumbnails, see THUMB_HEIGHT.
 THUMB_MARGIN_PX = 3
-WAVEFORM_UPDATE_INTERVAL = timedelta(microseconds=500000)
+# When the missing thumbnails requested by the user span at least this fraction
+# of the clip, decode the clip linearly instead of seeking.
+LINEAR_DECODING_THRESHOLD = 0.5
+# The delay in milliseconds between the refinements of the approximate
+# thumbnails, which are less urgent than the missing ones.
+REFINING_INTERVAL_MS = 100
 # For the waveforms, ensures we always have a little extra surface when
 # scrolling while playing.
 MARGIN = 500
+# The channels are drawn in separate lanes when they are at least this
+# high, otherwise they are mixed down.
+WAVEFORM_MIN_LANE_HEIGHT = 12
+# The height of the markers drawn above the clipped parts of a lane.
+WAVEFORM_CLIPPING_MARKER_HEIGHT = 3
+# The width in pixels of the tiles in which the waveforms are rendered.
+WAVEFORM_TILE_WIDTH = 256
+# The memory in bytes used by the rendered waveform tiles of all the clips.
+WAVEFORM_TILES_MEMORY_BUDGET = 32 * 1024 * 1024
+# While the preview daemon generates the thumbnails of a clip, the visible
+# ones are reloaded from the cache every this many seconds.
+DAEMON_REFRESH_INTERVAL_S = 2
+
+GlobalSettings.addConfigSection("previewers")
+# The maximum number of generators running concurrently, 0 means one per core.
+GlobalSettings.addConfigOption("previewersMaxVideoJobs",
+                               section="previewers",
+                               key="max-video-jobs",
+                               default=0,
+                               notify=True)
+GlobalSettings.addConfigOption("previewersMaxAudioJobs",
+                               section="previewers",
+                               key="max-audio-jobs",
+                               default=0,
+                               notify=True)
+# Whether the thumbnails are cached as raw pixels instead of JPEG images.
+# This takes more disk space but the thumbnails are displayed faster.
+GlobalSettings.addConfigOption("previewersRawThumbnails",
+                               section="previewers",
+                               key="raw-thumbnails",
+                               default=False)
+# Whether the previews are generated by a daemon shared by all the Pitivi
+# instances, instead of by each instance.
+GlobalSettings.addConfigOption("previewersDaemon",
+                               section="previewers",
+                               key="daemon",
+                               default=False)
+# The disk space in MB used by the preview caches of all the media files,
+# 0 means unlimited. The least recently used previews are removed first.
+GlobalSettings.addConfigOption("previewersCacheBudget",
+                               section="previewers",
+                               key="cache-budget",
+                               default=4096,
+                               notify=True)
 
 PREVIEW_GENERATOR_SIGNALS = {
     "done": (GObject.SIGNAL_RUN_LAST, None, ()),
@@ -80,44 +134,103 @@ class PreviewGeneratorManager():
 
     """
     Manage the execution of PreviewGenerators
+
+    Up to a configurable number of PreviewGenerators run concurrently for
+    each GES.TrackType. The waiting ones are started in the order in which
+    they asked to be controlled, so every clip gets its turn.
     """
 
     def __init__(self):
-        # The current PreviewGenerator per GES.TrackType.
-        self._cpipeline = {}
-        # The queue of PreviewGenerators.
+        self._settings = None
+        # The running PreviewGenerators per GES.TrackType.
+        self._running = {
+            GES.TrackType.AUDIO: [],
+            GES.TrackType.VIDEO: []
+        }
+        # The queue of PreviewGenerators waiting for a free slot.
         self._pipelines = {
             GES.TrackType.AUDIO: [],
             GES.TrackType.VIDEO: []
         }
 
+    def setSettings(self, settings):
+        if self._settings is settings:
+            return
+        if self._settings:
+            self._settings.disconnect_by_func(self._maxJobsChangedCb)
+        self._settings = settings
+        settings.connect("previewersMaxVideoJobsChanged",
+                         self._maxJobsChangedCb)
+        settings.connect("previewersMaxAudioJobsChanged",
+                         self._maxJobsChangedCb)
+        self._maxJobsChangedCb(settings)
+
+    def maxJobs(self, track_type):
+        """
+        Get the number of PreviewGenerators of the specified type which
+        are allowed to run at the same time.
+        """
+        if track_type == GES.TrackType.VIDEO:
+            attrname = "previewersMaxVideoJobs"
+        else:
+            attrname = "previewersMaxAudioJobs"
+        if self._settings:
+            max_jobs = getattr(self._settings, attrname)
+        else:
+            max_jobs = GlobalSettings.defaults[attrname]
+        if max_jobs <= 0:
+            # Use all the cores.
+            max_jobs = multiprocessing.cpu_count()
+        return max_jobs
+
     def addPipeline(self, pipeline):
         track_type = pipeline.track_type
 
-        current_pipeline = self._cpipeline.get(track_type)
         if pipeline in self._pipelines[track_type] or \
-                pipeline is current_pipeline:
+                pipeline in self._running[track_type]:
             # Already in the queue or already processing.
             return
 
-        if not self._pipelines[track_type] and current_pipeline is None:
-            self._setPipeline(pipeline)
-        else:
-            self._pipelines[track_type].insert(0, pipeline)
+        self._pipelines[track_type].append(pipeline)
+        self._startPipelines(track_type)
+
+    def removePipeline(self, pipeline):
+        """
+        Forget the specified PreviewGenerator, for example because its clip
+        has been removed from the timeline.
+        """
+        track_type = pipeline.track_type
+        if pipeline in self._pipelines[track_type]:
+            self._pipelines[track_type].remove(pipeline)
+        elif pipeline in self._running[track_type]:
+            self._running[track_type].remove(pipeline)
+            pipeline.disconnect_by_func(self._nextPipeline)
+            self._startPipelines(track_type)
+
+    def _startPipelines(self, track_type):
+        queue = self._pipelines[track_type]
+        while queue and len(self._running[track_type]) < self.maxJobs(track_type):
+            self._setPipeline(queue.pop(0))
 
     def _setPipeline(self, pipeline):
-        self._cpipeline[pipeline.track_type] = pipeline
+        self._running[pipeline.track_type].append(pipeline)
         pipeline.connect("done", self._nextPipeline)
         pipeline.startGeneration()
 
     def _nextPipeline(self, controlled):
         track_type = controlled.track_type
-        pipeline = self._cpipeline.pop(track_type, None)
-        if pipeline:
-            pipeline.disconnect_by_func(self._nextPipeline)
+        if controlled in self._running[track_type]:
+            self._running[track_type].remove(controlled)
+            controlled.disconnect_by_func(self._nextPipeline)
 
-        if self._pipelines[track_type]:
-            self._setPipeline(self._pipelines[track_type].pop())
+        self._startPipelines(track_type)
+
+    def _maxJobsChangedCb(self, unused_settings):
+        pool_size = sum(self.maxJobs(track_type)
+                        for track_type in self._pipelines)
+        get_governor().setPoolSize(self, pool_size)
+        for track_type in self._pipelines:
+            self._startPipelines(track_type)
 
 
 class PreviewGenerator(object):
@@ -138,6 +251,14 @@ class PreviewGenerator(object):
         """
         self.track_type = track_type
 
+    @classmethod
+    def setSettings(cls, settings):
+        """
+        Let the PreviewGeneratorManager know the user settings, which
+        specify how many generators can run concurrently.
+        """
+        cls.__manager.setSettings(settings)
+
     def startGeneration(self):
         raise NotImplemented
 
@@ -150,6 +271,12 @@ class PreviewGenerator(object):
         """
         PreviewGenerator.__manager.addPipeline(self)
 
+    def releaseControl(self):
+        """
+        Stop and remove ourselves from the PreviewGeneratorManager
+        """
+        PreviewGenerator.__manager.removePipeline(self)
+
 
 class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
 
@@ -176,22 +303,47 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
         self.duration = bElement.props.duration
 
         # Variables related to thumbnailing
-        self.wishlist = []
+        # The visible missing thumbnails, closest to the center and the
+        # playhead first.
+        self.wishlist = WishQueue()
+        # The times of all the missing thumbnails.
+        self.queue = set()
         self._thumb_cb_id = None
-        self._allAnimated = False
         self._running = False
-        # We should have one thumbnail per thumb_period.
-        # TODO: get this from the user settings
-        self.thumb_period = int(0.5 * Gst.SECOND)
-        self.thumb_height = EXPANDED_SIZE - 2 * THUMB_MARGIN_PX
+        # Whether the governor paused the generation.
+        self._work_paused = False
+        # Whether the missing thumbnails are being generated.
+        self._thumbnailing = False
+        # Whether the clip is being decoded from start to end, instead of
+        # seeking for each thumbnail.
+        self._linear = False
+        # The (time, exact) of the thumbnail being sought.
+        self._seek = None
+        # The times of the approximate thumbnails to be refined.
+        self._refinements = None
+        # The duration of a frame of the clip, 0 if unknown.
+        self._frame_duration = 0
+        self.thumb_period = THUMB_PERIOD
+        self.thumb_height = THUMB_HEIGHT
         self.thumb_width = None  # will be set by self._setupPipeline()
 
         # Maps (quantized) times to Thumbnail objects
         self.thumbs = {}
-        self.thumb_cache = get_cache_for_uri(self.uri)
-
-        self.cpu_usage_tracker = CPUUsageTracker()
-        self.interval = 500  # Every 0.5 second, reevaluate the situation
+        # The hidden Thumbnail objects which are not used at the moment.
+        self._thumbs_pool = []
+        # The level of the pyramid of the displayed thumbnails.
+        self._thumbs_level = None
+        # Whether the thumbnails have to be repositioned.
+        self._zoomed = False
+        raw = self.timeline._settings.previewersRawThumbnails
+        self.thumb_cache = get_cache_for_uri(self.uri, raw)
+        self._daemon = None
+        # The raw thumbnails files are not shared with the daemon, see
+        # RawThumbnailFile.
+        if self.timeline._settings.previewersDaemon and not raw:
+            self._daemon = get_daemon_client()
+        self._daemon_start_id = None
+        self._daemon_refresh_id = None
 
         # Connect signals and fire things up
         self.timeline.connect("scrolled", self._scrollCb)
@@ -200,15 +352,90 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
         self.bElement.connect("notify::start", self._startChangedCb)
 
         self.pipeline = None
-        self.becomeControlled()
+        if self._daemon:
+            # The daemon schedules the jobs itself.
+            self._daemon_start_id = GLib.idle_add(
+                self._startDaemonGeneration, priority=GLib.PRIORITY_LOW)
+        else:
+            self.becomeControlled()
 
     # Internal API
     def _update(self, unused_msg_source=None):
         if self.thumb_width:
             self._addVisibleThumbnails()
-            if self.wishlist:
+            if self.wishlist and not self._daemon:
                 self.becomeControlled()
 
+    def _startDaemonGeneration(self):
+        """
+        Ask the preview daemon to generate the thumbnails.
+
+        Meanwhile, the thumbnails it saves in the cache are displayed
+        periodically.
+        """
+        self._daemon_start_id = None
+        self.debug('Requesting thumbnails for "%s" from the daemon',
+                   filename_from_uri(self.uri))
+        if not self.thumb_width:
+            self.thumb_width = self._computeThumbWidth()
+        self._addVisibleThumbnails()
+        # Even when the visible thumbnails are cached, the daemon checks
+        # the rest of the clip.
+        self._daemon.request(JOB_THUMBNAILS, self.uri, self._daemonJobDoneCb)
+        self._daemon_refresh_id = GLib.timeout_add_seconds(
+            DAEMON_REFRESH_INTERVAL_S, self._daemonRefreshCb)
+        return False
+
+    def _computeThumbWidth(self):
+        """
+        Compute the width of the thumbnails out of the discoverer info of
+        the asset, as we don't preroll a pipeline for getting it.
+        """
+        info = self.bElement.get_parent().get_asset().get_info()
+        streams = info.get_video_streams()
+        if not streams or not streams[0].get_height():
+            # assume 16:9 aspect ratio
+            return 16 * self.thumb_height / 9
+        stream = streams[0]
+        par = stream.get_par_num() / max(1, stream.get_par_denom())
+        return int(round(self.thumb_height * stream.get_width() * par /
+                         stream.get_height()))
+
+    def _computeFrameDuration(self):
+        """
+        Compute the duration of a frame of the video stream out of the
+        discoverer info of the asset.
+
+        @return: The duration, or 0 if the framerate is unknown.
+        """
+        info = self.bElement.get_parent().get_asset().get_info()
+        streams = info.get_video_streams()
+        if not streams or not streams[0].get_framerate_num():
+            return 0
+        stream = streams[0]
+        return Gst.SECOND * stream.get_framerate_denom() // \
+            stream.get_framerate_num()
+
+    def _daemonRefreshCb(self):
+        self._addVisibleThumbnails()
+        return True
+
+    def _daemonJobDoneCb(self, success):
+        if self._daemon_refresh_id:
+            GLib.source_remove(self._daemon_refresh_id)
+            self._daemon_refresh_id = None
+        # From now on, the thumbnails still missing are generated locally.
+        self._daemon = None
+        if success:
+            self.debug("The daemon generated the thumbnails")
+        else:
+            self.warning('The daemon failed generating the thumbnails for '
+                         '"%s", generating them ourselves',
+                         filename_from_uri(self.uri))
+        # The daemon skips the times which were not missing when the job
+        # started, for example when the cache has been cleared meanwhile.
+        self._update()
+
     def _setupPipeline(self):
         """
         Create the pipeline.
@@ -216,15 +443,8 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
         It has the form "playbin ! thumbnailsink" where thumbnailsink
         is a Bin made out of "videorate ! capsfilter ! gdkpixbufsink"
         """
-        # TODO: don't hardcode framerate
         self.pipeline = Gst.parse_launch(
-            "uridecodebin uri={uri} name=decode ! "
-            "videoconvert ! "
-            "videorate ! "
-            "videoscale method=lanczos ! "
-            "capsfilter caps=video/x-raw,format=(string)RGBA,height=(int){height},"
-            "pixel-aspect-ratio=(fraction)1/1,framerate=2/1 ! "
-            "gdkpixbufsink name=gdkpixbufsink".format(uri=self.uri, height=self.thumb_height))
+            get_thumbnails_pipeline_description(self.uri, self.thumb_height))
 
         # get the gdkpixbufsink and the sinkpad
         self.gdkpixbufsink = self.pipeline.get_by_name("gdkpixbufsink")
@@ -257,26 +477,42 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
         self.pipeline.get_bus().add_signal_watch()
         self.pipeline.get_bus().connect("message", self.bus_message_handler)
 
-    def _checkCPU(self):
+    def _scheduleNextThumb(self):
         """
-        Check the CPU usage and adjust the time interval (+10 or -10%) at
-        which the next thumbnail will be generated. Even then, it will only
-        happen when the gobject loop is idle to avoid blocking the UI.
+        Create the next thumbnail when the main loop is idle, unless the
+        governor paused the generation.
         """
-        usage_percent = self.cpu_usage_tracker.usage()
-        if usage_percent < THUMBNAILS_CPU_USAGE:
-            self.interval *= 0.9
-            self.log(
-                'Thumbnailing sped up (+10%%) to a %.1f ms interval for "%s"' %
-                (self.interval, filename_from_uri(self.uri)))
+        if self._work_paused or self._thumb_cb_id:
+            return
+        if self.wishlist and self.queue:
+            self._thumb_cb_id = GLib.idle_add(
+                self._create_next_thumb, priority=GLib.PRIORITY_LOW)
         else:
-            self.interval *= 1.1
-            self.log(
-                'Thumbnailing slowed down (-10%%) to a %.1f ms interval for "%s"' %
-                (self.interval, filename_from_uri(self.uri)))
-        self.cpu_usage_tracker.reset()
-        self._thumb_cb_id = GLib.timeout_add(
-            self.interval, self._create_next_thumb)
+            # Refining the approximate thumbnails is less urgent.
+            self._thumb_cb_id = GLib.timeout_add(
+                REFINING_INTERVAL_MS, self._create_next_thumb,
+                priority=GLib.PRIORITY_LOW)
+
+    def pauseWork(self):
+        """
+        Called by the governor to suspend the generation.
+        """
+        self._work_paused = True
+        if self._linear:
+            self.pipeline.set_state(Gst.State.PAUSED)
+        elif self._thumb_cb_id:
+            GLib.source_remove(self._thumb_cb_id)
+            self._thumb_cb_id = None
+
+    def resumeWork(self):
+        """
+        Called by the governor to resume the generation.
+        """
+        self._work_paused = False
+        if self._linear:
+            self.pipeline.set_state(Gst.State.PLAYING)
+        elif self._seek is None:
+            self._scheduleNextThumb()
 
     def _startThumbnailingWhenIdle(self):
         self.debug(
@@ -298,101 +534,227 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
         else:
             self.duration = duration
 
-        self.queue = list(range(0, duration, self.thumb_period))
-
-        self._checkCPU()
+        self.queue = set(self.thumb_cache.missing(
+            range(0, duration, self.thumb_period)))
+        self._refinements = None
 
         if self.bElement.props.in_point != 0:
             position = Clutter.Point()
             position.x = Zoomable.nsToPixel(self.bElement.props.in_point)
             self.scroll_to_point(position)
+        self._thumbnailing = True
         self._addVisibleThumbnails()
-        # Save periodically to avoid the common situation where the user exits
-        # the app before a long clip has been fully thumbnailed.
-        # Spread timeouts between 30-80 secs to avoid concurrent disk writes.
-        random_time = randrange(30, 80)
-        GLib.timeout_add_seconds(random_time, self._autosave)
+        if not self._linear:
+            self._scheduleNextThumb()
+        get_governor().register(self)
 
         # Remove the GSource
         return False
 
+    def _wishlistCoverage(self):
+        """
+        Get the fraction of the clip spanned by the wished thumbnails.
+
+        When zoomed out the wishes are spaced by the duration of the
+        displayed thumbnails, many times thumb_period, so the span from the
+        first to the last one is used instead of their number.
+        """
+        if not self.duration or not self.wishlist:
+            return 0
+        first, last = self.wishlist.bounds()
+        return (last - first) / self.duration
+
+    def _updateDecodingMode(self):
+        """
+        Switch between seeking and decoding linearly when the wishlist
+        changes, for example when zooming.
+        """
+        if not self._thumbnailing or not self.queue:
+            return
+        linear = self._wishlistCoverage() >= LINEAR_DECODING_THRESHOLD
+        if linear and not self._linear:
+            self._startLinearDecoding()
+        elif not linear and self._linear:
+            self._stopLinearDecoding()
+
+    def _startLinearDecoding(self):
+        """
+        Decode the clip from the first missing thumbnail to the end and
+        keep all the frames.
+
+        The videorate element outputs one frame per thumb_period, so this
+        avoids an accurate seek for each thumbnail, which on long-GOP
+        footage means decoding again from the previous keyframe.
+        """
+        self.debug('Decoding linearly: %s', filename_from_uri(self.uri))
+        if self._thumb_cb_id:
+            GLib.source_remove(self._thumb_cb_id)
+            self._thumb_cb_id = None
+        self._linear = True
+        self._seek = None
+        self._frame_duration = self._computeFrameDuration()
+        self.gdkpixbufsink.props.sync = False
+        self.pipeline.seek_simple(Gst.Format.TIME,
+                                  Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT,
+                                  min(self.queue))
+        if not self._work_paused:
+            self.pipeline.set_state(Gst.State.PLAYING)
+
+    def _stopLinearDecoding(self):
+        """
+        Go back to seeking for each wished thumbnail.
+        """
+        self.debug('Seeking thumbnails: %s', filename_from_uri(self.uri))
+        self._linear = False
+        self.gdkpixbufsink.props.sync = True
+        self.pipeline.set_state(Gst.State.PAUSED)
+        self._scheduleNextThumb()
+
+    def _linearDecodingDone(self):
+        self.debug("Linear decoding complete")
+        self.queue = set()
+        self.stopGeneration()
+        self.thumb_cache.commit()
+
     def _create_next_thumb(self):
-        if not self.wishlist or not self.queue:
+        self._thumb_cb_id = None
+        if self.wishlist and self.queue:
+            self.debug("Missing %d thumbs", len(self.wishlist))
+            time = self._get_wish()
+            if time is None:
+                time = min(self.queue)
+            # the time stays in the queue until the thumbnail is created, so
+            # that if this seek fails another try will be started later
+            # Seek to the closest keyframe to show something quickly.
+            # The thumbnail will be refined later.
+            self._seekThumbnail(time, False)
+            return False
+
+        if self._refinements is None:
+            # Refine the visible thumbnails first.
+            self._refinements = sorted(
+                self.thumb_cache.approximate(),
+                key=lambda time: (time not in self.thumbs, time))
+        if not self._refinements:
             # nothing left to do
             self.debug("Thumbnails generation complete")
             self.stopGeneration()
             self.thumb_cache.commit()
-            return
-        else:
-            self.debug("Missing %d thumbs", len(self.wishlist))
+            return False
 
-        wish = self._get_wish()
-        if wish:
-            time = wish
-            self.queue.remove(wish)
-        else:
-            time = self.queue.pop(0)
-        self.log('Creating thumb for "%s"' % filename_from_uri(self.uri))
-        # append the time to the end of the queue so that if this seek fails
-        # another try will be started later
-        self.queue.append(time)
-        self.pipeline.seek(1.0,
-                           Gst.Format.TIME, Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE,
-                           Gst.SeekType.SET, time,
-                           Gst.SeekType.NONE, -1)
+        self.log("Refining %d thumbs", len(self._refinements))
+        self._seekThumbnail(self._refinements.pop(0), True)
 
         # Remove the GSource
         return False
 
-    def _autosave(self):
-        if self.wishlist:
-            self.log("Periodic thumbnail autosave")
-            self.thumb_cache.commit()
-            return True
+    def _seekThumbnail(self, time, exact):
+        self.log('Creating thumb for "%s"' % filename_from_uri(self.uri))
+        self._seek = (time, exact)
+        if exact:
+            flags = Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE
         else:
-            return False  # Stop the timer
+            flags = Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT | \
+                Gst.SeekFlags.SNAP_NEAREST
+        self.pipeline.seek(1.0,
+                           Gst.Format.TIME, flags,
+                           Gst.SeekType.SET, time,
+                           Gst.SeekType.NONE, -1)
 
-    def _get_thumb_duration(self):
+    def _get_thumb_level(self):
+        """
+        Get the level of the thumbnails pyramid matching the zoom ratio.
+
+        This is the coarsest level which has at least a thumbnail for each
+        thumbnail displayed.
+        """
+        thumb_duration = Zoomable.pixelToNs(self.thumb_width + THUMB_MARGIN_PX)
+        level = 0
+        for index, (unused_divisor, multiplier) in enumerate(THUMB_LEVELS):
+            if multiplier * self.thumb_period <= thumb_duration:
+                level = index
+        return level
+
+    def _get_thumb_duration(self, period):
         thumb_duration_tmp = Zoomable.pixelToNs(
             self.thumb_width + THUMB_MARGIN_PX)
-        # quantize thumb length to thumb_period
-        thumb_duration = quantize(thumb_duration_tmp, self.thumb_period)
+        # quantize thumb length to the period of the level
+        thumb_duration = quantize(thumb_duration_tmp, period)
         # make sure that the thumb duration after the quantization isn't
         # smaller than before
         if thumb_duration < thumb_duration_tmp:
-            thumb_duration += self.thumb_period
-        # make sure that we don't show thumbnails more often than thumb_period
-        return max(thumb_duration, self.thumb_period)
+            thumb_duration += period
+        # make sure that we don't show thumbnails more often than period
+        return max(thumb_duration, period)
 
     def _addVisibleThumbnails(self):
         """
         Get the thumbnails to be displayed in the currently visible clip portion
-        """
-        self.remove_all_children()
-        old_thumbs = self.thumbs
-        self.thumbs = {}
-        self.wishlist = []
 
-        thumb_duration = self._get_thumb_duration()
+        The Thumbnail actors which are still visible are kept as they are.
+        The others are recycled for the newly visible thumbnails.
+        """
+        self.wishlist.clear()
+
+        level = self._get_thumb_level()
+        thumb_duration = self._get_thumb_duration(
+            THUMB_LEVELS[level][1] * self.thumb_period)
+        if level != self._thumbs_level:
+            # All the thumbnails have to be replaced with smaller or
+            # bigger ones.
+            self._recycleThumbnails(list(self.thumbs.keys()))
+            self._thumbs_level = level
         element_left, element_right = self._get_visible_range()
         element_left = quantize(element_left, thumb_duration)
-
-        for current_time in range(element_left, element_right, thumb_duration):
+        times = range(element_left, element_right, thumb_duration)
+
+        self._recycleThumbnails([time for time in self.thumbs
+                                 if time not in times])
+        if self._zoomed:
+            for time, thumb in self.thumbs.items():
+                thumb.set_position(Zoomable.nsToPixel(time), THUMB_MARGIN_PX)
+            self._zoomed = False
+
+        # The thumbnails still empty might have been cached in the meantime,
+        # for example by the preview daemon.
+        new_times = [time for time in times if time not in self.thumbs or
+                     not self.thumbs[time].has_pixel_data]
+        gdkpixbufs = {}
+        if new_times:
+            gdkpixbufs = self.thumb_cache.getRange(
+                new_times[0], new_times[-1] + 1, thumb_duration, level)
+        for current_time in new_times:
+            thumb = self.thumbs.get(current_time)
+            if thumb is None:
+                thumb = self._getRecycledThumbnail()
+                thumb.set_position(
+                    Zoomable.nsToPixel(current_time), THUMB_MARGIN_PX)
+                self.thumbs[current_time] = thumb
+            gdkpixbuf = gdkpixbufs.get(current_time)
+            if gdkpixbuf:
+                thumb.set_from_gdkpixbuf_animated(gdkpixbuf)
+
+        self.wishlist.setPoints(self._get_points_of_interest())
+        for current_time in times:
+            if not self.thumbs[current_time].has_pixel_data:
+                self.wishlist.add(current_time)
+        self._updateDecodingMode()
+
+    def _recycleThumbnails(self, times):
+        for time in times:
+            thumb = self.thumbs.pop(time)
+            thumb.clear()
+            thumb.hide()
+            self._thumbs_pool.append(thumb)
+
+    def _getRecycledThumbnail(self):
+        if self._thumbs_pool:
+            thumb = self._thumbs_pool.pop()
+            thumb.show()
+        else:
             thumb = Thumbnail(self.thumb_width, self.thumb_height)
-            thumb.set_position(
-                Zoomable.nsToPixel(current_time), THUMB_MARGIN_PX)
             self.add_child(thumb)
-            self.thumbs[current_time] = thumb
-            if current_time in self.thumb_cache:
-                gdkpixbuf = self.thumb_cache[current_time]
-                if self._allAnimated or current_time not in old_thumbs:
-                    self.thumbs[
-                        current_time].set_from_gdkpixbuf_animated(gdkpixbuf)
-                else:
-                    self.thumbs[current_time].set_from_gdkpixbuf(gdkpixbuf)
-            else:
-                self.wishlist.append(current_time)
-        self._allAnimated = False
+        return thumb
 
     def _get_wish(self):
         """
@@ -401,46 +763,39 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
         while True:
             if not self.wishlist:
                 return None
-            wish = self.wishlist.pop(0)
+            wish = self.wishlist.pop()
             if wish in self.queue:
                 return wish
 
-    def _setThumbnail(self, time, pixbuf):
-        # Q: Is "time" guaranteed to be nanosecond precise?
-        # A: Not always.
-        # => __tim says: "that's how it should be"
-        # => also see gst-plugins-good/tests/icles/gdkpixbufsink-test
-        # => Daniel: It is *not* nanosecond precise when we remove the videorate
-        #            element from the pipeline
-        # => thiblahute: not the case with mpegts
-        original_time = time
-        if time in self.thumbs:
-            thumb = self.thumbs[time]
-        else:
-            sorted_times = sorted(self.thumbs.keys())
-            index = binary_search(sorted_times, time)
-            time = sorted_times[index]
-            thumb = self.thumbs[time]
-            if thumb.has_pixel_data:
-                # If this happens, it means the precision of the thumbnail
-                # generator is not good enough for the current thumbnail
-                # interval.
-                # We could consider shifting the thumbnails, but seems like
-                # too much trouble for something which does not happen in
-                # practice. My last words..
-                self.fixme("Thumbnail is already set for time: %s, %s",
-                           format_ns(time), format_ns(original_time))
-                return
-        thumb.set_from_gdkpixbuf_animated(pixbuf)
-        if time in self.queue:
-            self.queue.remove(time)
-        self.thumb_cache[time] = pixbuf
+    def _setThumbnail(self, time, pixbuf, exact):
+        self.queue.discard(time)
+        self.wishlist.remove(time)
+        self.thumb_cache.put(time, pixbuf, exact)
+        thumb = self.thumbs.get(time)
+        if thumb:
+            thumb.set_from_gdkpixbuf_animated(pixbuf)
+
+    def _setLinearThumbnail(self, stream_time, pixbuf):
+        # Snap to the closest thumb_period multiple.
+        time = quantize(stream_time + self.thumb_period // 2,
+                        self.thumb_period)
+        if time not in self.queue:
+            # Already cached.
+            return
+        self.queue.remove(time)
+        self.wishlist.remove(time)
+        # After the key unit seek, videorate outputs the frames relative to
+        # the keyframe, which is not necessarily on a thumb_period multiple.
+        exact = abs(stream_time - time) <= self._frame_duration
+        self.thumb_cache.put(time, pixbuf, exact)
+        thumb = self.thumbs.get(time)
+        if thumb and not thumb.has_pixel_data:
+            thumb.set_from_gdkpixbuf_animated(pixbuf)
 
     # Interface (Zoomable)
 
     def zoomChanged(self):
-        self.remove_all_children()
-        self._allAnimated = True
+        self._zoomed = True
         self._update()
 
     def _get_visible_range(self):
@@ -457,6 +812,18 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
 
         return (element_left, element_right)
 
+    def _get_points_of_interest(self):
+        """
+        Get the clip times of the center of the visible timeline portion
+        and of the playhead, around which the thumbnails are needed first.
+        """
+        start = self.bElement.props.start
+        in_point = self.bElement.props.in_point
+        timeline_left, timeline_right = self._get_visible_timeline_range()
+        center = (timeline_left + timeline_right) // 2
+        playhead = self.timeline.lastPosition
+        return (center - start + in_point, playhead - start + in_point)
+
     # TODO: move to Timeline or to utils
     def _get_visible_timeline_range(self):
         # determine the visible left edge of the timeline
@@ -504,13 +871,25 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
                 message.src == self.gdkpixbufsink:
             struct = message.get_structure()
             struct_name = struct.get_name()
-            if struct_name == "preroll-pixbuf":
+            if struct_name == "preroll-pixbuf" and not self._linear:
+                if self._seek is None:
+                    return Gst.BusSyncReply.PASS
+                time, exact = self._seek
+                self._seek = None
+                # A key unit seek can still land exactly on the thumbnail.
                 stream_time = struct.get_value("stream-time")
+                exact = exact or stream_time == time
                 pixbuf = struct.get_value("pixbuf")
-                self._setThumbnail(stream_time, pixbuf)
+                self._setThumbnail(time, pixbuf, exact)
+            elif struct_name == "pixbuf" and self._linear:
+                stream_time = struct.get_value("stream-time")
+                pixbuf = struct.get_value("pixbuf")
+                self._setLinearThumbnail(stream_time, pixbuf)
         elif message.type == Gst.MessageType.ASYNC_DONE and \
-                message.src == self.pipeline:
-            self._checkCPU()
+                message.src == self.pipeline and not self._linear:
+            self._scheduleNextThumb()
+        elif message.type == Gst.MessageType.EOS and self._linear:
+            self._linearDecodingDone()
         return Gst.BusSyncReply.PASS
 
     def _autoplugSelectCb(self, unused_decode, unused_pad, unused_caps, factory):
@@ -542,6 +921,8 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
         self._startThumbnailingWhenIdle()
 
     def stopGeneration(self):
+        get_governor().unregister(self)
+        self._work_paused = False
         if self._thumb_cb_id:
             GLib.source_remove(self._thumb_cb_id)
             self._thumb_cb_id = None
@@ -550,13 +931,91 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
             self.pipeline.set_state(Gst.State.NULL)
             self.pipeline.get_state(Gst.CLOCK_TIME_NONE)
             self.pipeline = None
+        self._thumbnailing = False
+        self._linear = False
+        self._seek = None
         self.emit("done")
 
     def cleanup(self):
+        self.timeline.disconnect_by_func(self._scrollCb)
+        self.bElement.disconnect_by_func(self._durationChangedCb)
+        self.bElement.disconnect_by_func(self._inpointChangedCb)
+        self.bElement.disconnect_by_func(self._startChangedCb)
+        if self._daemon_start_id:
+            GLib.source_remove(self._daemon_start_id)
+            self._daemon_start_id = None
+        if self._daemon_refresh_id:
+            GLib.source_remove(self._daemon_refresh_id)
+            self._daemon_refresh_id = None
+        if self._daemon:
+            self._daemon.cancel(
+                JOB_THUMBNAILS, self.uri, self._daemonJobDoneCb)
+        self.releaseControl()
         self.stopGeneration()
         Zoomable.__del__(self)
 
 
+class WishQueue(object):
+
+    """Priority queue of the times of the wished thumbnails.
+
+    The times closest to any of the points of interest come out first.
+    Adding and popping are O(log n). Removed or re-added times leave stale
+    entries in the heap, which are skipped when popping.
+    """
+
+    def __init__(self):
+        self._heap = []
+        # Maps the queued times to their priority.
+        self._priorities = {}
+        self._points = ()
+
+    def __len__(self):
+        return len(self._priorities)
+
+    def __contains__(self, time):
+        return time in self._priorities
+
+    def _priority(self, time):
+        return min([abs(time - point) for point in self._points] or [0])
+
+    def setPoints(self, points):
+        """
+        Set the points of interest and reprioritize the queued times.
+        """
+        self._points = tuple(points)
+        self._heap = [(self._priority(time), time)
+                      for time in self._priorities]
+        heapq.heapify(self._heap)
+        self._priorities = dict((time, priority)
+                                for priority, time in self._heap)
+
+    def add(self, time):
+        priority = self._priority(time)
+        self._priorities[time] = priority
+        heapq.heappush(self._heap, (priority, time))
+
+    def remove(self, time):
+        self._priorities.pop(time, None)
+
+    def pop(self):
+        """Removes and returns the time with the highest priority."""
+        while self._heap:
+            priority, time = heapq.heappop(self._heap)
+            if self._priorities.get(time) == priority:
+                del self._priorities[time]
+                return time
+        raise IndexError("pop from an empty WishQueue")
+
+    def bounds(self):
+        """Returns the (earliest, latest) queued times."""
+        return min(self._priorities), max(self._priorities)
+
+    def clear(self):
+        self._heap = []
+        self._priorities = {}
+
+
 class Thumbnail(Clutter.Actor):
 
     def __init__(self, width, height):
@@ -571,17 +1030,29 @@ class Thumbnail(Clutter.Actor):
 
     def set_from_gdkpixbuf(self, gdkpixbuf):
         row_stride = gdkpixbuf.get_rowstride()
-        pixel_data = gdkpixbuf.get_pixels()
         alpha = gdkpixbuf.get_has_alpha()
+        # The pixbuf can be smaller than the actor, in which case it's scaled.
+        width = gdkpixbuf.get_width()
+        height = gdkpixbuf.get_height()
         self.has_pixel_data = True
         if alpha:
-            self.props.content.set_data(pixel_data, Cogl.PixelFormat.RGBA_8888,
-                                        self.width, self.height, row_stride)
+            pixel_format = Cogl.PixelFormat.RGBA_8888
+        else:
+            pixel_format = Cogl.PixelFormat.RGB_888
+        if hasattr(gdkpixbuf, "read_pixel_bytes"):
+            # The pixels are uploaded without being copied to Python first.
+            self.props.content.set_bytes(gdkpixbuf.read_pixel_bytes(),
+                                         pixel_format, width, height,
+                                         row_stride)
         else:
-            self.props.content.set_data(pixel_data, Cogl.PixelFormat.RGB_888,
-                                        self.width, self.height, row_stride)
+            self.props.content.set_data(gdkpixbuf.get_pixels(), pixel_format,
+                                        width, height, row_stride)
         self.set_opacity(255)
 
+    def clear(self):
+        self.has_pixel_data = False
+        self.set_opacity(0)
+
     def set_from_gdkpixbuf_animated(self, gdkpixbuf):
         self.save_easing_state()
         self.set_easing_duration(750)
@@ -589,177 +1060,190 @@ class Thumbnail(Clutter.Actor):
         self.restore_easing_state()
 
 
-caches = {}
+class SurfaceMemoryCache(PixbufMemoryCache):
 
+    """Keeps cairo image surfaces in memory using a LRU policy."""
 
-def get_cache_for_uri(uri):
-    if uri in caches:
-        return caches[uri]
-    else:
-        cache = ThumbnailCache(uri)
-        caches[uri] = cache
-        return cache
+    @staticmethod
+    def _pixbufSize(surface):
+        return surface.get_stride() * surface.get_height()
 
 
-class ThumbnailCache(Loggable):
+# The rendered tiles of all the AudioPreviewers, by
+# (wavefile, zoom ratio, tile index).
+waveform_tiles = SurfaceMemoryCache(WAVEFORM_TILES_MEMORY_BUDGET)
 
-    """Caches thumbnails by key using LRU policy, implemented with heapq.
 
-    Uses a two stage caching mechanism. A limited number of elements are
-    held in memory, the rest is being cached on disk using an sqlite db."""
+def get_waveform_tile_range(tile, blocks_per_pixel, num_blocks):
+    """
+    Get the level 0 blocks of a waveform tile and its width in pixels.
+
+    @param tile: The index of the tile.
+    @param blocks_per_pixel: The number of blocks per pixel at the zoom ratio
+    of the tile.
+    @param num_blocks: The number of level 0 blocks of the waveform.
+    @return: The (start, end, width) of the tile, start being inclusive and
+    end exclusive. The width is 0 if the tile is past the end of the waveform.
+    """
+    total_width = int(math.ceil(num_blocks / blocks_per_pixel))
+    width = min(WAVEFORM_TILE_WIDTH, total_width - tile * WAVEFORM_TILE_WIDTH)
+    if width <= 0:
+        return 0, 0, 0
+    start = min(int(tile * WAVEFORM_TILE_WIDTH * blocks_per_pixel),
+                num_blocks - 1)
+    end = int(math.ceil((tile * WAVEFORM_TILE_WIDTH + width) *
+                        blocks_per_pixel))
+    # When zoomed in a lot, a block covers many pixels.
+    end = min(max(end, start + 1), num_blocks)
+    return start, end, width
+
+
+def render_waveform_tile(waveform, zoomratio, tile):
+    """
+    Render the specified tile of a waveform.
 
-    def __init__(self, uri):
-        Loggable.__init__(self)
-        self._filehash = hash_file(Gst.uri_get_location(uri))
-        self._filename = filename_from_uri(uri)
-        thumbs_cache_dir = get_dir(os.path.join(xdg_cache_home(), "thumbs"))
-        dbfile = os.path.join(thumbs_cache_dir, self._filehash)
-        self._db = sqlite3.connect(dbfile)
-        self._cur = self._db.cursor()  # Use this for normal db operations
-        self._cur.execute("CREATE TABLE IF NOT EXISTS Thumbs\
-                          (Time INTEGER NOT NULL PRIMARY KEY,\
-                          Jpeg BLOB NOT NULL)")
-
-    def __contains__(self, key):
-        # check if item is present in on disk cache
-        self._cur.execute("SELECT Time FROM Thumbs WHERE Time = ?", (key,))
-        if self._cur.fetchone():
-            return True
-        return False
+    Safe to call from any thread, the rendering is done mostly without
+    holding the GIL.
 
-    def __getitem__(self, key):
-        self._cur.execute("SELECT * FROM Thumbs WHERE Time = ?", (key,))
-        row = self._cur.fetchone()
-        if not row:
-            raise KeyError(key)
-        jpeg = row[1]
-        loader = GdkPixbuf.PixbufLoader.new()
-        # TODO: what do to if any of the following calls fails?
-        loader.write(jpeg)
-        loader.close()
-        pixbuf = loader.get_pixbuf()
-        return pixbuf
-
-    def __setitem__(self, key, value):
-        success, jpeg = value.save_to_bufferv(
-            "jpeg", ["quality", None], ["90"])
-        if not success:
-            self.warning("JPEG compression failed")
-            return
-        blob = sqlite3.Binary(jpeg)
-        # Replace if a row with the same time already exists.
-        self._cur.execute("DELETE FROM Thumbs WHERE  time=?", (key,))
-        self._cur.execute("INSERT INTO Thumbs VALUES (?,?)", (key, blob,))
+    @type waveform: L{Waveform}
+    @param zoomratio: The zoom ratio of the tile, in pixels per second.
+    @param tile: The index of the tile.
+    @return: The cairo image surface, or None if the tile is past the end.
+    """
+    blocks_per_pixel = Gst.SECOND / zoomratio / WAVEFORM_BLOCK_DURATION
+    start, end, width = get_waveform_tile_range(
+        tile, blocks_per_pixel, len(waveform))
+    if not width:
+        return None
+    blocks = waveform.getBlocks(start, end, width)
+    lanes = waveform.channels
+    if lanes > 1 and EXPANDED_SIZE // lanes < WAVEFORM_MIN_LANE_HEIGHT:
+        blocks = mix_waveform(blocks)
+        lanes = 1
+    lane_height = EXPANDED_SIZE // lanes
+
+    surface = cairo.ImageSurface(
+        cairo.FORMAT_ARGB32, width, int(EXPANDED_SIZE))
+    context = cairo.Context(surface)
+    for lane in range(lanes):
+        # The blocks of the lane are passed without copying, even when
+        # memory-mapped.
+        lane_surface = renderer.fill_envelope_surface(
+            blocks[:, lane, :], width, lane_height)
+        context.set_source_surface(lane_surface, 0, lane * lane_height)
+        context.paint()
+        lane_surface.finish()
+        if blocks.shape[2] > WAVEFORM_CLIPPED:
+            _draw_clipping(context, blocks[:, lane, WAVEFORM_CLIPPED],
+                           width, lane * lane_height)
+    return surface
 
-    def commit(self):
-        self.debug(
-            'Saving thumbnail cache file to disk for: %s', self._filename)
-        self._db.commit()
-        self.log("Saved thumbnail cache file: %s" % self._filehash)
+
+def _draw_clipping(context, clipped, width, y):
+    """
+    Draw markers above the pixels showing clipped blocks.
+    """
+    firsts = numpy.arange(width) * len(clipped) // width
+    pixels = numpy.maximum.reduceat(clipped, firsts).nonzero()[0]
+    if not len(pixels):
+        return
+    for x in pixels.tolist():
+        context.rectangle(x, y, 1, WAVEFORM_CLIPPING_MARKER_HEIGHT)
+    context.set_source_rgb(0.9, 0.1, 0.1)
+    context.fill()
 
 
-class PipelineCpuAdapter(Loggable):
+class WaveformTilesRenderer(Loggable):
 
     """
-    This pipeline manager will modulate the rate of the provided pipeline.
-    It is the responsibility of the caller to set the sync of the sink to True,
-    disable QOS and provide a pipeline with a rate of 1.0.
-    Doing otherwise would be cheating. Cheating is bad.
+    Renders the waveform tiles on a worker thread, so painting the canvases
+    of the AudioPreviewers does not block the UI.
+
+    The tiles are rendered one at a time, in the order they are requested,
+    and put in L{waveform_tiles}.
     """
 
-    def __init__(self, pipeline):
+    def __init__(self):
         Loggable.__init__(self)
-        self.pipeline = pipeline
-        self.bus = self.pipeline.get_bus()
-
-        self.cpu_usage_tracker = CPUUsageTracker()
-        self.rate = 1.0
-        self.done = False
-        self.ready = False
-        self.lastPos = 0
-        self._bus_cb_id = None
-
-    def start(self):
-        GLib.timeout_add(200, self._modulateRate)
-        self._bus_cb_id = self.bus.connect("message", self._messageCb)
-        self.done = False
-
-    def stop(self):
-        if self._bus_cb_id is not None:
-            self.bus.disconnect(self._bus_cb_id)
-            self._bus_cb_id = None
-        self.pipeline = None
-        self.done = True
-
-    def _modulateRate(self):
+        # The keys of the tiles to be rendered, with their waveform and the
+        # callbacks to be called once they are.
+        self._pending = OrderedDict()
+        self._worker = None
+        # The key of the tile being rendered.
+        self._key = None
+
+    def request(self, key, waveform, callback):
         """
-        Adapt the rate of audio playback (analysis) depending on CPU usage.
+        Render a tile unless it is already cached.
+
+        @param key: The (wavefile, zoom ratio, tile index) of the tile.
+        @type waveform: L{Waveform}
+        @param callback: Called in the main loop with the key once the tile
+        is in L{waveform_tiles}.
+        @return: Whether the tile exists, False if it's past the end.
         """
-        if self.done:
+        unused_wavefile, zoomratio, tile = key
+        blocks_per_pixel = Gst.SECOND / zoomratio / WAVEFORM_BLOCK_DURATION
+        if not get_waveform_tile_range(tile, blocks_per_pixel,
+                                       len(waveform))[2]:
             return False
+        unused_waveform, callbacks = self._pending.setdefault(
+            key, (waveform, []))
+        if callback not in callbacks:
+            callbacks.append(callback)
+        if not self._worker:
+            self._startWorker()
+        return True
 
-        usage_percent = self.cpu_usage_tracker.usage()
-        self.cpu_usage_tracker.reset()
-        if usage_percent >= WAVEFORMS_CPU_USAGE:
-            if self.rate < 0.1:
-                if not self.ready:
-                    self.ready = True
-                    self.pipeline.set_state(Gst.State.READY)
-                    res, self.lastPos = self.pipeline.query_position(
-                        Gst.Format.TIME)
-                return True
-
-            if self.rate > 0.0:
-                self.rate *= 0.9
-                self.log(
-                    'Pipeline rate slowed down (-10%%) to %.3f' % self.rate)
-        else:
-            self.rate *= 1.1
-            self.log('Pipeline rate sped up (+10%%) to %.3f' % self.rate)
-
-        if not self.ready:
-            res, position = self.pipeline.query_position(Gst.Format.TIME)
-        else:
-            # This to avoid going back and forth from READY to PAUSED
-            if self.rate > 0.5:
-                # The message handler will unset ready and seek correctly.
-                self.pipeline.set_state(Gst.State.PAUSED)
-            return True
+    def cancel(self, callback):
+        """
+        Forget the specified callback and the tiles nobody waits for anymore.
+        """
+        for key, (unused_waveform, callbacks) in list(self._pending.items()):
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks and key != self._key:
+                del self._pending[key]
+
+    def _startWorker(self):
+        key, (waveform, unused_callbacks) = next(iter(self._pending.items()))
+        self._key = key
+        unused_wavefile, zoomratio, tile = key
+        self._worker = threading.Thread(target=self._work,
+                                        args=(waveform, zoomratio, tile),
+                                        name="waveformtiles", daemon=True)
+        self._worker.start()
+
+    def _work(self, waveform, zoomratio, tile):
+        try:
+            surface = render_waveform_tile(waveform, zoomratio, tile)
+        except (cairo.Error, ValueError) as e:
+            self.warning("Failed rendering a waveform tile: %s", e)
+            surface = None
+        GLib.idle_add(self._workDoneCb, surface)
+
+    def _workDoneCb(self, surface):
+        self._worker.join()
+        self._worker = None
+        key = self._key
+        self._key = None
+        unused_waveform, callbacks = self._pending.pop(key)
+        if surface is not None:
+            waveform_tiles.put(key, surface)
+            for callback in callbacks:
+                callback(key)
+        if self._pending:
+            self._startWorker()
+        return False
 
-        self.pipeline.set_state(Gst.State.PAUSED)
-        self.pipeline.seek(self.rate,
-                           Gst.Format.TIME,
-                           Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE,
-                           Gst.SeekType.SET,
-                           position,
-                           Gst.SeekType.NONE,
-                           -1)
-        self.pipeline.set_state(Gst.State.PLAYING)
-        self.ready = False
-        # Keep the glib timer running:
-        return True
 
-    def _messageCb(self, unused_bus, message):
-        if not self.ready:
-            return
-        if message.type == Gst.MessageType.STATE_CHANGED:
-            prev, new, pending = message.parse_state_changed()
-            if message.src == self.pipeline:
-                if prev == Gst.State.READY and new == Gst.State.PAUSED:
-                    self.pipeline.seek(1.0,
-                                       Gst.Format.TIME,
-                                       Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE,
-                                       Gst.SeekType.SET,
-                                       self.lastPos,
-                                       Gst.SeekType.NONE,
-                                       -1)
-                    self.ready = False
+waveform_tiles_renderer = WaveformTilesRenderer()
 
 
 class AudioPreviewer(Clutter.Actor, PreviewGenerator, Zoomable, Loggable):
 
     """
-    Audio previewer based on the results from the "level" gstreamer element.
+    Audio previewer showing the waveform extracted by a WaveformExtractor.
     """
 
     __gsignals__ = PREVIEW_GENERATOR_SIGNALS
@@ -770,7 +1254,6 @@ class AudioPreviewer(Clutter.Actor, PreviewGenerator, Zoomable, Loggable):
         Zoomable.__init__(self)
         Loggable.__init__(self)
 
-        self.pipeline = None
         self.discovered = False
         self.bElement = bElement
         # Guard against malformed URIs
@@ -783,18 +1266,17 @@ class AudioPreviewer(Clutter.Actor, PreviewGenerator, Zoomable, Loggable):
         self.canvas = Clutter.Canvas()
         self.set_content(self.canvas)
         self.width = 0
-        self._num_failures = 0
-        self.lastUpdate = None
-
-        self.current_geometry = (-1, -1)
+        self._extractor = None
+        # The position of the canvas in the asset, in pixels.
+        self._asset_offset = 0
 
-        self.adapter = None
-        self.surface = None
         self.timeline.connect("scrolled", self._scrolledCb)
         self.canvas.connect("draw", self._drawContentCb)
         self.canvas.invalidate()
 
-        self._callback_id = 0
+        self._daemon = None
+        if self.timeline._settings.previewersDaemon:
+            self._daemon = get_daemon_client()
 
     def startLevelsDiscoveryWhenIdle(self):
         self.debug('Waiting for UI to become idle for: %s',
@@ -803,36 +1285,36 @@ class AudioPreviewer(Clutter.Actor, PreviewGenerator, Zoomable, Loggable):
 
     def _startLevelsDiscovery(self):
         self.log('Preparing waveforms for "%s"' % filename_from_uri(self._uri))
-        filename = hash_file(Gst.uri_get_location(self._uri)) + ".wave"
-        cache_dir = get_dir(os.path.join(xdg_cache_home(), "waves"))
-        filename = os.path.join(cache_dir, filename)
+        self.wavefile = get_wavefile_location_for_uri(self._uri)
+        get_preview_caches_manager().touch(self.wavefile, self._uri)
 
-        if os.path.exists(filename):
-            self.samples = pickle.load(open(filename, "rb"))
-            self._startRendering()
+        if self._loadWavefile():
+            return
+        if self._daemon:
+            self._daemon.request(
+                JOB_WAVEFORM, self._uri, self._daemonJobDoneCb)
         else:
-            self.wavefile = filename
-            self._launchPipeline()
-
-    def _launchPipeline(self):
-        self.debug(
-            'Now generating waveforms for: %s', filename_from_uri(self._uri))
-        self.peaks = None
-        self.pipeline = Gst.parse_launch("uridecodebin name=decode uri=" + self._uri +
-                                         " ! audioconvert ! level name=wavelevel interval=10000000 post-messages=true ! fakesink qos=false name=faked")
-        faked = self.pipeline.get_by_name("faked")
-        faked.props.sync = True
-        self._wavelevel = self.pipeline.get_by_name("wavelevel")
-        decode = self.pipeline.get_by_name("decode")
-        decode.connect("autoplug-select", self._autoplugSelectCb)
-        bus = self.pipeline.get_bus()
-        bus.add_signal_watch()
+            self.becomeControlled()
 
-        self.nSamples = self.bElement.get_parent(
-        ).get_asset().get_duration() / 10000000
-        bus.connect("message", self._busMessageCb)
+    def _daemonJobDoneCb(self, success):
+        if success and self._loadWavefile():
+            self.debug("The daemon generated the waveform")
+            return
+        self.warning('The daemon failed generating the waveform for "%s", '
+                     'generating it ourselves', filename_from_uri(self._uri))
+        self._daemon = None
         self.becomeControlled()
 
+    def _loadWavefile(self):
+        import_legacy_wavefile(self.wavefile)
+        if not os.path.isdir(self.wavefile):
+            return False
+        self.waveform = Waveform(self.wavefile)
+        if not len(self.waveform):
+            return False
+        self._startRendering()
+        return True
+
     def set_size(self, unused_width, unused_height):
         if self.discovered:
             self._maybeUpdate()
@@ -842,21 +1324,12 @@ class AudioPreviewer(Clutter.Actor, PreviewGenerator, Zoomable, Loggable):
 
     def _maybeUpdate(self):
         if self.discovered:
-            self.log('Checking if the waveform for "%s" needs to be redrawn' %
-                     self._uri)
-            if self.lastUpdate is None or datetime.now() - self.lastUpdate > WAVEFORM_UPDATE_INTERVAL:
-                # Last update was long ago or never.
-                self._compute_geometry()
-            else:
-                if self._callback_id:
-                    GLib.source_remove(self._callback_id)
-                self._callback_id = GLib.timeout_add(
-                    500, self._compute_geometry)
+            # Cheap, as only the tiles not rendered yet at this zoom ratio
+            # are rendered, the others are just painted.
+            self._compute_geometry()
 
     def _compute_geometry(self):
-        self._callback_id = 0
         self.log("Computing the clip's geometry for waveforms")
-        self.lastUpdate = datetime.now()
         width_px = self.nsToPixel(self.bElement.props.duration)
         if width_px <= 0:
             return
@@ -875,159 +1348,79 @@ class AudioPreviewer(Clutter.Actor, PreviewGenerator, Zoomable, Loggable):
         if self.width < 0:
             return
 
-        # We need to take duration and inpoint into account.
-        asset_duration = self.bElement.get_parent().get_asset().get_duration()
-        if self.bElement.props.duration:
-            nbSamples = self.nbSamples / \
-                (float(asset_duration) / float(self.bElement.props.duration))
-        else:
-            nbSamples = self.nbSamples
-        if self.bElement.props.in_point:
-            startOffsetSamples = self.nbSamples / \
-                (float(asset_duration) / float(self.bElement.props.in_point))
-        else:
-            startOffsetSamples = 0
-
-        self.start = int(start / width_px * nbSamples + startOffsetSamples)
-        self.end = int(end / width_px * nbSamples + startOffsetSamples)
+        # The tiles are aligned on the beginning of the asset.
+        self._asset_offset = start + \
+            self.bElement.props.in_point * Zoomable.zoomratio / Gst.SECOND
 
         self.canvas.set_size(self.width, EXPANDED_SIZE)
         Clutter.Actor.set_size(self, self.width, EXPANDED_SIZE)
         self.set_position(start, self.props.y)
         self.canvas.invalidate()
 
-    def _prepareSamples(self):
-        # Let's go mono.
-        if len(self.peaks) > 1:
-            samples = (
-                numpy.array(self.peaks[0]) + numpy.array(self.peaks[1])) / 2
-        else:
-            samples = numpy.array(self.peaks[0])
-
-        self.samples = samples.tolist()
-        f = open(self.wavefile, 'wb')
-        pickle.dump(self.samples, f)
-
     def _startRendering(self):
-        self.nbSamples = len(self.samples)
+        self.nbSamples = len(self.waveform)
         self.discovered = True
-        self.start = 0
-        self.end = self.nbSamples
         self._compute_geometry()
-        if self.adapter:
-            self.adapter.stop()
-
-    def _busMessageCb(self, bus, message):
-        if message.src == self._wavelevel:
-            s = message.get_structure()
-            p = None
-            if s:
-                p = s.get_value("rms")
-
-            if p:
-                st = s.get_value("stream-time")
-
-                if self.peaks is None:
-                    self.peaks = []
-                    for channel in p:
-                        self.peaks.append([0] * int(self.nSamples))
-
-                pos = int(st / 10000000)
-                if pos >= len(self.peaks[0]):
-                    return
-
-                for i, val in enumerate(p):
-                    if val < 0:
-                        val = 10 ** (val / 20) * 100
-                        self.peaks[i][pos] = val
-                    else:
-                        self.peaks[i][pos] = self.peaks[i][pos - 1]
-            return
-
-        if message.type == Gst.MessageType.EOS:
-            self._prepareSamples()
-            self._startRendering()
-            self.stopGeneration()
-
-        elif message.type == Gst.MessageType.ERROR:
-            if self.adapter:
-                self.adapter.stop()
-                self.adapter = None
-            # Something went wrong TODO : recover
-            self.stopGeneration()
-            self._num_failures += 1
-            if self._num_failures < 2:
-                self.warning("Issue during waveforms generation: %s"
-                             " for the %ith time, trying again with no rate "
-                             " modulation", message.parse_error(),
-                             self._num_failures)
-                bus.disconnect_by_func(self._busMessageCb)
-                self._launchPipeline()
-                self.becomeControlled()
-            else:
-                self.error("Issue during waveforms generation: %s"
-                           "Abandonning", message.parse_error())
-
-        elif message.type == Gst.MessageType.STATE_CHANGED:
-            prev, new, pending = message.parse_state_changed()
-            if message.src == self.pipeline:
-                if prev == Gst.State.READY and new == Gst.State.PAUSED:
-                    self.pipeline.seek(1.0,
-                                       Gst.Format.TIME,
-                                       Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE,
-                                       Gst.SeekType.SET,
-                                       0,
-                                       Gst.SeekType.NONE,
-                                       -1)
-
-                # In case we failed previously, we won't modulate next time
-                elif not self.adapter and prev == Gst.State.PAUSED and \
-                        new == Gst.State.PLAYING and self._num_failures == 0:
-                    self.adapter = PipelineCpuAdapter(self.pipeline)
-                    self.adapter.start()
-
-    def _autoplugSelectCb(self, unused_decode, unused_pad, unused_caps, factory):
-        # Don't plug video decoders / parsers.
-        if "Video" in factory.get_klass():
-            return True
-        return False
 
     def _drawContentCb(self, unused_canvas, context, unused_surf_w, unused_surf_h):
         context.set_operator(cairo.OPERATOR_CLEAR)
         context.paint()
-        if not self.discovered:
+        if not self.discovered or self.width <= 0:
             return
 
-        if self.surface:
-            self.surface.finish()
-
-        self.surface = renderer.fill_surface(
-            self.samples[self.start:self.end], int(self.width), int(EXPANDED_SIZE))
-
+        # The tiles requested for a previous zoom ratio or scroll position
+        # are not needed anymore.
+        waveform_tiles_renderer.cancel(self._tileRenderedCb)
         context.set_operator(cairo.OPERATOR_OVER)
-        context.set_source_surface(self.surface, 0, 0)
-        context.paint()
+        first = int(self._asset_offset // WAVEFORM_TILE_WIDTH)
+        last = int((self._asset_offset + self.width) // WAVEFORM_TILE_WIDTH)
+        for tile in range(first, last + 1):
+            key = (self.wavefile, Zoomable.zoomratio, tile)
+            surface = waveform_tiles.get(key)
+            if surface is None:
+                # The missing tile is painted once rendered, see
+                # _tileRenderedCb.
+                if not waveform_tiles_renderer.request(
+                        key, self.waveform, self._tileRenderedCb):
+                    break
+                continue
+            context.set_source_surface(
+                surface, tile * WAVEFORM_TILE_WIDTH - self._asset_offset, 0)
+            context.paint()
+
+    def _tileRenderedCb(self, key):
+        wavefile, zoomratio, unused_tile = key
+        if wavefile == self.wavefile and zoomratio == Zoomable.zoomratio:
+            self.canvas.invalidate()
 
     def _scrolledCb(self, unused):
         self._maybeUpdate()
 
     def startGeneration(self):
-        self.pipeline.set_state(Gst.State.PLAYING)
-        if self.adapter is not None:
-            self.adapter.start()
+        self.debug(
+            'Now generating waveforms for: %s', filename_from_uri(self._uri))
+        self._extractor = WaveformExtractor(
+            self._uri, self.wavefile, self._extractedCb)
+        self._extractor.start()
+
+    def _extractedCb(self, success):
+        self._extractor = None
+        if not success or not self._loadWavefile():
+            self.warning('No waveform for "%s"', filename_from_uri(self._uri))
+        self.stopGeneration()
 
     def stopGeneration(self):
-        if self.adapter is not None:
-            self.adapter.stop()
-            self.adapter = None
-
-        if self.pipeline:
-            self.pipeline.set_state(Gst.State.NULL)
-            self.pipeline.get_state(Gst.CLOCK_TIME_NONE)
+        if self._extractor:
+            self._extractor.stop()
+            self._extractor = None
 
         self.emit("done")
 
     def cleanup(self):
+        if self._daemon:
+            self._daemon.cancel(JOB_WAVEFORM, self._uri, self._daemonJobDoneCb)
+        waveform_tiles_renderer.cancel(self._tileRenderedCb)
+        self.releaseControl()
         self.stopGeneration()
         self.canvas.disconnect_by_func(self._drawContentCb)
         self.timeline.disconnect_by_func(self._scrolledCb)
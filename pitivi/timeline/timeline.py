@@ -39,9 +39,13 @@ from pitivi.dialogs.prefs import PreferencesDialog
 from pitivi.settings import GlobalSettings
 from pitivi.timeline.controls import ControlContainer
 from pitivi.timeline.elements import URISourceElement, TransitionElement, Ghostclip
+from pitivi.timeline.previewers import PreviewGenerator
 from pitivi.timeline.ruler import ScaleRuler
+from pitivi.utils.governor import get_governor
 from pitivi.utils.loggable import Loggable
+from pitivi.utils.misc import filename_from_uri
 from pitivi.utils.pipeline import PipelineError
+from pitivi.utils.previewcaches import get_preview_caches_manager
 from pitivi.utils.timeline import Zoomable, Selection, SELECT, TimelineError
 from pitivi.utils.ui import alter_style_class, EFFECT_TARGET_ENTRY, EXPANDED_SIZE, SPACING, PLAYHEAD_COLOR, PLAYHEAD_WIDTH, CONTROL_WIDTH
 from pitivi.utils.widgets import ZoomBox
@@ -73,6 +77,18 @@ PreferencesDialog.addNumericPreference('imageClipLength',
                                            "Default clip length (in miliseconds) of images when inserting on the timeline."),
                                        lower=1)
 
+GlobalSettings.addConfigOption('autoAlignEstimateDrift',
+                               section="user-interface",
+                               key="autoalign-estimate-drift",
+                               default=False)
+
+PreferencesDialog.addTogglePreference('autoAlignEstimateDrift',
+                                      section=_("Behavior"),
+                                      label=_("Estimate the clock drift when aligning"),
+                                      description=_(
+                                          "When auto-aligning clips, also measure how much faster or slower "
+                                          "each clip runs than the reference clip. This takes longer."))
+
 # Colors
 TIMELINE_BACKGROUND_COLOR = Clutter.Color.new(31, 30, 33, 255)
 SELECTION_MARQUEE_COLOR = Clutter.Color.new(100, 100, 100, 200)
@@ -107,6 +123,8 @@ class TimelineStage(Clutter.ScrollActor, Zoomable, Loggable):
         self._container = container
         self.allowSeek = True
         self._settings = settings
+        PreviewGenerator.setSettings(settings)
+        get_preview_caches_manager().setSettings(settings)
         self.elements = []
         self.ghostClips = []
         self.selection = Selection()
@@ -384,6 +402,8 @@ class TimelineStage(Clutter.ScrollActor, Zoomable, Loggable):
         track.disconnect_by_func(self._trackElementRemovedCb)
 
     def _positionCb(self, unused_pipeline, position):
+        # Playing or seeking, the background work should not get in the way.
+        get_governor().userActive()
         self._movePlayhead(position)
         self._container._scrollToPlayhead()
         self.lastPosition = position
@@ -537,6 +557,7 @@ class TimelineStage(Clutter.ScrollActor, Zoomable, Loggable):
     def scroll_to_point(self, point):
         Clutter.ScrollActor.scroll_to_point(self, point)
         self._scroll_point = point.copy()
+        get_governor().userActive()
         self.emit("scrolled")
 
     def get_scroll_point(self):
@@ -1231,16 +1252,24 @@ class TimelineContainer(Gtk.Grid, Zoomable, Loggable):
                 "Trying to use the autoalign feature with an empty timeline")
             return
 
-        progress_dialog = AlignmentProgressDialog(self.app)
-        progress_dialog.window.show()
-        self.app.action_log.begin("align")
-
         def alignedCb():  # Called when alignment is complete
             self.app.action_log.commit()
             self._project.pipeline.commit_timeline()
             progress_dialog.window.destroy()
+            if auto_aligner.failed or auto_aligner.drifts:
+                self._showAlignmentReport(auto_aligner)
+
+        def cancelledCb():
+            auto_aligner.cancel()
+            self.app.action_log.rollback()
+            progress_dialog.window.destroy()
 
-        auto_aligner = AutoAligner(self.timeline.selection, alignedCb)
+        auto_aligner = AutoAligner(
+            self.timeline.selection, alignedCb,
+            estimate_drift=self._settings.autoAlignEstimateDrift)
+        progress_dialog = AlignmentProgressDialog(self.app, cancelledCb)
+        progress_dialog.window.show()
+        self.app.action_log.begin("align")
         try:
             progress_meter = auto_aligner.start()
             progress_meter.addWatcher(progress_dialog.updatePosition)
@@ -1248,6 +1277,40 @@ class TimelineContainer(Gtk.Grid, Zoomable, Loggable):
             self.error("Could not start the autoaligner: %s" % e)
             progress_dialog.window.destroy()
 
+    def _showAlignmentReport(self, auto_aligner):
+        """
+        Show the clips which could not be aligned and the estimated drifts.
+        """
+        paragraphs = []
+        if auto_aligner.failed:
+            names = "\n".join(filename_from_uri(clip.props.uri)
+                              for clip in auto_aligner.failed)
+            paragraphs.append(
+                _("The audio of these clips could not be decoded:\n%s") % names)
+        if auto_aligner.drifts:
+            # A positive drift means the clip runs faster than the reference.
+            lines = [_("%(name)s: %(drift)+.3f%%") %
+                     {"name": filename_from_uri(clip.props.uri),
+                      "drift": drift * 100}
+                     for clip, drift in auto_aligner.drifts.items()]
+            paragraphs.append(
+                _("The speed of the clips relative to the reference:\n%s") %
+                "\n".join(lines))
+        if auto_aligner.failed:
+            message_type = Gtk.MessageType.WARNING
+            text = _("Some clips could not be aligned")
+        else:
+            message_type = Gtk.MessageType.INFO
+            text = _("The clips have been aligned")
+        dialog = Gtk.MessageDialog(transient_for=self.app.gui,
+                                   modal=True,
+                                   message_type=message_type,
+                                   buttons=Gtk.ButtonsType.OK,
+                                   text=text)
+        dialog.set_property("secondary-text", "\n\n".join(paragraphs))
+        dialog.run()
+        dialog.destroy()
+
     def _splitCb(self, unused_action):
         """
         If clips are selected, split them at the current playhead position.
@@ -18,44 +18,26 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with this program; if not, write to the
 # Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
-# Boston, MA 02110-1301, USA.from gi.repository import Gst
+# Boston, MA 02110-1301, USA.
 
 """
 Classes for extracting decoded contents of streams into Python
-
-Code derived from ui/previewer.py.
 """
 
-# FIXME reimplement after GES port
+import threading
 
+import numpy
+from gi.repository import GLib
 from gi.repository import Gst
-from collections import deque
-# from pitivi.elements.singledecodebin import SingleDecodeBin
-# from pitivi.elements.extractionsink import ExtractionSink
-from pitivi.utils.loggable import Loggable
-
 
-def linkDynamic(element, target):
+from pitivi.utils.governor import get_governor
+from pitivi.utils.loggable import Loggable
+from pitivi.utils.misc import filename_from_uri
 
-    def pad_added(unused_bin, pad, target):
-        compatpad = target.get_compatible_pad(pad)
-        if compatpad:
-            pad.link_full(compatpad, Gst.PAD_LINK_CHECK_NOTHING)
-    element.connect("pad-added", pad_added, target)
 
-
-def pipeline(graph):
-    E = iter(graph.items())
-    V = iter(graph.keys())
-    p = Gst.Pipeline()
-    p.add(*V)
-    for u, v in E:
-        if v:
-            try:
-                u.link(v)
-            except Gst.LinkError:
-                linkDynamic(u, v)
-    return p
+# The decoded buffers queued in the appsink of an extractor. When the worker
+# thread lags behind, the decoding blocks instead of using more memory.
+APPSINK_MAX_BUFFERS = 8
 
 
 class Extractee:
@@ -66,7 +48,10 @@ class Extractee:
         """
         Receive a chunk of data from an Extractor.
 
-        @param array: The chunk of data as an array
+        Called from the extraction thread of the Extractor.
+
+        @param array: The chunk of data as an array, which maps the decoded
+            buffer and is valid only during the call.
         @type array: any kind of numeric array
 
         """
@@ -82,27 +67,35 @@ class Extractee:
         """
         raise NotImplementedError
 
+    def fail(self):
+        """
+        Inform the Extractee that the extraction failed.
+
+        Called from the main loop instead of finalize() when the stream
+            cannot be decoded to the end, so the data received so far is
+            incomplete.
+
+        """
+        raise NotImplementedError
+
 
 class Extractor(Loggable):
 
     """
     Abstract base class for extraction of raw data from a stream.
 
-    Closely modeled on L{Previewer}.
-
     """
 
-    def __init__(self, factory, stream_):
+    def __init__(self, uri):
         """
         Create a new Extractor.
 
-        @param factory: the factory with which to decode the stream
-        @type factory: L{ObjectFactory}
-        @param stream_: the stream to decode
-        @type stream_: L{Stream}
+        @param uri: the URI of the media file to decode
+        @type uri: L{str}
         """
         Loggable.__init__(self)
-        self.debug("Initialized with %s %s", factory, stream_)
+        self.uri = uri
+        self.debug("Initialized with %s", uri)
 
     def extract(self, extractee, start, duration):
         """
@@ -119,69 +112,56 @@ class Extractor(Loggable):
         """
         raise NotImplementedError
 
-
-class RandomAccessExtractor(Extractor):
-
-    """
-    Abstract class for L{Extractor}s of random access streams.
-
-    Closely inspired by L{RandomAccessPreviewer}.
-
-    """
-
-    def __init__(self, factory, stream_):
-        Extractor.__init__(self, factory, stream_)
-        # FIXME:
-        # why doesn't this work?
-        # bin = factory.makeBin(stream_)
-        uri = factory.uri
-        caps = stream_.caps
-        bin = SingleDecodeBin(uri=uri, caps=caps, stream=stream_)
-
-        self._pipelineInit(factory, bin)
-
-    def _pipelineInit(self, factory, bin):
+    def stop(self):
         """
-        Create the pipeline for the preview process.
+        Abort the extraction and release the decoder.
 
-        Subclasses should
-        override this method and create a pipeline, connecting to
-        callbacks to the appropriate signals, and prerolling the
-        pipeline if necessary.
+        The L{Extractee}s of the pending segments are neither finalized nor
+        failed.
 
         """
         raise NotImplementedError
 
 
-class RandomAccessAudioExtractor(RandomAccessExtractor):
+class RandomAccessAudioExtractor(Extractor):
 
     """
     L{Extractor} for random access audio streams.
 
-    Closely inspired by L{RandomAccessAudioPreviewer}.
+    The stream is decoded to mono float samples by a uridecodebin pipeline
+    ending with an appsink. For each segment, the pipeline is seeked and the
+    buffers are pulled on a worker thread and handed over to the
+    L{Extractee} without being copied, so the decoding goes as fast as
+    possible and the memory used doesn't depend on the length of the segment.
+
+    The extractor is paused and resumed by the background work governor.
+    When the decoding fails, the L{Extractee}s of the pending segments are
+    failed and the extractor is stopped.
 
     """
 
-    def __init__(self, factory, stream_):
-        self._queue = deque()
-        RandomAccessExtractor.__init__(self, factory, stream_)
+    def __init__(self, uri, rate):
+        """
+        @param rate: The sample rate of the extracted data.
+        @type rate: L{int}
+        """
+        Extractor.__init__(self, uri)
+        self._queue = []
         self._ready = False
-
-    def _pipelineInit(self, factory, sbin):
-        self.audioSink = ExtractionSink()
-        self.audioSink.set_stopped_cb(self._finishSegment)
+        self._paused = False
+        self._thread = None
         # This audiorate element ensures that the extracted raw-data
         # timeline matches the timestamps used for seeking, even if the
         # audio source has gaps or other timestamp abnormalities.
-        audiorate = Gst.ElementFactory.make("audiorate")
-        conv = Gst.ElementFactory.make("audioconvert")
-        q = Gst.ElementFactory.make("queue")
-        self.audioPipeline = pipeline({
-            sbin: audiorate,
-            audiorate: conv,
-            conv: q,
-            q: self.audioSink,
-            self.audioSink: None})
+        self.audioPipeline = Gst.parse_launch(
+            "uridecodebin name=decode uri=" + uri + " ! audioconvert ! "
+            "audioresample ! audiorate ! capsfilter caps=audio/x-raw,"
+            "format=F32LE,channels=1,rate=%d,layout=interleaved ! "
+            "appsink name=sink sync=false max-buffers=%d drop=false" %
+            (rate, APPSINK_MAX_BUFFERS))
+        decode = self.audioPipeline.get_by_name("decode")
+        decode.connect("autoplug-select", self._autoplugSelectCb)
+        self._sink = self.audioPipeline.get_by_name("sink")
         bus = self.audioPipeline.get_bus()
         bus.add_signal_watch()
         bus.connect("message::error", self._busMessageErrorCb)
@@ -197,19 +177,42 @@ class RandomAccessAudioExtractor(RandomAccessExtractor):
         # message is received before setting self._ready = True,
         # which enables extraction to proceed.
 
+    def _autoplugSelectCb(self, unused_decode, unused_pad, unused_caps, factory):
+        # Don't plug video decoders / parsers.
+        if "Video" in factory.get_klass():
+            return True
+        return False
+
     def _busMessageErrorCb(self, unused_bus, message):
         error, debug = message.parse_error()
-        self.error("Event bus error: %s; %s", error, debug)
+        self.error("Failed extracting %s: %s; %s",
+                   filename_from_uri(self.uri), error, debug)
+        self._fail()
 
-        return Gst.BusSyncReply.PASS
+    def _fail(self):
+        extractees = [extractee for extractee, unused_start, unused_duration
+                      in self._queue]
+        self.stop()
+        for extractee in extractees:
+            extractee.fail()
 
     def _busMessageAsyncDoneCb(self, bus, unused_message):
         self.debug("Pipeline is ready for seeking")
         bus.disconnect(self._donecb_id)  # Don't call me again
         self._ready = True
+        get_governor().register(self)
         if self._queue:  # Someone called .extract() before we were ready
             self._run()
 
+    def pauseWork(self):
+        self._paused = True
+        self.audioPipeline.set_state(Gst.State.PAUSED)
+
+    def resumeWork(self):
+        self._paused = False
+        if self._thread:
+            self.audioPipeline.set_state(Gst.State.PLAYING)
+
     def _startSegment(self, timestamp, duration):
         self.debug("processing segment with timestamp=%i and duration=%i",
                    timestamp, duration)
@@ -220,17 +223,52 @@ class RandomAccessAudioExtractor(RandomAccessExtractor):
                                       Gst.SeekType.SET, timestamp + duration)
         if not res:
             self.warning("seek failed %s", timestamp)
-        self.audioPipeline.set_state(Gst.State.PLAYING)
+        if not self._paused:
+            self.audioPipeline.set_state(Gst.State.PLAYING)
 
         return res
 
-    def _finishSegment(self):
-        self.audioSink.extractee.finalize()
-        self.audioSink.reset()
-        self._queue.popleft()
+    def _extractSegment(self, extractee):
+        # Runs on the worker thread until the end of the segment.
+        while True:
+            sample = self._sink.emit("pull-sample")
+            if sample is None:
+                # EOS, or the pipeline has been stopped.
+                break
+            buf = sample.get_buffer()
+            mapped, info = buf.map(Gst.MapFlags.READ)
+            if not mapped:
+                continue
+            try:
+                extractee.receive(numpy.frombuffer(info.data, "<f4"))
+            finally:
+                buf.unmap(info)
+        if self._sink.props.eos:
+            extractee.finalize()
+            GLib.idle_add(self._finishSegmentCb)
+        else:
+            GLib.idle_add(self._segmentInterruptedCb)
+
+    def _finishSegmentCb(self):
+        if self._thread is None:
+            # Stopped meanwhile.
+            return False
+        self._thread.join()
+        self._thread = None
+        self._queue.pop(0)
         # If there's more to do, keep running
         if self._queue:
             self._run()
+        return False
+
+    def _segmentInterruptedCb(self):
+        if self._thread is None:
+            # Stopped meanwhile, or failed by the error message.
+            return False
+        self.error("The decoding of %s stopped before the end of the segment",
+                   filename_from_uri(self.uri))
+        self._fail()
+        return False
 
     def extract(self, extractee, start, duration):
         stopped = not self._queue
@@ -238,15 +276,33 @@ class RandomAccessAudioExtractor(RandomAccessExtractor):
         if stopped and self._ready:
             self._run()
         # if self._ready is False, self._run() will be called from
-        # self._busMessageDoneCb().
+        # self._busMessageAsyncDoneCb().
+
+    def stop(self):
+        if self.audioPipeline is None:
+            # Already stopped.
+            return
+        get_governor().unregister(self)
+        self._queue = []
+        self._ready = False
+        self.audioPipeline.get_bus().remove_signal_watch()
+        # Unblocks the worker thread if it waits for a sample.
+        self.audioPipeline.set_state(Gst.State.NULL)
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.audioPipeline = None
 
     def _run(self):
         # Control flows in a cycle:
-        # _run -> _startSegment -> busMessageSegmentDoneCb -> _finishSegment -> _run
+        # _run -> _startSegment -> _extractSegment -> _finishSegmentCb -> _run
         # This forms a loop that extracts an entire segment (i.e. satisfies an
         # extract request) in each cycle. The cycle
         # runs until the queue of Extractees empties.  If the cycle is not
         # running, extract() will kick it off again.
         extractee, start, duration = self._queue[0]
-        self.audioSink.set_extractee(extractee)
         self._startSegment(start, duration)
+        self._thread = threading.Thread(target=self._extractSegment,
+                                        args=(extractee,), name="extract",
+                                        daemon=True)
+        self._thread.start()
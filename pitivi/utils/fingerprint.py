@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Pitivi video editor
+#
+#       pitivi/utils/fingerprint.py
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""
+Persistent index of the media files fingerprints.
+
+The preview caches are keyed by a hash of the beginning of the media files,
+which is expensive to compute for many files on a network filesystem. The
+index remembers the hash of each file, as long as its device, inode, size and
+modification time don't change, so only the new or modified files are read.
+"""
+
+import os
+import sqlite3
+import threading
+
+from pitivi.settings import get_dir, xdg_cache_home
+from pitivi.utils.loggable import Loggable
+from pitivi.utils.misc import hash_file
+
+
+class FingerprintIndex(Loggable):
+
+    """
+    Maps the (device, inode, size, mtime) of the files to their hash.
+
+    The index is stored in an SQLite database shared by the Pitivi processes.
+    """
+
+    def __init__(self, db_path):
+        Loggable.__init__(self)
+        # The hashes known in this process, by file stat key.
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._cur = self._db.cursor()
+        self._cur.execute("CREATE TABLE IF NOT EXISTS Fingerprints "
+                          "(Device INTEGER, Inode INTEGER, Size INTEGER, "
+                          "Mtime INTEGER, Hash TEXT, "
+                          "PRIMARY KEY(Device, Inode))")
+        self._db.commit()
+
+    def hash(self, path):
+        """
+        Get the hash of the specified file, computed with L{hash_file}.
+
+        @param path: The location of the file.
+        """
+        stat = os.stat(path)
+        key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            filehash = self._hashes.get(key)
+            if filehash:
+                return filehash
+            self._cur.execute("SELECT Hash FROM Fingerprints WHERE Device = ? "
+                              "AND Inode = ? AND Size = ? AND Mtime = ?", key)
+            row = self._cur.fetchone()
+            if row:
+                self._hashes[key] = row[0]
+                return row[0]
+
+        self.debug("Hashing %s", path)
+        filehash = hash_file(path)
+        with self._lock:
+            self._hashes[key] = filehash
+            # Replaces the row of a modified file or of a reused inode.
+            self._cur.execute("INSERT OR REPLACE INTO Fingerprints "
+                              "VALUES (?, ?, ?, ?, ?)", key + (filehash,))
+            self._db.commit()
+        return filehash
+
+
+# The indexes by database path.
+_indexes = {}
+
+
+def get_file_hash(path):
+    """
+    Get the hash of the specified file, out of the index of the cache
+    directory shared by all the preview caches when possible.
+    """
+    db_path = os.path.join(get_dir(xdg_cache_home()), "fingerprints.db")
+    if db_path not in _indexes:
+        _indexes[db_path] = FingerprintIndex(db_path)
+    return _indexes[db_path].hash(path)
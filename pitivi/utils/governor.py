@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+# Pitivi video editor
+#
+#       pitivi/utils/governor.py
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""
+Sharing of the machine between the user and the background work.
+
+The thumbnails, waveforms and envelopes are computed in the background while
+the user edits. A single governor decides how many of these jobs can run at
+the moment, out of the load of the whole system, of the responsiveness of
+the main loop and of the activity of the user.
+"""
+
+import multiprocessing
+
+from gi.repository import GLib
+
+from pitivi.utils.loggable import Loggable
+from pitivi.utils.system import SystemCPUUsageTracker
+
+
+# How often the load is evaluated.
+GOVERNOR_INTERVAL_MS = 250
+# Above this system CPU usage, less background jobs are allowed.
+GOVERNOR_MAX_CPU_USAGE = 80
+# When the main loop wakes up later than this, the background jobs make
+# the UI sluggish and most of them are paused.
+GOVERNOR_MAX_LATENCY_MS = 50
+# For how long after the user did something, for example scrolling or
+# playing, at most one background job is allowed.
+GOVERNOR_USER_ACTIVITY_S = 1
+
+
+class BackgroundWorkGovernor(Loggable):
+
+    """
+    Decides how many background jobs can run at the moment.
+
+    The jobs register with L{register} and are paused and resumed by the
+    governor, without being torn down, so a pipeline for example is simply
+    set to PAUSED and back to PLAYING.
+
+    The budget, the number of jobs allowed to run, starts at the number of
+    jobs the pools starting them allow, see L{setPoolSize}. It grows by one
+    when the system is not loaded and decreases by one when it is. It is
+    halved when the main loop is late, and it is one while the user is
+    active. At least one job is always allowed to run, so the background
+    work is never starved.
+    The most recently registered jobs are paused first, so the jobs started
+    earlier finish earlier.
+
+    @ivar budget: The number of jobs allowed to run.
+    """
+
+    def __init__(self, max_jobs=None):
+        """
+        @param max_jobs: The maximum budget while no pool declared its size,
+        by default the number of cores.
+        """
+        Loggable.__init__(self)
+        self._default_max_jobs = max_jobs or multiprocessing.cpu_count()
+        # Maps the pools starting the jobs to the number of jobs they run
+        # concurrently.
+        self._pool_sizes = {}
+        self.max_jobs = self._default_max_jobs
+        self.budget = self.max_jobs
+        self.cpu_usage_tracker = SystemCPUUsageTracker()
+        # The registered jobs, in the order in which they registered.
+        self._jobs = []
+        self._paused = set()
+        self._timeout_id = None
+        self._last_evaluation = None
+        self._last_activity = None
+
+    def setPoolSize(self, pool, size):
+        """
+        Declare how many jobs the specified pool runs concurrently.
+
+        The maximum budget is the total of the pools, so the jobs they start
+        are not paused while the machine is not loaded.
+
+        @param pool: An object identifying the pool.
+        @param size: The number of jobs, 0 when the pool is done.
+        """
+        if size:
+            self._pool_sizes[pool] = size
+        else:
+            self._pool_sizes.pop(pool, None)
+        previous_max_jobs = self.max_jobs
+        self.max_jobs = sum(self._pool_sizes.values()) or \
+            self._default_max_jobs
+        if not self._jobs or self.budget >= previous_max_jobs or \
+                self.budget > self.max_jobs:
+            # Not throttled at the moment.
+            self.budget = self.max_jobs
+            self._apply()
+
+    def register(self, job):
+        """
+        Let the governor pause and resume the specified job.
+
+        @param job: An object having pauseWork and resumeWork methods. It's
+        considered to be running when registered.
+        """
+        if job in self._jobs:
+            return
+        self._jobs.append(job)
+        if self._timeout_id is None:
+            self.cpu_usage_tracker.reset()
+            self._last_evaluation = GLib.get_monotonic_time()
+            self._timeout_id = GLib.timeout_add(GOVERNOR_INTERVAL_MS,
+                                                self._evaluateCb)
+        self._apply()
+
+    def unregister(self, job):
+        """
+        Forget the specified job, for example because it's done.
+        """
+        if job not in self._jobs:
+            return
+        self._jobs.remove(job)
+        self._paused.discard(job)
+        if not self._jobs and self._timeout_id is not None:
+            GLib.source_remove(self._timeout_id)
+            self._timeout_id = None
+        self._apply()
+
+    def userActive(self):
+        """
+        Signal that the user interacts with the UI, which should stay
+        responsive.
+        """
+        self._last_activity = GLib.get_monotonic_time()
+        if self.budget > 1:
+            self.budget = 1
+            self._apply()
+
+    def _userIsActive(self, now):
+        return self._last_activity is not None and \
+            now - self._last_activity < GOVERNOR_USER_ACTIVITY_S * 1000000
+
+    def _evaluateCb(self):
+        now = GLib.get_monotonic_time()
+        latency_ms = (now - self._last_evaluation) / 1000 - \
+            GOVERNOR_INTERVAL_MS
+        self._last_evaluation = now
+        cpu_usage = self.cpu_usage_tracker.usage()
+        self.cpu_usage_tracker.reset()
+
+        if latency_ms > GOVERNOR_MAX_LATENCY_MS:
+            budget = self.budget // 2
+        elif cpu_usage > GOVERNOR_MAX_CPU_USAGE:
+            # The load might be caused by other applications for a long
+            # time, keep going slowly.
+            budget = self.budget - 1
+        else:
+            budget = self.budget + 1
+        if self._userIsActive(now):
+            budget = 1
+        budget = max(1, min(budget, self.max_jobs))
+        if budget != self.budget:
+            self.log("Budget %d, CPU usage %.1f%%, main loop latency %d ms",
+                     budget, cpu_usage, latency_ms)
+            self.budget = budget
+            self._apply()
+        return True
+
+    def _apply(self):
+        for index, job in enumerate(self._jobs):
+            if index < self.budget:
+                if job in self._paused:
+                    self._paused.remove(job)
+                    job.resumeWork()
+            elif job not in self._paused:
+                self._paused.add(job)
+                job.pauseWork()
+
+
+_governor = None
+
+
+def get_governor():
+    """
+    Get the governor shared by all the background jobs of this process.
+    """
+    global _governor
+    if _governor is None:
+        _governor = BackgroundWorkGovernor()
+    return _governor
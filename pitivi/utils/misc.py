@@ -29,7 +29,6 @@ from urllib.parse import urlparse, unquote, urlsplit
 
 from gi.repository import GLib
 from gi.repository import Gst
-from gi.repository import Gtk
 
 from gettext import gettext as _
 
@@ -180,14 +179,8 @@ class PathWalker(Thread):
 
 def hash_file(uri):
     """Hashes the first 256KB of the specified file"""
-    sha256 = hashlib.sha256()
     with open(uri, "rb") as file:
-        for _ in range(1024):
-            chunk = file.read(256)
-            if not chunk:
-                break
-            sha256.update(chunk)
-    return sha256.hexdigest()
+        return hashlib.sha256(file.read(256 * 1024)).hexdigest()
 
 
 def quantize(input, interval):
@@ -221,6 +214,10 @@ def show_user_manual(page=None):
     Display the user manual with Yelp.
     Optional: for contextual help, a page ID can be specified.
     """
+    # Imported here, so the headless preview daemon using the other
+    # helpers doesn't load the UI toolkit.
+    from gi.repository import Gtk
+
     time_now = int(time.time())
     if "APPDIR" in os.environ:
         uris = (APPMANUALURL_ONLINE,)
@@ -241,6 +238,8 @@ def show_user_manual(page=None):
 
 
 def unicode_error_dialog():
+    from gi.repository import Gtk
+
     message = _("The system's locale that you are using is not UTF-8 capable. "
                 "Unicode support is required for Python3 software like Pitivi. "
                 "Please correct your system settings; if you try to use Pitivi "
@@ -0,0 +1,608 @@
+# -*- coding: utf-8 -*-
+# Pitivi video editor
+#
+#       pitivi/utils/previewcaches.py
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""
+Storage and disk budget of the preview caches.
+
+The JPEG thumbnails of all the media files are kept in a single database
+shared by the Pitivi processes. Each media file also has its own preview
+stores in the cache directory: a directory of raw thumbnails, a waveform
+and the amplitude envelopes used by the auto-aligner. The thumbnails in the
+database and the stores are tracked in an index, and the least recently
+used ones are removed when the total size exceeds the budget.
+
+Run "python3 -m pitivi.utils.previewcaches" to enforce the budget and remove
+the stores of the media files which have been deleted, for example on a
+machine where Pitivi is used without a display.
+"""
+
+import fcntl
+import os
+import queue
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from gi.repository import GLib
+
+from pitivi.settings import get_dir, xdg_cache_home
+from pitivi.utils.loggable import Loggable
+from pitivi.utils.misc import path_from_uri
+
+
+# The directories of the cache containing one store per media file.
+# The "thumbs" directory contains the thumbnails databases of the older
+# versions, which are imported in the thumbnails database when used.
+STORES_DIRS = ("envelopes", "thumbs", "thumbs-raw", "waves")
+# The database of the JPEG thumbnails, in the cache directory.
+THUMBNAILS_DB_NAME = "thumbs.db"
+# The number of connections to the thumbnails database.
+POOL_SIZE = 4
+# The writes to the thumbnails database are committed in a single
+# transaction when this many are pending, or after COMMIT_INTERVAL_S.
+COMMIT_BATCH_SIZE = 64
+COMMIT_INTERVAL_S = 5
+# The stores used in the last hour are never evicted, as another Pitivi
+# process might be using them.
+EVICTION_GRACE_S = 60 * 60
+# How often the budget is enforced while Pitivi runs.
+EVICTION_INTERVAL_S = 10 * 60
+
+
+def get_store_size(path):
+    """
+    Get the disk space in bytes used by the specified store.
+    """
+    try:
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+        size = 0
+        for dirpath, unused_dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                size += os.path.getsize(os.path.join(dirpath, filename))
+        return size
+    except OSError:
+        # Removed meanwhile.
+        return 0
+
+
+def connect_db(path):
+    """
+    Open a connection to an SQLite database which can be used by any thread.
+    """
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    # Safe with WAL, the last transactions might be lost on power loss.
+    conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+
+class ConnectionPool(object):
+
+    """
+    A fixed number of connections to an SQLite database, shared by threads.
+    """
+
+    def __init__(self, path, size=POOL_SIZE):
+        self._path = path
+        self._connections = queue.Queue()
+        self._created = 0
+        self._size = size
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection, waiting for one to be returned if they are all
+        in use.
+        """
+        conn = None
+        with self._lock:
+            if self._connections.empty() and self._created < self._size:
+                conn = connect_db(self._path)
+                self._created += 1
+        if conn is None:
+            conn = self._connections.get()
+        try:
+            yield conn
+        finally:
+            self._connections.put(conn)
+
+
+class ThumbnailsDatabase(Loggable):
+
+    """
+    The JPEG thumbnails of all the media files.
+
+    The database is in WAL mode so the processes reading thumbnails don't
+    wait for the one writing them. The writes are executed on a dedicated
+    connection, in a transaction committed once per batch. While writes are
+    pending, the reads are done on that connection, so they see them.
+    """
+
+    def __init__(self, path):
+        Loggable.__init__(self)
+        self.path = path
+        self._pool = ConnectionPool(path)
+        self._writer = connect_db(path)
+        # The number of writes not committed yet.
+        self._pending = 0
+        self._writer_lock = threading.Lock()
+        self._commit_id = None
+        # Has to be set before creating the tables.
+        self._writer.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._writer.execute("PRAGMA journal_mode = WAL")
+        self._writer.execute("CREATE TABLE IF NOT EXISTS Thumbnails\
+                             (Asset TEXT NOT NULL,\
+                             Level INTEGER NOT NULL,\
+                             Time INTEGER NOT NULL,\
+                             Jpeg BLOB NOT NULL,\
+                             Exact INTEGER NOT NULL DEFAULT 1,\
+                             PRIMARY KEY (Asset, Level, Time))")
+        # A new full size thumbnail makes the smaller ones scaled down from
+        # the previous one obsolete.
+        self._writer.execute("CREATE TRIGGER IF NOT EXISTS DropScaledDown\
+                             AFTER INSERT ON Thumbnails WHEN NEW.Level = 0\
+                             BEGIN\
+                             DELETE FROM Thumbnails WHERE Asset = NEW.Asset\
+                             AND Time = NEW.Time AND Level > 0;\
+                             END")
+        self._writer.commit()
+
+    def query(self, sql, params=()):
+        """
+        Get the rows selected by the specified statement, including the
+        pending writes.
+        """
+        with self._writer_lock:
+            if self._pending:
+                return self._writer.execute(sql, params).fetchall()
+        with self._pool.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def write(self, sql, params=()):
+        """
+        Execute a write, committed with the next batch.
+        """
+        with self._writer_lock:
+            self._writer.execute(sql, params)
+            self._pending += 1
+            full = self._pending >= COMMIT_BATCH_SIZE
+            if not full and not self._commit_id:
+                self._commit_id = GLib.timeout_add_seconds(
+                    COMMIT_INTERVAL_S, self._commitCb)
+        if full:
+            self.commit()
+
+    def commit(self):
+        """
+        Commit the pending writes.
+        """
+        with self._writer_lock:
+            if self._commit_id:
+                GLib.source_remove(self._commit_id)
+                self._commit_id = None
+            if not self._pending:
+                return
+            self.log("Committing %d thumbnails writes", self._pending)
+            self._pending = 0
+            self._writer.commit()
+
+    def _commitCb(self):
+        with self._writer_lock:
+            self._commit_id = None
+        self.commit()
+        return False
+
+    def importLegacy(self, asset, path):
+        """
+        Move the thumbnails from the per media file database used by the
+        older versions.
+        """
+        if not os.path.exists(path):
+            return
+        self.debug("Importing the thumbnails of %s", path)
+        # Otherwise the import waits for the transaction of the writer.
+        self.commit()
+        with self._pool.connection() as conn:
+            conn.execute("ATTACH DATABASE ? AS legacy", (path,))
+            try:
+                tables = [row[0] for row in conn.execute(
+                    "SELECT name FROM legacy.sqlite_master WHERE\
+                    type = 'table'")]
+                with conn:
+                    if "Thumbnails" in tables:
+                        # The full size thumbnails first, so the trigger
+                        # keeps the smaller ones.
+                        conn.execute("INSERT OR IGNORE INTO Thumbnails\
+                                     (Asset, Level, Time, Jpeg, Exact)\
+                                     SELECT ?, Level, Time, Jpeg, Exact\
+                                     FROM legacy.Thumbnails\
+                                     ORDER BY Level", (asset,))
+                    if "Thumbs" in tables:
+                        columns = [row[1] for row in conn.execute(
+                            "PRAGMA legacy.table_info(Thumbs)")]
+                        # Created before the approximate thumbnails existed.
+                        exact = "Exact" if "Exact" in columns else "1"
+                        conn.execute("INSERT OR IGNORE INTO Thumbnails\
+                                     (Asset, Level, Time, Jpeg, Exact)\
+                                     SELECT ?, 0, Time, Jpeg, %s\
+                                     FROM legacy.Thumbs" % exact, (asset,))
+            except sqlite3.DatabaseError as e:
+                self.warning("Could not import %s: %s", path, e)
+            finally:
+                conn.execute("DETACH DATABASE legacy")
+        for filename in (path, path + "-journal"):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def assetSizes(self):
+        """
+        Get the number of bytes used by the committed thumbnails of each
+        media file.
+
+        Called by the worker thread of the PreviewCachesManager, so the
+        pending writes are left alone.
+        """
+        with self._pool.connection() as conn:
+            return dict(conn.execute("SELECT Asset, SUM(LENGTH(Jpeg))\
+                                     FROM Thumbnails GROUP BY Asset"))
+
+    def removeAsset(self, asset):
+        """
+        Remove the thumbnails of a media file.
+
+        Called by the worker thread of the PreviewCachesManager. The pending
+        writes are left alone, the deletion waits for their batch to be
+        committed by the main loop.
+        """
+        with self._pool.connection() as conn:
+            with conn:
+                conn.execute("DELETE FROM Thumbnails WHERE Asset = ?",
+                             (asset,))
+            # Give the free pages back to the filesystem.
+            conn.execute("PRAGMA incremental_vacuum")
+
+
+_databases = {}
+
+
+def get_thumbnails_db():
+    """
+    Get the thumbnails database of the cache directory.
+    """
+    path = os.path.join(xdg_cache_home(), THUMBNAILS_DB_NAME)
+    if path not in _databases:
+        _databases[path] = ThumbnailsDatabase(path)
+    return _databases[path]
+
+
+class PreviewCachesManager(Loggable):
+
+    """
+    Tracks the size and the last access of the preview stores.
+
+    @ivar budget: The maximum disk space in bytes of the stores,
+    0 means unlimited.
+    """
+
+    def __init__(self, cache_dir, thumbnails_db=None):
+        """
+        @param thumbnails_db: The thumbnails database, if any.
+        @type thumbnails_db: L{ThumbnailsDatabase}
+        """
+        Loggable.__init__(self)
+        self.budget = 0
+        self._settings = None
+        self._cache_dir = cache_dir
+        self._thumbnails_db = thumbnails_db
+        self._lock_path = os.path.join(cache_dir, "previewcaches.lock")
+        # The stores used by this process, which are never evicted by it.
+        self._used = set()
+        self._enforce_id = None
+        # The (function, done callback) of the scans waiting for the worker.
+        self._pending = []
+        self._worker = None
+        # The index is accessed by the main thread and the worker thread.
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(cache_dir, "previewcaches.db"),
+                                   check_same_thread=False)
+        self._cur = self._db.cursor()
+        self._cur.execute("CREATE TABLE IF NOT EXISTS Stores\
+                          (Path TEXT PRIMARY KEY,\
+                          Uri TEXT,\
+                          Size INTEGER NOT NULL DEFAULT 0,\
+                          LastAccess REAL NOT NULL)")
+        self._db.commit()
+
+    def touch(self, path, uri):
+        """
+        Mark the specified store as just used.
+
+        @param path: The location of the store.
+        @param uri: The URI of the media file previewed by the store.
+        """
+        with self._db_lock:
+            self._used.add(path)
+            self._cur.execute("UPDATE Stores SET Uri = ?, LastAccess = ?\
+                              WHERE Path = ?", (uri, time.time(), path))
+            if not self._cur.rowcount:
+                self._cur.execute("INSERT INTO Stores (Path, Uri, LastAccess)\
+                                  VALUES (?, ?, ?)", (path, uri, time.time()))
+            self._db.commit()
+
+    def setSettings(self, settings):
+        """
+        Follow the previewersCacheBudget setting, in MB.
+        """
+        if self._settings is settings:
+            return
+        if self._settings:
+            self._settings.disconnect_by_func(self._cacheBudgetChangedCb)
+        self._settings = settings
+        settings.connect("previewersCacheBudgetChanged",
+                         self._cacheBudgetChangedCb)
+        self._cacheBudgetChangedCb(settings)
+
+    def _cacheBudgetChangedCb(self, settings):
+        self.setBudget(settings.previewersCacheBudget * 1024 * 1024)
+
+    def setBudget(self, budget):
+        """
+        Set the budget and enforce it when the UI is idle, then periodically.
+        """
+        self.budget = budget
+        if self._enforce_id:
+            GLib.source_remove(self._enforce_id)
+        GLib.idle_add(self._enforceBudgetCb, False, priority=GLib.PRIORITY_LOW)
+        self._enforce_id = GLib.timeout_add_seconds(
+            EVICTION_INTERVAL_S, self._enforceBudgetCb, True)
+
+    def _enforceBudgetCb(self, repeat):
+        self.enforceBudgetInBackground()
+        return repeat
+
+    def enforceBudgetInBackground(self, done_cb=None):
+        """
+        Call L{enforceBudget} on a worker thread, so the UI is not blocked
+        while the stores are scanned.
+
+        @param done_cb: Called in the main loop with the number of bytes
+        freed.
+        """
+        self._runInBackground(self.enforceBudget, done_cb)
+
+    def pruneMissingInBackground(self, done_cb=None):
+        """
+        Call L{pruneMissing} on a worker thread, see
+        L{enforceBudgetInBackground}.
+        """
+        self._runInBackground(self.pruneMissing, done_cb)
+
+    def _runInBackground(self, function, done_cb):
+        self._pending.append((function, done_cb))
+        if not self._worker:
+            self._startWorker()
+
+    def _startWorker(self):
+        function, done_cb = self._pending.pop(0)
+        self._worker = threading.Thread(target=self._work,
+                                        args=(function, done_cb),
+                                        name="previewcaches", daemon=True)
+        self._worker.start()
+
+    def _work(self, function, done_cb):
+        try:
+            freed = function()
+        except (OSError, sqlite3.Error) as e:
+            self.warning("Failed cleaning the preview caches: %s", e)
+            freed = 0
+        GLib.idle_add(self._workDoneCb, freed, done_cb)
+
+    def _workDoneCb(self, freed, done_cb):
+        self._worker.join()
+        self._worker = None
+        if self._pending:
+            self._startWorker()
+        if done_cb:
+            done_cb(freed)
+        return False
+
+    def enforceBudget(self):
+        """
+        Remove the least recently used stores until the budget is met.
+
+        @return: The number of bytes freed.
+        """
+        if not self.budget:
+            return 0
+        freed = 0
+        with self._locked():
+            used = self._usedStores()
+            stores = self._scan()
+            total = sum(size for unused_path, unused_uri, size, unused_access
+                        in stores)
+            self.debug("The preview caches use %d bytes, the budget is %d",
+                       total, self.budget)
+            now = time.time()
+            for path, unused_uri, size, last_access in stores:
+                if total <= self.budget:
+                    break
+                if path in used or now - last_access < EVICTION_GRACE_S:
+                    continue
+                self._evict(path)
+                total -= size
+                freed += size
+        return freed
+
+    def pruneMissing(self):
+        """
+        Remove the stores of the media files which have been deleted.
+
+        A file is considered deleted only when its directory still exists,
+        so the stores of the files on an unmounted disk are kept.
+
+        @return: The number of bytes freed.
+        """
+        freed = 0
+        with self._locked():
+            used = self._usedStores()
+            for path, uri, size, unused_access in self._scan():
+                if not uri or path in used:
+                    continue
+                try:
+                    location = path_from_uri(uri)
+                except AssertionError:
+                    # Not a local file.
+                    continue
+                if os.path.exists(location) or \
+                        not os.path.isdir(os.path.dirname(location)):
+                    continue
+                self.debug("Pruning the previews of deleted %s", location)
+                self._evict(path)
+                freed += size
+        return freed
+
+    def _usedStores(self):
+        with self._db_lock:
+            return set(self._used)
+
+    @contextmanager
+    def _locked(self):
+        """
+        Prevent the other processes from scanning and evicting at the same
+        time as us.
+        """
+        with open(self._lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _scan(self):
+        """
+        Sync the index with the stores on disk.
+
+        The stores created before the index existed are added with their
+        modification time as last access.
+
+        @return: The (path, uri, size, last access) of the stores, the least
+        recently used first.
+        """
+        with self._db_lock:
+            self._cur.execute("SELECT Path FROM Stores")
+            indexed = set(row[0] for row in self._cur.fetchall())
+        on_disk = set()
+        for stores_dir in STORES_DIRS:
+            stores_dir = os.path.join(self._cache_dir, stores_dir)
+            if not os.path.isdir(stores_dir):
+                continue
+            for name in os.listdir(stores_dir):
+                if name.endswith("-journal") or name.endswith(".tmp"):
+                    continue
+                on_disk.add(os.path.join(stores_dir, name))
+
+        sizes = dict((path, get_store_size(path)) for path in on_disk)
+        if self._thumbnails_db:
+            for asset, size in self._thumbnails_db.assetSizes().items():
+                sizes[self.getThumbnailsStore(asset)] = size
+
+        mtimes = {}
+        for path in set(sizes) - indexed:
+            try:
+                mtimes[path] = os.path.getmtime(path)
+            except OSError:
+                # The thumbnails of a media file in the database.
+                mtimes[path] = os.path.getmtime(self._thumbnails_db.path)
+
+        with self._db_lock:
+            for path in indexed - set(sizes):
+                self._cur.execute("DELETE FROM Stores WHERE Path = ?", (path,))
+            for path, mtime in mtimes.items():
+                self._cur.execute("INSERT INTO Stores (Path, LastAccess)\
+                                  VALUES (?, ?)", (path, mtime))
+            for path, size in sizes.items():
+                self._cur.execute("UPDATE Stores SET Size = ? WHERE Path = ?",
+                                  (size, path))
+            self._db.commit()
+
+            self._cur.execute("SELECT Path, Uri, Size, LastAccess FROM Stores\
+                              ORDER BY LastAccess")
+            return self._cur.fetchall()
+
+    def getThumbnailsStore(self, asset):
+        """
+        Get the path identifying the thumbnails of the specified media file
+        in the thumbnails database.
+        """
+        return os.path.join(self._thumbnails_db.path, asset)
+
+    def _evict(self, path):
+        self.debug("Evicting the preview store %s", path)
+        if self._thumbnails_db and \
+                os.path.dirname(path) == self._thumbnails_db.path:
+            self._thumbnails_db.removeAsset(os.path.basename(path))
+        elif os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            for filename in (path, path + "-journal"):
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+        with self._db_lock:
+            self._cur.execute("DELETE FROM Stores WHERE Path = ?", (path,))
+            self._db.commit()
+
+
+# The managers by cache directory.
+_managers = {}
+
+
+def get_preview_caches_manager():
+    """
+    Get the manager of the preview caches of the cache directory.
+    """
+    cache_dir = get_dir(xdg_cache_home())
+    if cache_dir not in _managers:
+        _managers[cache_dir] = PreviewCachesManager(cache_dir,
+                                                    get_thumbnails_db())
+    return _managers[cache_dir]
+
+
+def main(argv):
+    """
+    Remove the previews of the deleted media files and enforce the budget,
+    which can be specified in MB as argument.
+    """
+    manager = get_preview_caches_manager()
+    if len(argv) > 1:
+        manager.budget = int(argv[1]) * 1024 * 1024
+    freed = manager.pruneMissing() + manager.enforceBudget()
+    print("Freed %d MB" % (freed // (1024 * 1024)))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+# Pitivi video editor
+#
+#       pitivi/utils/previewclient.py
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""
+Client side of the preview daemon.
+
+The thumbnails and waveforms of a media file are generated by a single
+daemon process shared by all the running Pitivi instances, so that several
+projects using the same footage don't decode it concurrently. The daemon
+writes the previews in the usual cache files, the clients only get notified
+when a job is done and load the previews from the cache.
+
+The protocol is made of JSON objects separated by newlines. A request looks
+like {"type": "thumbnails", "uri": "file:///..."} and is answered, once the
+previews are in the cache, by the same object with a "status" which is
+either "done" or "error".
+"""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+
+from gi.repository import GLib
+
+from pitivi.settings import xdg_cache_home
+from pitivi.utils.loggable import Loggable
+
+
+# The raw thumbnails are always generated by the process displaying them,
+# as the index of a RawThumbnailFile is only loaded when opened.
+JOB_THUMBNAILS = "thumbnails"
+JOB_WAVEFORM = "waveform"
+JOB_TYPES = (JOB_THUMBNAILS, JOB_WAVEFORM)
+
+STATUS_DONE = "done"
+STATUS_ERROR = "error"
+
+# How often and how many times we try to connect to a daemon being spawned.
+CONNECT_RETRY_INTERVAL_MS = 200
+CONNECT_RETRIES = 25
+
+
+def get_socket_path():
+    return os.path.join(xdg_cache_home(), "previews.socket")
+
+
+def encode_message(message):
+    return (json.dumps(message) + "\n").encode("utf-8")
+
+
+def decode_messages(buf):
+    """
+    Split the complete messages out of the received data.
+
+    @param buf: The data received so far.
+    @type buf: bytes
+    @return: The decoded messages and the rest of the data, which is the
+    beginning of a message not fully received yet.
+    """
+    messages = []
+    while True:
+        line, sep, rest = buf.partition(b"\n")
+        if not sep:
+            return messages, buf
+        buf = rest
+        try:
+            messages.append(json.loads(line.decode("utf-8")))
+        except ValueError:
+            # Skip the garbage.
+            continue
+
+
+class PreviewDaemonClient(Loggable):
+
+    """
+    Connection to the preview daemon, spawned if it's not running yet.
+
+    The callbacks passed to L{request} are called with True when the
+    previews are in the cache, or with False when they have to be generated
+    by the caller, for example because the daemon cannot be started.
+    """
+
+    def __init__(self, socket_path=None):
+        Loggable.__init__(self)
+        self._socket_path = socket_path or get_socket_path()
+        self._socket = None
+        self._watch_id = None
+        self._buffer = b""
+        self._connect_id = None
+        self._retries = 0
+        self._spawned = False
+        # Maps the (type, uri) of the jobs to the callbacks waiting for them.
+        self._callbacks = {}
+        # The requests not sent yet because we are not connected.
+        self._pending = []
+
+    def request(self, job_type, uri, callback):
+        """
+        Ask the daemon to put the previews of the specified type in the cache.
+
+        @param job_type: One of JOB_TYPES.
+        @param uri: The URI of the media file.
+        @param callback: Called with True if the job succeeded.
+        """
+        key = (job_type, uri)
+        callbacks = self._callbacks.setdefault(key, [])
+        callbacks.append(callback)
+        if len(callbacks) > 1:
+            # Already requested.
+            return
+        if self._socket:
+            self._send(key)
+        else:
+            self._pending.append(key)
+            self._connect()
+
+    def cancel(self, job_type, uri, callback):
+        """
+        Forget the specified callback.
+
+        The job keeps running in the daemon, as other clients might want it,
+        and its results end up in the cache anyway.
+        """
+        callbacks = self._callbacks.get((job_type, uri), [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+    def _send(self, key):
+        job_type, uri = key
+        try:
+            self._socket.sendall(encode_message({"type": job_type, "uri": uri}))
+        except OSError as e:
+            self.warning("Lost the connection to the preview daemon: %s", e)
+            self._disconnect()
+
+    def _connect(self):
+        if self._connect_id or self._socket:
+            return
+        if self._tryConnect():
+            return
+        if not self._spawned:
+            self._spawnDaemon()
+        self._retries = 0
+        self._connect_id = GLib.timeout_add(CONNECT_RETRY_INTERVAL_MS,
+                                            self._retryConnectCb)
+
+    def _tryConnect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._socket_path)
+        except OSError:
+            sock.close()
+            return False
+        self.debug("Connected to the preview daemon")
+        self._socket = sock
+        self._buffer = b""
+        self._watch_id = GLib.io_add_watch(
+            sock.fileno(), GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self._socketCb)
+        pending, self._pending = self._pending, []
+        for key in pending:
+            self._send(key)
+        return True
+
+    def _spawnDaemon(self):
+        self.info("Spawning the preview daemon")
+        self._spawned = True
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(path for path in sys.path if path)
+        try:
+            process = subprocess.Popen(
+                [sys.executable, "-m", "pitivi.previewdaemon"],
+                env=env, stdin=subprocess.DEVNULL, start_new_session=True)
+        except OSError as e:
+            self.warning("Could not spawn the preview daemon: %s", e)
+            return
+        # Reap the process when it exits.
+        GLib.child_watch_add(GLib.PRIORITY_DEFAULT, process.pid,
+                             self._daemonExitedCb)
+
+    def _retryConnectCb(self):
+        if self._tryConnect():
+            self._connect_id = None
+            return False
+        self._retries += 1
+        if self._retries < CONNECT_RETRIES:
+            return True
+        self.warning("Could not connect to the preview daemon")
+        self._connect_id = None
+        self._failAll()
+        return False
+
+    def _disconnect(self):
+        if self._watch_id:
+            GLib.source_remove(self._watch_id)
+            self._watch_id = None
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+        # The daemon exited or crashed, spawn it again next time.
+        self._spawned = False
+        self._failAll()
+
+    def _failAll(self):
+        callbacks, self._callbacks = self._callbacks, {}
+        self._pending = []
+        for key_callbacks in callbacks.values():
+            for callback in key_callbacks:
+                callback(False)
+
+    def _socketCb(self, unused_fd, condition):
+        data = b""
+        if condition & GLib.IO_IN:
+            try:
+                data = self._socket.recv(4096)
+            except OSError:
+                data = b""
+        if not data:
+            self.warning("The preview daemon closed the connection")
+            self._watch_id = None
+            self._disconnect()
+            return False
+
+        messages, self._buffer = decode_messages(self._buffer + data)
+        for message in messages:
+            key = (message.get("type"), message.get("uri"))
+            success = message.get("status") == STATUS_DONE
+            for callback in self._callbacks.pop(key, []):
+                callback(success)
+        return True
+
+    def _daemonExitedCb(self, pid, status):
+        self.debug("The preview daemon %d exited with status %d", pid, status)
+
+
+_client = None
+
+
+def get_daemon_client():
+    """
+    Get the connection to the preview daemon shared in this process.
+    """
+    global _client
+    if _client is None:
+        _client = PreviewDaemonClient()
+    return _client
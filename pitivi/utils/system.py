@@ -18,10 +18,7 @@
 # License along with this program; if not, see <http://www.gnu.org/licenses/>.
 
 
-import datetime
-import multiprocessing
 import os
-import resource
 
 from gi.repository import GObject
 
@@ -303,19 +300,39 @@ def getSystem():
     return system
 
 
-class CPUUsageTracker(object):
+class SystemCPUUsageTracker(object):
+
+    """
+    Measures the CPU usage of the whole system, out of /proc/stat.
+
+    Where /proc/stat is not available, the usage is always 0.
+    """
 
     def __init__(self):
         self.reset()
 
     def usage(self):
-        delta_time = (datetime.datetime.now()
-                      - self.last_moment).total_seconds()
-        delta_usage = resource.getrusage(
-            resource.RUSAGE_SELF).ru_utime - self.last_usage.ru_utime
-        usage = float(delta_usage) / delta_time * 100
-        return usage / multiprocessing.cpu_count()
+        """
+        Get the percentage of the CPU time spent working by all the
+        processes since the last reset.
+        """
+        busy, total = self._times()
+        delta_total = total - self.last_total
+        if delta_total <= 0:
+            return 0.
+        return (busy - self.last_busy) / delta_total * 100
 
     def reset(self):
-        self.last_moment = datetime.datetime.now()
-        self.last_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.last_busy, self.last_total = self._times()
+
+    @staticmethod
+    def _times():
+        try:
+            with open("/proc/stat") as stat:
+                fields = stat.readline().split()
+        except OSError:
+            return 0, 0
+        # user nice system idle iowait irq softirq steal...
+        times = [int(field) for field in fields[1:9]]
+        idle = times[3] + times[4]
+        return sum(times) - idle, sum(times)
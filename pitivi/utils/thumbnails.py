@@ -0,0 +1,673 @@
+# -*- coding: utf-8 -*-
+# Pitivi video editor
+#
+#       pitivi/utils/thumbnails.py
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""
+Generation and caching of the thumbnails of the video clips.
+
+Nothing here depends on the UI toolkit, so it's used both by the
+previewers displaying the thumbnails and by the preview daemon.
+"""
+
+from collections import OrderedDict
+import mmap
+import os
+import sqlite3
+import struct
+
+from gi.repository import GLib
+from gi.repository import GdkPixbuf
+from gi.repository import Gst
+
+from pitivi.settings import get_dir, xdg_cache_home
+from pitivi.utils.fingerprint import get_file_hash
+from pitivi.utils.loggable import Loggable
+from pitivi.utils.misc import filename_from_uri
+from pitivi.utils.previewcaches import COMMIT_BATCH_SIZE, \
+    get_preview_caches_manager, get_thumbnails_db
+
+
+# The height of the full size thumbnails, fitting in an expanded track with
+# a margin of 3 pixels, see pitivi.utils.ui.EXPANDED_SIZE.
+THUMB_HEIGHT = 59
+# We should have one thumbnail per THUMB_PERIOD.
+# TODO: get this from the user settings
+THUMB_PERIOD = int(0.5 * Gst.SECOND)
+# The levels of the thumbnails pyramid, as (height divisor, period multiplier)
+# pairs. When zoomed out, the smaller thumbnails of a coarser level are shown,
+# which are cheaper to load and keep in memory.
+THUMB_LEVELS = ((1, 1), (2, 32), (4, 256))
+# The memory in bytes used by the decoded thumbnails of all the clips.
+THUMBNAILS_MEMORY_BUDGET = 64 * 1024 * 1024
+
+
+class PixbufMemoryCache(object):
+
+    """Keeps decoded pixbufs in memory using a LRU policy.
+
+    The pixbufs are dropped, least recently used first, when their total
+    size in bytes exceeds the budget.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._pixbufs = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._pixbufs
+
+    def get(self, key):
+        """Returns the pixbuf for the specified key or None."""
+        pixbuf = self._pixbufs.get(key)
+        if pixbuf is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._pixbufs.move_to_end(key)
+        return pixbuf
+
+    def put(self, key, pixbuf):
+        self.discard(key)
+        self._pixbufs[key] = pixbuf
+        self.size += self._pixbufSize(pixbuf)
+        while self.size > self.budget and len(self._pixbufs) > 1:
+            unused_key, old_pixbuf = self._pixbufs.popitem(last=False)
+            self.size -= self._pixbufSize(old_pixbuf)
+
+    def discard(self, key):
+        pixbuf = self._pixbufs.pop(key, None)
+        if pixbuf is not None:
+            self.size -= self._pixbufSize(pixbuf)
+
+    @staticmethod
+    def _pixbufSize(pixbuf):
+        return pixbuf.get_rowstride() * pixbuf.get_height()
+
+
+# The decoded thumbnails of all the ThumbnailCaches share the same budget.
+thumbnails_memory = PixbufMemoryCache(THUMBNAILS_MEMORY_BUDGET)
+
+caches = {}
+
+
+def get_thumbnails_pipeline_description(uri, height):
+    """
+    Get the description of a pipeline producing thumbnails of the specified
+    height, with a gdkpixbufsink named "gdkpixbufsink".
+    """
+    # TODO: don't hardcode framerate
+    return ("uridecodebin uri={uri} name=decode ! "
+            "videoconvert ! "
+            "videorate ! "
+            "videoscale method=lanczos ! "
+            "capsfilter caps=video/x-raw,format=(string)RGBA,height=(int){height},"
+            "pixel-aspect-ratio=(fraction)1/1,framerate=2/1 ! "
+            "gdkpixbufsink name=gdkpixbufsink".format(uri=uri, height=height))
+
+
+def get_cache_for_uri(uri, raw=False):
+    """
+    Get the thumbnails cache for the specified file.
+
+    @param raw: Whether to use a RawThumbnailCache instead of a
+        ThumbnailCache when the cache does not exist yet.
+    """
+    if uri in caches:
+        return caches[uri]
+    else:
+        if raw:
+            cache = RawThumbnailCache(uri)
+        else:
+            cache = ThumbnailCache(uri)
+        caches[uri] = cache
+        return cache
+
+
+def scale_thumbnail(pixbuf, level):
+    """Scales a level 0 thumbnail down to the specified level."""
+    divisor = THUMB_LEVELS[level][0]
+    return pixbuf.scale_simple(max(1, pixbuf.get_width() // divisor),
+                               max(1, pixbuf.get_height() // divisor),
+                               GdkPixbuf.InterpType.BILINEAR)
+
+
+class ThumbnailCache(Loggable):
+
+    """Caches thumbnails by key using LRU policy.
+
+    Uses a two stage caching mechanism. The decoded thumbnails recently used
+    are held in memory, in the thumbnails_memory PixbufMemoryCache shared by
+    all the ThumbnailCaches. All the thumbnails are cached on disk as JPEG
+    images in the ThumbnailsDatabase shared by all the media files.
+
+    The thumbnails are kept in a pyramid with the levels in THUMB_LEVELS.
+    Only the full size thumbnails of level 0 are generated, the smaller ones
+    are scaled down from them the first time they are requested.
+
+    @ivar hits: The number of thumbnails found in memory.
+    @ivar misses: The number of thumbnails which had to be read from disk.
+    """
+
+    def __init__(self, uri, memory=thumbnails_memory):
+        Loggable.__init__(self)
+        self._filehash = get_file_hash(Gst.uri_get_location(uri))
+        self._filename = filename_from_uri(uri)
+        self._memory = memory
+        self.hits = 0
+        self.misses = 0
+        self._uri = uri
+        self._db = get_thumbnails_db()
+        # The database used by the older versions for this file.
+        self._db.importLegacy(self._filehash, os.path.join(
+            xdg_cache_home(), "thumbs", self._filehash))
+        self._store = get_preview_caches_manager().getThumbnailsStore(
+            self._filehash)
+        get_preview_caches_manager().touch(self._store, uri)
+
+    def _query(self, sql, params=()):
+        return self._db.query(sql, (self._filehash,) + tuple(params))
+
+    def __contains__(self, key):
+        if (self._filehash, 0, key) in self._memory:
+            return True
+        # check if item is present in on disk cache
+        return bool(self._query("SELECT Time FROM Thumbnails WHERE Asset = ? "
+                                "AND Level = 0 AND Time = ?", (key,)))
+
+    def __getitem__(self, key):
+        pixbuf = self._memory.get((self._filehash, 0, key))
+        if pixbuf is not None:
+            self.hits += 1
+            return pixbuf
+
+        self.misses += 1
+        rows = self._query("SELECT Time, Jpeg FROM Thumbnails WHERE "
+                           "Asset = ? AND Level = 0 AND Time = ?", (key,))
+        if not rows:
+            raise KeyError(key)
+        pixbuf = self._decode(rows[0][1])
+        self._memory.put((self._filehash, 0, key), pixbuf)
+        return pixbuf
+
+    def __setitem__(self, key, value):
+        self.put(key, value, True)
+
+    def put(self, key, pixbuf, exact, level=0):
+        """
+        Cache a thumbnail.
+
+        Putting a level 0 thumbnail drops the smaller ones for the same key,
+        in memory and in the database thanks to a trigger, so they are scaled
+        down again from the new one.
+
+        @param exact: Whether the thumbnail is the frame at the key time,
+            or only an approximation, such as the closest keyframe.
+        @param level: The level of the pyramid, see THUMB_LEVELS.
+        """
+        success, jpeg = pixbuf.save_to_bufferv(
+            "jpeg", ["quality", None], ["90"])
+        if not success:
+            self.warning("JPEG compression failed")
+            return
+        blob = sqlite3.Binary(jpeg)
+        if level == 0:
+            for other_level in range(1, len(THUMB_LEVELS)):
+                self._memory.discard((self._filehash, other_level, key))
+        self._db.write("INSERT OR REPLACE INTO Thumbnails "
+                       "(Asset, Level, Time, Jpeg, Exact) VALUES (?,?,?,?,?)",
+                       (self._filehash, level, key, blob, int(exact)))
+        self._memory.put((self._filehash, level, key), pixbuf)
+
+    def approximate(self):
+        """
+        Get the sorted keys of the level 0 thumbnails which are not exact.
+        """
+        rows = self._query("SELECT Time FROM Thumbnails WHERE Asset = ? AND "
+                           "Level = 0 AND Exact = 0 ORDER BY Time")
+        return [row[0] for row in rows]
+
+    def getRange(self, start, end, interval=None, level=0):
+        """
+        Get the cached thumbnails in the specified time window.
+
+        The thumbnails which are not held in memory are read from the db
+        with a single query, plus one for scaling down the missing ones
+        if the level is not 0.
+
+        @param start: The start of the window, inclusive.
+        @param end: The end of the window, exclusive.
+        @param interval: If specified, only the thumbnails for the multiples
+            of this value are returned.
+        @param level: The level of the pyramid, see THUMB_LEVELS.
+        @returns: A dict mapping times to pixbufs.
+        """
+        pixbufs = {}
+        if interval:
+            first = -(-start // interval) * interval
+            missing = []
+            for key in range(first, end, interval):
+                pixbuf = self._memory.get((self._filehash, level, key))
+                if pixbuf is None:
+                    missing.append(key)
+                else:
+                    pixbufs[key] = pixbuf
+            self.hits += len(pixbufs)
+            if not missing:
+                return pixbufs
+            start, end = missing[0], missing[-1] + 1
+            rows = self._query("SELECT Time, Jpeg FROM Thumbnails WHERE "
+                               "Asset = ? AND Level = ? AND Time >= ? AND "
+                               "Time < ? AND Time % ? = 0",
+                               (level, start, end, interval))
+        else:
+            rows = self._query("SELECT Time, Jpeg FROM Thumbnails WHERE "
+                               "Asset = ? AND Level = ? AND Time >= ? AND "
+                               "Time < ?", (level, start, end))
+        self._addRows(pixbufs, level, rows)
+
+        if level != 0:
+            self._scaleDown(pixbufs, start, end, interval, level)
+        return pixbufs
+
+    def _addRows(self, pixbufs, level, rows):
+        for key, jpeg in rows:
+            if key in pixbufs:
+                continue
+            pixbuf = self._memory.get((self._filehash, level, key))
+            if pixbuf is None:
+                self.misses += 1
+                pixbuf = self._decode(jpeg)
+                self._memory.put((self._filehash, level, key), pixbuf)
+            else:
+                self.hits += 1
+            pixbufs[key] = pixbuf
+
+    def _scaleDown(self, pixbufs, start, end, interval, level):
+        """Creates the missing thumbnails of a level out of level 0 ones."""
+        if interval:
+            rows = self._query("SELECT Time, Jpeg, Exact FROM Thumbnails "
+                               "WHERE Asset = ? AND Level = 0 AND "
+                               "Time >= ? AND Time < ? AND Time % ? = 0",
+                               (start, end, interval))
+        else:
+            rows = self._query("SELECT Time, Jpeg, Exact FROM Thumbnails "
+                               "WHERE Asset = ? AND Level = 0 AND "
+                               "Time >= ? AND Time < ?", (start, end))
+        for key, jpeg, exact in rows:
+            if key in pixbufs:
+                continue
+            pixbuf = self._memory.get((self._filehash, 0, key))
+            if pixbuf is None:
+                pixbuf = self._decode(jpeg)
+            pixbuf = scale_thumbnail(pixbuf, level)
+            self.put(key, pixbuf, exact, level)
+            pixbufs[key] = pixbuf
+
+    def missing(self, keys):
+        """
+        Get the keys for which there is no cached thumbnail.
+
+        Since the smaller thumbnails are scaled down from the level 0 ones,
+        only level 0 is checked.
+
+        @param keys: The sorted keys to check.
+        @returns: The list of the keys which are not cached.
+        """
+        keys = [key for key in keys
+                if (self._filehash, 0, key) not in self._memory]
+        if not keys:
+            return keys
+        rows = self._query("SELECT Time FROM Thumbnails WHERE Asset = ? AND "
+                           "Level = 0 AND Time >= ? AND Time <= ?",
+                           (keys[0], keys[-1]))
+        cached = set(row[0] for row in rows)
+        return [key for key in keys if key not in cached]
+
+    def _decode(self, jpeg):
+        loader = GdkPixbuf.PixbufLoader.new()
+        # TODO: what do to if any of the following calls fails?
+        loader.write(jpeg)
+        loader.close()
+        return loader.get_pixbuf()
+
+    def commit(self):
+        """
+        Commit the pending thumbnails now instead of with the next batch.
+        """
+        self.debug('Saving thumbnails to disk for: %s', self._filename)
+        self._db.commit()
+        get_preview_caches_manager().touch(self._store, self._uri)
+
+
+class RawThumbnailFile(object):
+
+    """The raw thumbnails of a level of the pyramid of a file.
+
+    The RGBA pixels of the thumbnails are stored in a memory-mapped file,
+    in fixed size slots. An index file maps the times to the slots. Each
+    index record is appended when written and the last record of a time
+    wins, a slot of -1 meaning the thumbnail has been removed. The index is
+    compacted when opened, if most of its records are obsolete.
+
+    The index is only read when the file is opened and the free slots are
+    allocated by the process, so the files must be written by a single
+    process: the one displaying the thumbnails, never the preview daemon.
+    """
+
+    HEADER = struct.Struct("<4sII")
+    RECORD = struct.Struct("<qii")
+    MAGIC = b"PTRT"
+    # The data file is grown by this number of slots at a time.
+    GROWTH = 64
+    # The index is rewritten when it has more than this many records for
+    # each thumbnail.
+    MAX_RECORDS_PER_SLOT = 2
+
+    def __init__(self, path):
+        self._data_path = path + ".raw"
+        self._index_path = path + ".idx"
+        self.width = None
+        self.height = None
+        # Maps times to (slot, exact) pairs.
+        self.slots = {}
+        self._free_slots = []
+        self._num_slots = 0
+        self._mmap = None
+        self._data = None
+        self._index = None
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self._index_path):
+            return
+        with open(self._index_path, "rb") as index:
+            header = index.read(self.HEADER.size)
+            if len(header) < self.HEADER.size:
+                return
+            magic, self.width, self.height = self.HEADER.unpack(header)
+            if magic != self.MAGIC:
+                self.width = self.height = None
+                return
+            num_records = 0
+            while True:
+                record = index.read(self.RECORD.size)
+                if len(record) < self.RECORD.size:
+                    break
+                num_records += 1
+                time, slot, exact = self.RECORD.unpack(record)
+                if slot < 0:
+                    self.slots.pop(time, None)
+                else:
+                    self.slots[time] = (slot, bool(exact))
+                    self._num_slots = max(self._num_slots, slot + 1)
+        used = set(slot for slot, unused_exact in self.slots.values())
+        self._free_slots = [slot for slot in range(self._num_slots)
+                            if slot not in used]
+        if num_records > self.MAX_RECORDS_PER_SLOT * max(len(self.slots), 1):
+            self._compact()
+        self._open()
+
+    def _compact(self):
+        """
+        Rewrite the index with a single record for each thumbnail.
+        """
+        tmp_path = "%s.%d.tmp" % (self._index_path, os.getpid())
+        with open(tmp_path, "wb") as index:
+            index.write(self.HEADER.pack(self.MAGIC, self.width, self.height))
+            for time, (slot, exact) in sorted(self.slots.items()):
+                index.write(self.RECORD.pack(time, slot, int(exact)))
+        os.replace(tmp_path, self._index_path)
+
+    def _open(self):
+        self._data = open(self._data_path, "a+b")
+        self._index = open(self._index_path, "ab")
+        self._map()
+
+    def _map(self):
+        if self._mmap:
+            self._mmap.close()
+            self._mmap = None
+        size = os.fstat(self._data.fileno()).st_size
+        if size:
+            self._mmap = mmap.mmap(self._data.fileno(), size)
+
+    def _reset(self, width, height):
+        self.close()
+        for path in (self._data_path, self._index_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.width = width
+        self.height = height
+        self.slots = {}
+        self._free_slots = []
+        self._num_slots = 0
+        self._open()
+        self._index.write(self.HEADER.pack(self.MAGIC, width, height))
+
+    @property
+    def _stride(self):
+        return self.width * 4
+
+    @property
+    def _slot_size(self):
+        return self._stride * self.height
+
+    def get(self, time):
+        """Returns the pixbuf for the specified time or None."""
+        if time not in self.slots:
+            return None
+        slot, unused_exact = self.slots[time]
+        offset = slot * self._slot_size
+        if not self._mmap or offset + self._slot_size > len(self._mmap):
+            # The data file has been truncated.
+            return None
+        # A slice of the mapped file, no JPEG decoding involved. The slot
+        # can be reused for another thumbnail, so it's copied once and the
+        # GBytes takes ownership of the copy.
+        pixels = GLib.Bytes.new_take(
+            self._mmap[offset:offset + self._slot_size])
+        return GdkPixbuf.Pixbuf.new_from_bytes(
+            pixels, GdkPixbuf.Colorspace.RGB, True, 8,
+            self.width, self.height, self._stride)
+
+    def put(self, time, pixbuf, exact):
+        if not pixbuf.get_has_alpha():
+            pixbuf = pixbuf.add_alpha(False, 0, 0, 0)
+        width = pixbuf.get_width()
+        height = pixbuf.get_height()
+        if (width, height) != (self.width, self.height):
+            # The thumbnails have a different size, start over.
+            self._reset(width, height)
+
+        if time in self.slots:
+            slot, unused_exact = self.slots[time]
+        elif self._free_slots:
+            slot = self._free_slots.pop()
+        else:
+            slot = self._num_slots
+            self._num_slots += 1
+            if self._num_slots * self._slot_size > len(self._mmap or b""):
+                self._data.truncate(
+                    (self._num_slots + self.GROWTH) * self._slot_size)
+                self._map()
+
+        offset = slot * self._slot_size
+        row_stride = pixbuf.get_rowstride()
+        pixels = pixbuf.get_pixels()
+        if row_stride == self._stride:
+            self._mmap[offset:offset + self._slot_size] = \
+                pixels[:self._slot_size]
+        else:
+            for row in range(height):
+                start = row * row_stride
+                self._mmap[offset:offset + self._stride] = \
+                    pixels[start:start + self._stride]
+                offset += self._stride
+        self.slots[time] = (slot, exact)
+        self._index.write(self.RECORD.pack(time, slot, int(exact)))
+
+    def remove(self, time):
+        if time not in self.slots:
+            return
+        slot, unused_exact = self.slots.pop(time)
+        self._free_slots.append(slot)
+        self._index.write(self.RECORD.pack(time, -1, 0))
+
+    def flush(self):
+        if self._mmap:
+            self._mmap.flush()
+        if self._index:
+            self._index.flush()
+
+    def close(self):
+        if self._mmap:
+            self._mmap.close()
+            self._mmap = None
+        for file in (self._data, self._index):
+            if file:
+                file.close()
+        self._data = None
+        self._index = None
+
+
+class RawThumbnailCache(Loggable):
+
+    """Caches thumbnails as raw pixels in memory-mapped files.
+
+    An alternative to ThumbnailCache with the same interface, which avoids
+    the JPEG compression and decompression at the cost of more disk space.
+    Each level of the pyramid is kept in a RawThumbnailFile.
+
+    @ivar hits: The number of thumbnails found in memory.
+    @ivar misses: The number of thumbnails which had to be read from disk.
+    """
+
+    def __init__(self, uri, memory=thumbnails_memory):
+        Loggable.__init__(self)
+        self._filehash = get_file_hash(Gst.uri_get_location(uri))
+        self._filename = filename_from_uri(uri)
+        self._memory = memory
+        self.hits = 0
+        self.misses = 0
+        self._uri = uri
+        self._cache_dir = get_dir(os.path.join(xdg_cache_home(), "thumbs-raw",
+                                               self._filehash))
+        get_preview_caches_manager().touch(self._cache_dir, uri)
+        self._unflushed = 0
+        self._levels = [
+            RawThumbnailFile(os.path.join(self._cache_dir, str(level)))
+            for level in range(len(THUMB_LEVELS))]
+
+    def __contains__(self, key):
+        return key in self._levels[0].slots
+
+    def __getitem__(self, key):
+        pixbuf = self._get(key, 0)
+        if pixbuf is None:
+            raise KeyError(key)
+        return pixbuf
+
+    def __setitem__(self, key, value):
+        self.put(key, value, True)
+
+    def _get(self, key, level):
+        pixbuf = self._memory.get((self._filehash, level, key))
+        if pixbuf is not None:
+            self.hits += 1
+            return pixbuf
+        pixbuf = self._levels[level].get(key)
+        if pixbuf is not None:
+            self.misses += 1
+            self._memory.put((self._filehash, level, key), pixbuf)
+        return pixbuf
+
+    def put(self, key, pixbuf, exact, level=0):
+        """
+        Cache a thumbnail.
+
+        @param exact: Whether the thumbnail is the frame at the key time,
+            or only an approximation, such as the closest keyframe.
+        @param level: The level of the pyramid, see THUMB_LEVELS.
+        """
+        if level == 0:
+            for other_level in range(1, len(THUMB_LEVELS)):
+                self._levels[other_level].remove(key)
+                self._memory.discard((self._filehash, other_level, key))
+        self._levels[level].put(key, pixbuf, exact)
+        self._memory.put((self._filehash, level, key), pixbuf)
+        # Flush in batches, like the ThumbnailsDatabase commits.
+        self._unflushed += 1
+        if self._unflushed >= COMMIT_BATCH_SIZE:
+            self.commit()
+
+    def approximate(self):
+        """
+        Get the sorted keys of the level 0 thumbnails which are not exact.
+        """
+        return sorted(key for key, (unused_slot, exact)
+                      in self._levels[0].slots.items() if not exact)
+
+    def getRange(self, start, end, interval=None, level=0):
+        """
+        Get the cached thumbnails in the specified time window.
+
+        @param start: The start of the window, inclusive.
+        @param end: The end of the window, exclusive.
+        @param interval: If specified, only the thumbnails for the multiples
+            of this value are returned.
+        @param level: The level of the pyramid, see THUMB_LEVELS.
+        @returns: A dict mapping times to pixbufs.
+        """
+        if interval:
+            first = -(-start // interval) * interval
+            keys = range(first, end, interval)
+        else:
+            keys = sorted(key for key in self._levels[0].slots
+                          if start <= key < end)
+        pixbufs = {}
+        for key in keys:
+            pixbuf = self._get(key, level)
+            if pixbuf is None and level != 0:
+                pixbuf = self._get(key, 0)
+                if pixbuf is not None:
+                    unused_slot, exact = self._levels[0].slots[key]
+                    pixbuf = scale_thumbnail(pixbuf, level)
+                    self.put(key, pixbuf, exact, level)
+            if pixbuf is not None:
+                pixbufs[key] = pixbuf
+        return pixbufs
+
+    def missing(self, keys):
+        """
+        Get the keys for which there is no cached thumbnail.
+
+        @param keys: The sorted keys to check.
+        @returns: The list of the keys which are not cached.
+        """
+        return [key for key in keys if key not in self._levels[0].slots]
+
+    def commit(self):
+        self.debug('Saving raw thumbnails to disk for: %s', self._filename)
+        self._unflushed = 0
+        for level in self._levels:
+            level.flush()
+        get_preview_caches_manager().touch(self._cache_dir, self._uri)
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+# Pitivi video editor
+#
+#       pitivi/utils/waveforms.py
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""
+Extraction and storage of the waveforms of the audio clips.
+
+Nothing here depends on the UI toolkit, so it's used both by the
+previewers drawing the waveforms and by the preview daemon.
+"""
+
+from fractions import Fraction
+import numpy
+import os
+import pickle
+import shutil
+import threading
+
+from gi.repository import GLib
+from gi.repository import Gst
+
+from pitivi.settings import get_dir, xdg_cache_home
+from pitivi.utils.extract import APPSINK_MAX_BUFFERS
+from pitivi.utils.fingerprint import get_file_hash
+from pitivi.utils.governor import get_governor
+from pitivi.utils.loggable import Loggable
+from pitivi.utils.misc import filename_from_uri
+
+
+# The duration of a waveform block.
+WAVEFORM_BLOCK_DURATION = 10000000
+# Each level of the waveforms merges this many blocks of the previous level.
+WAVEFORM_DECIMATION = 8
+# The coarsest level of a waveform has at most this many blocks.
+WAVEFORM_MIN_LEVEL_BLOCKS = 512
+# The columns of the waveform blocks. WAVEFORM_CLIPPED is 1 when the
+# block has samples at WAVEFORM_CLIPPING_LEVEL or above, 0 otherwise.
+WAVEFORM_MIN, WAVEFORM_MAX, WAVEFORM_RMS, WAVEFORM_CLIPPED = range(4)
+WAVEFORM_COLUMNS = 4
+# The level in percents of the full scale above which a sample is clipped.
+WAVEFORM_CLIPPING_LEVEL = 99.9
+
+
+def get_wavefile_location_for_uri(uri):
+    """
+    Get the directory containing the waveform levels of the specified file.
+    """
+    filehash = get_file_hash(Gst.uri_get_location(uri))
+    cache_dir = get_dir(os.path.join(xdg_cache_home(), "waves"))
+    return os.path.join(cache_dir, filehash)
+
+
+def decimate_waveform(blocks):
+    """
+    Merge each WAVEFORM_DECIMATION consecutive waveform blocks.
+    """
+    starts = numpy.arange(0, len(blocks), WAVEFORM_DECIMATION)
+    counts = numpy.diff(numpy.append(starts, len(blocks)))
+    decimated = numpy.empty((len(starts),) + blocks.shape[1:], numpy.float32)
+    decimated[..., WAVEFORM_MIN] = numpy.minimum.reduceat(
+        blocks[..., WAVEFORM_MIN], starts)
+    decimated[..., WAVEFORM_MAX] = numpy.maximum.reduceat(
+        blocks[..., WAVEFORM_MAX], starts)
+    squares = blocks[..., WAVEFORM_RMS].astype(numpy.float64) ** 2
+    decimated[..., WAVEFORM_RMS] = numpy.sqrt(
+        numpy.add.reduceat(squares, starts) / counts[:, numpy.newaxis])
+    decimated[..., WAVEFORM_CLIPPED] = numpy.maximum.reduceat(
+        blocks[..., WAVEFORM_CLIPPED], starts)
+    return decimated
+
+
+def mix_waveform(blocks):
+    """
+    Mix down the channels of the specified waveform blocks.
+
+    @return: An array with a single channel.
+    """
+    mixed = numpy.empty((len(blocks), 1, blocks.shape[2]), numpy.float32)
+    mixed[:, 0, WAVEFORM_MIN] = blocks[..., WAVEFORM_MIN].min(axis=1)
+    mixed[:, 0, WAVEFORM_MAX] = blocks[..., WAVEFORM_MAX].max(axis=1)
+    mixed[:, 0, WAVEFORM_RMS] = blocks[..., WAVEFORM_RMS].mean(axis=1)
+    mixed[:, 0, WAVEFORM_CLIPPED:] = blocks[:, :, WAVEFORM_CLIPPED:].max(axis=1)
+    return mixed
+
+
+def save_waveform(path, blocks):
+    """
+    Save the levels of a waveform in the specified directory.
+
+    The directory is created atomically, as a client of the preview daemon
+    can load the waveform at any time.
+
+    @param blocks: The level 0 blocks, see WaveformBuilder.getBlocks.
+    """
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    level = 0
+    while True:
+        numpy.save(os.path.join(tmp_path, "%d.npy" % level), blocks)
+        if len(blocks) <= WAVEFORM_MIN_LEVEL_BLOCKS:
+            break
+        blocks = decimate_waveform(blocks)
+        level += 1
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Saved meanwhile by another process.
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def import_legacy_wavefile(path):
+    """
+    Convert the pickled waveform saved by the older versions, if any.
+    """
+    legacy_path = path + ".wave"
+    if not os.path.exists(legacy_path):
+        return
+    with open(legacy_path, "rb") as wavefile:
+        samples = numpy.array(pickle.load(wavefile), numpy.float32)
+    if len(samples):
+        blocks = numpy.zeros((len(samples), 1, WAVEFORM_COLUMNS),
+                             numpy.float32)
+        blocks[:, 0, WAVEFORM_MIN] = -samples
+        blocks[:, 0, WAVEFORM_MAX] = samples
+        blocks[:, 0, WAVEFORM_RMS] = samples
+        save_waveform(path, blocks)
+    os.remove(legacy_path)
+
+
+class WaveformBuilder(object):
+
+    """
+    Reduces the decoded samples of an audio stream to waveform blocks.
+
+    Each block covers WAVEFORM_BLOCK_DURATION and holds, for each channel,
+    the min and max amplitudes and the RMS value, in percents of the full
+    scale, and whether the channel clipped.
+
+    @ivar channels: The number of channels of the samples.
+    """
+
+    def __init__(self, rate, channels):
+        self.channels = channels
+        # The number of frames per block, as an exact fraction because a
+        # block does not necessarily last a whole number of frames.
+        self._frames_per_block = Fraction(rate * WAVEFORM_BLOCK_DURATION,
+                                          Gst.SECOND)
+        # The samples received but not making a full block yet.
+        self._pending = numpy.empty((0, channels), numpy.float32)
+        self._num_blocks = 0
+        # The computed blocks, as arrays of shape (blocks, channels,
+        # WAVEFORM_COLUMNS).
+        self._chunks = []
+
+    def _blockStart(self, block):
+        return int(block * self._frames_per_block)
+
+    def addSamples(self, samples):
+        """
+        Reduce the specified samples, following the ones added previously.
+
+        @param samples: The interleaved samples, as an array of shape
+        (frames, channels). The array is not referenced after the call, so
+        it can be a view of a buffer being unmapped.
+        """
+        if len(self._pending):
+            samples = numpy.concatenate((self._pending, samples))
+        offset = self._blockStart(self._num_blocks)
+        # The first block which is not complete.
+        last = (len(samples) + offset + 1) * self._frames_per_block.denominator
+        last = -(-last // self._frames_per_block.numerator) - 1
+        if last > self._num_blocks:
+            bounds = [self._blockStart(block) - offset
+                      for block in range(self._num_blocks, last + 1)]
+            self._reduce(samples[:bounds[-1]], numpy.array(bounds))
+            self._num_blocks = last
+            samples = samples[bounds[-1]:]
+        self._pending = samples.copy()
+
+    def _reduce(self, samples, bounds):
+        starts = bounds[:-1]
+        counts = numpy.diff(bounds)[:, numpy.newaxis]
+        squares = numpy.square(samples, dtype=numpy.float64)
+        blocks = numpy.empty((len(starts), self.channels, WAVEFORM_COLUMNS),
+                             numpy.float32)
+        blocks[..., WAVEFORM_MIN] = numpy.minimum.reduceat(samples, starts)
+        blocks[..., WAVEFORM_MAX] = numpy.maximum.reduceat(samples, starts)
+        blocks[..., WAVEFORM_RMS] = numpy.sqrt(
+            numpy.add.reduceat(squares, starts) / counts)
+        blocks[..., :WAVEFORM_CLIPPED] *= 100
+        # Computed here, as the peaks of the blocks are enough to know
+        # whether any sample clipped.
+        blocks[..., WAVEFORM_CLIPPED] = numpy.logical_or(
+            blocks[..., WAVEFORM_MAX] >= WAVEFORM_CLIPPING_LEVEL,
+            blocks[..., WAVEFORM_MIN] <= -WAVEFORM_CLIPPING_LEVEL)
+        self._chunks.append(blocks)
+
+    def finish(self):
+        """
+        Reduce the samples of the last block, which is not complete.
+        """
+        if len(self._pending):
+            self._reduce(self._pending, numpy.array([0, len(self._pending)]))
+            self._num_blocks += 1
+            self._pending = self._pending[:0]
+
+    def getBlocks(self):
+        """
+        @return: The blocks as an array of shape (blocks, channels,
+        WAVEFORM_COLUMNS), or None if no sample has been added.
+        """
+        self.finish()
+        if not self._chunks:
+            return None
+        return numpy.concatenate(self._chunks)
+
+    def save(self, path):
+        """
+        Save the waveform in the specified directory.
+
+        @return: Whether there was something to save.
+        """
+        blocks = self.getBlocks()
+        if blocks is None:
+            return False
+        save_waveform(path, blocks)
+        return True
+
+
+class WaveformExtractor(Loggable):
+
+    """
+    Decodes the audio stream of a media file and saves its waveform.
+
+    The decoded buffers are pulled out of an appsink and reduced on a worker
+    thread, so the decoding is not slowed down by the main loop and goes as
+    fast as possible.
+    """
+
+    def __init__(self, uri, wavefile, done_cb):
+        """
+        @param wavefile: Where to save the waveform.
+        @param done_cb: Called in the main loop with whether the waveform
+        has been saved.
+        """
+        Loggable.__init__(self)
+        self.uri = uri
+        self.pipeline = None
+        self._wavefile = wavefile
+        self._done_cb = done_cb
+        self._thread = None
+        self._failed = False
+
+    def start(self):
+        self.pipeline = Gst.parse_launch(
+            "uridecodebin name=decode uri=" + self.uri + " ! audioconvert ! "
+            "capsfilter caps=audio/x-raw,format=F32LE,layout=interleaved ! "
+            "appsink name=sink sync=false max-buffers=%d drop=false" %
+            APPSINK_MAX_BUFFERS)
+        decode = self.pipeline.get_by_name("decode")
+        decode.connect("autoplug-select", self._autoplugSelectCb)
+        bus = self.pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message", self._busMessageCb)
+        self.pipeline.set_state(Gst.State.PLAYING)
+        self._thread = threading.Thread(
+            target=self._extract, args=(self.pipeline.get_by_name("sink"),),
+            name="waveform", daemon=True)
+        self._thread.start()
+        get_governor().register(self)
+
+    def pauseWork(self):
+        # The worker thread simply waits for the next sample.
+        if not self._failed:
+            self.pipeline.set_state(Gst.State.PAUSED)
+
+    def resumeWork(self):
+        if not self._failed:
+            self.pipeline.set_state(Gst.State.PLAYING)
+
+    def stop(self):
+        """
+        Abort the extraction, the done callback is not called anymore.
+        """
+        self._done_cb = None
+        self._teardown()
+
+    def _teardown(self):
+        get_governor().unregister(self)
+        if self.pipeline:
+            self.pipeline.get_bus().remove_signal_watch()
+            # Unblocks the worker thread if it waits for a sample.
+            self.pipeline.set_state(Gst.State.NULL)
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.pipeline = None
+
+    def _extract(self, sink):
+        builder = None
+        while True:
+            sample = sink.emit("pull-sample")
+            if sample is None:
+                # EOS, or the pipeline has been stopped.
+                break
+            if builder is None:
+                struct = sample.get_caps().get_structure(0)
+                builder = WaveformBuilder(struct.get_value("rate"),
+                                          struct.get_value("channels"))
+            buf = sample.get_buffer()
+            mapped, info = buf.map(Gst.MapFlags.READ)
+            if not mapped:
+                continue
+            try:
+                samples = numpy.frombuffer(info.data, "<f4")
+                builder.addSamples(samples.reshape(-1, builder.channels))
+            finally:
+                buf.unmap(info)
+
+        success = builder is not None and sink.props.eos and \
+            not self._failed and builder.save(self._wavefile)
+        GLib.idle_add(self._extractedCb, success)
+
+    def _extractedCb(self, success):
+        self._teardown()
+        if self._done_cb:
+            self._done_cb(success)
+        return False
+
+    def _busMessageCb(self, unused_bus, message):
+        if message.type == Gst.MessageType.ERROR:
+            self.warning('Failed extracting the waveform of "%s": %s',
+                         filename_from_uri(self.uri), message.parse_error())
+            self._failed = True
+            # Unblocks the worker thread.
+            self.pipeline.set_state(Gst.State.NULL)
+
+    def _autoplugSelectCb(self, unused_decode, unused_pad, unused_caps, factory):
+        # Don't plug video decoders / parsers.
+        if "Video" in factory.get_klass():
+            return True
+        return False
+
+
+class Waveform(object):
+
+    """
+    The levels of a saved waveform, memory-mapped.
+
+    Level 0 has a block per WAVEFORM_BLOCK_DURATION and each next level
+    merges WAVEFORM_DECIMATION blocks of the previous one. Only the pages of
+    the blocks drawn are read from the disk, so long files open instantly.
+    """
+
+    def __init__(self, path):
+        self.levels = []
+        while True:
+            level_path = os.path.join(path, "%d.npy" % len(self.levels))
+            if not os.path.exists(level_path):
+                break
+            level = numpy.load(level_path, mmap_mode="r")
+            if level.ndim == 2:
+                # Saved mixed down, without the clipping, by an older
+                # version.
+                level = level[:, numpy.newaxis, :]
+            self.levels.append(level)
+
+    def __len__(self):
+        """The number of level 0 blocks."""
+        if not self.levels:
+            return 0
+        return len(self.levels[0])
+
+    @property
+    def channels(self):
+        if not self.levels:
+            return 0
+        return self.levels[0].shape[1]
+
+    def getBlocks(self, start, end, width):
+        """
+        Get the blocks covering the specified level 0 blocks, out of the
+        coarsest level which still has a block for each pixel.
+
+        @param start: The first level 0 block, inclusive.
+        @param end: The last level 0 block, exclusive.
+        @param width: The number of pixels on which the blocks are drawn.
+        @return: The blocks, as an array of shape (blocks, channels,
+        columns).
+        """
+        level = 0
+        factor = 1
+        while level + 1 < len(self.levels) and \
+                (end - start) // (factor * WAVEFORM_DECIMATION) >= width:
+            level += 1
+            factor *= WAVEFORM_DECIMATION
+        return self.levels[level][start // factor:-(-end // factor)]
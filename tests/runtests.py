@@ -2,8 +2,11 @@
 
 """Pitivi tests runner."""
 
+import atexit
 import os
+import shutil
 import sys
+import tempfile
 import unittest
 
 
@@ -50,6 +53,11 @@ def setup():
     pitivi_dir = get_pitivi_dir()
     os.environ.setdefault('PITIVI_TOP_LEVEL_DIR', pitivi_dir)
 
+    # Keep the previews generated by the tests out of the user's cache.
+    cache_dir = tempfile.mkdtemp(prefix="pitivi-tests-cache-")
+    os.environ['PITIVI_USER_CACHE_DIR'] = cache_dir
+    atexit.register(shutil.rmtree, cache_dir, True)
+
     # Make available the compiled C code.
     build_dir = get_build_dir()
     libs_dir = os.path.join(build_dir, "pitivi/coptimizations/.libs")
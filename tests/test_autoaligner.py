@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# Pitivi video editor
+#
+#       tests/test_autoaligner.py
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+import mock
+import numpy
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from gi.repository import Gst
+
+from pitivi.autoaligner import AutoAligner, EnvelopeExtractee, \
+    affinealign, fftsize, \
+    load_envelope, pyramidalign, rigidalign, save_envelope, \
+    slice_envelope, PYRAMID_MAX_BLOCKS
+
+
+class TestRigidAlign(TestCase):
+
+    def testFFTSize(self):
+        self.assertEqual(fftsize(1), 1)
+        self.assertEqual(fftsize(100), 100)
+        self.assertEqual(fftsize(1025), 1080)
+        self.assertEqual(fftsize(4097), 4320)
+
+    def testRigidAlign(self):
+        signal = numpy.random.RandomState(0).rand(5000)
+        reference = signal[1000:4000]
+        shifts = [50, -300, 0, 700]
+        targets = [signal[1000 + shift:3000 + shift] for shift in shifts]
+        for shift, expected in zip(rigidalign(reference, targets), shifts):
+            self.assertAlmostEqual(shift, expected, places=2)
+
+    def testPyramidAlign(self):
+        random = numpy.random.RandomState(0)
+        length = PYRAMID_MAX_BLOCKS * 20
+        signal = random.rand(length * 2)
+        reference = signal[length // 2:length // 2 + length]
+        shifts = [1234, -5678, 0, 7]
+        targets = [signal[length // 2 + shift:length + shift] +
+                   0.1 * random.rand(length // 2) for shift in shifts]
+        for shift, expected in zip(pyramidalign(reference, targets), shifts):
+            self.assertAlmostEqual(shift, expected, delta=0.1)
+
+        # Short envelopes are aligned directly.
+        targets = [signal[1000 + shift:3000 + shift] for shift in shifts[2:]]
+        for shift, expected in zip(pyramidalign(signal[1000:4000], targets),
+                                   shifts[2:]):
+            self.assertAlmostEqual(shift, expected, places=2)
+
+
+class TestAffineAlign(TestCase):
+
+    def testAffineAlign(self):
+        random = numpy.random.RandomState(0)
+        reference = random.rand(50000) ** 4
+        expected = [(1000.5, 0.002), (-300, -0.0005), (2000, 0)]
+        targets = []
+        for offset, drift in expected:
+            positions = offset + (1 + drift) * numpy.arange(20000)
+            targets.append(numpy.interp(
+                positions, numpy.arange(len(reference)), reference,
+                left=0, right=0) + 0.1 * random.rand(20000))
+        offsets, drifts = affinealign(reference, targets)
+        for (offset, drift), estimated in zip(expected, zip(offsets, drifts)):
+            self.assertAlmostEqual(estimated[0], offset, delta=0.5)
+            self.assertAlmostEqual(estimated[1], drift, delta=0.0001)
+
+    def testMaxWindow(self):
+        random = numpy.random.RandomState(0)
+        reference = random.rand(100000) ** 4
+        # The default max_drift allows for 1200 samples, more than the
+        # maximum window.
+        positions = 500 + 1.001 * numpy.arange(60000)
+        target = numpy.interp(positions, numpy.arange(len(reference)),
+                              reference, left=0, right=0)
+        offsets, drifts = affinealign(reference, [target], max_window=100)
+        self.assertAlmostEqual(offsets[0], 500, delta=0.5)
+        self.assertAlmostEqual(drifts[0], 0.001, delta=0.0001)
+
+    def testShortTarget(self):
+        reference = numpy.random.RandomState(0).rand(3000)
+        offsets, drifts = affinealign(reference, [reference[100:400]],
+                                      shifts=[100])
+        self.assertEqual(offsets, [100])
+        self.assertEqual(drifts, [0])
+
+
+class TestEnvelopeExtractee(TestCase):
+
+    def testEnvelope(self):
+        samples = numpy.random.RandomState(0).randn(10000).astype(
+            numpy.float32)
+        envelopes = []
+        extractee = EnvelopeExtractee(
+            100, lambda envelope, tag: envelopes.append((envelope, tag)),
+            "tag")
+        progress = []
+        extractee.addWatcher(progress.append)
+        # Chunks smaller and larger than a block, some completing a block.
+        start = 0
+        for size in [30, 70, 250, 1, 49, 3000, 7, 93, 6000]:
+            extractee.receive(samples[start:start + size])
+            start += size
+        self.assertEqual(start, 9500)
+        self.assertEqual(progress, [])
+        extractee.finalize()
+
+        self.assertEqual(len(envelopes), 1)
+        envelope, tag = envelopes[0]
+        self.assertEqual(tag, "tag")
+        expected = numpy.abs(samples[:9500]).reshape((95, 100)).sum(axis=1)
+        numpy.testing.assert_allclose(envelope, expected, rtol=1e-5)
+
+    def testProgress(self):
+        extractee = EnvelopeExtractee(1, lambda envelope: None)
+        progress = []
+        extractee.addWatcher(progress.append)
+        samples = numpy.ones(1500, dtype=numpy.float32)
+        for unused in range(4):
+            extractee.receive(samples)
+        self.assertEqual(progress, [3000, 6000])
+
+    def testFail(self):
+        failures = []
+        extractee = EnvelopeExtractee(
+            1, lambda envelope, tag: self.fail("Finalized"), "tag",
+            error_callback=failures.append)
+        extractee.receive(numpy.ones(10, dtype=numpy.float32))
+        extractee.fail()
+        self.assertEqual(failures, ["tag"])
+
+
+class TestAutoAligner(TestCase):
+
+    def testFailedClipsAreDropped(self):
+        clips = [mock.MagicMock() for unused in range(3)]
+        aligned = []
+        aligner = AutoAligner(clips, lambda: aligned.append(True))
+        aligner._performShifts = mock.MagicMock()
+        # The extraction of all the envelopes is running.
+        aligner._extractors = dict.fromkeys(clips)
+        aligner._tracks = dict.fromkeys(clips)
+
+        aligner._envelopeFailedCb(clips[0])
+        self.assertEqual(aligner.failed, [clips[0]])
+        aligner._extractors.pop(clips[1])
+        aligner._extractors.pop(clips[2])
+        aligner._finishCb()
+        self.assertTrue(aligner._performShifts.called)
+        self.assertEqual(aligned, [True])
+
+    def testNotEnoughClipsLeft(self):
+        clips = [mock.MagicMock() for unused in range(2)]
+        aligned = []
+        aligner = AutoAligner(clips, lambda: aligned.append(True))
+        aligner._performShifts = mock.MagicMock()
+        aligner._extractors = dict.fromkeys(clips)
+        aligner._tracks = dict.fromkeys(clips)
+
+        aligner._envelopeFailedCb(clips[0])
+        self.assertEqual(aligned, [])
+        aligner._envelopeFailedCb(clips[1])
+        # The alignment is given up, the clips are left untouched.
+        self.assertFalse(aligner._performShifts.called)
+        self.assertEqual(aligned, [True])
+        self.assertEqual(aligner.failed, clips)
+
+
+class TestEnvelopeCache(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testSaveLoad(self):
+        path = os.path.join(self.tmpdir, "envelope-25.npy")
+        self.assertIsNone(load_envelope(path))
+        envelope = numpy.arange(100, dtype=numpy.float32)
+        save_envelope(path, envelope)
+        self.assertEqual(os.listdir(self.tmpdir), ["envelope-25.npy"])
+        numpy.testing.assert_array_equal(load_envelope(path), envelope)
+
+    def testSlice(self):
+        envelope = numpy.arange(100, dtype=numpy.float32)
+        numpy.testing.assert_array_equal(
+            slice_envelope(envelope, 0, 4 * Gst.SECOND, 25),
+            envelope[:100])
+        numpy.testing.assert_array_equal(
+            slice_envelope(envelope, Gst.SECOND, 2 * Gst.SECOND, 25),
+            envelope[25:75])
+        # The boundaries are rounded to the nearest block.
+        numpy.testing.assert_array_equal(
+            slice_envelope(envelope, Gst.SECOND // 25 * 3 // 4, Gst.SECOND,
+                           25),
+            envelope[1:26])
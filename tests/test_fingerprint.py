@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# Pitivi video editor
+#
+#       tests/test_fingerprint.py
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+import os
+import tempfile
+from unittest import TestCase
+
+from pitivi.utils.fingerprint import FingerprintIndex, get_file_hash
+from pitivi.utils.misc import hash_file
+
+
+class TestFingerprintIndex(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "media")
+        with open(self.path, "wb") as media:
+            media.write(b"x" * 300000)
+        self.index = FingerprintIndex(os.path.join(self.dir.name, "db"))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def testPersistent(self):
+        filehash = self.index.hash(self.path)
+        self.assertEqual(filehash, hash_file(self.path))
+        other = FingerprintIndex(os.path.join(self.dir.name, "db"))
+        self.assertEqual(other._hashes, {})
+        self.assertEqual(other.hash(self.path), filehash)
+        self.assertEqual(len(other._hashes), 1)
+
+    def testModifiedFile(self):
+        filehash = self.index.hash(self.path)
+        with open(self.path, "r+b") as media:
+            media.write(b"z")
+        self.assertNotEqual(self.index.hash(self.path), filehash)
+        self.assertEqual(self.index.hash(self.path), hash_file(self.path))
+
+
+class TestGetFileHash(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.old_cache_dir = os.environ.get("PITIVI_USER_CACHE_DIR")
+        self.path = os.path.join(self.dir.name, "media")
+        with open(self.path, "wb") as media:
+            media.write(b"x" * 1000)
+
+    def tearDown(self):
+        if self.old_cache_dir is None:
+            os.environ.pop("PITIVI_USER_CACHE_DIR", None)
+        else:
+            os.environ["PITIVI_USER_CACHE_DIR"] = self.old_cache_dir
+        self.dir.cleanup()
+
+    def testCacheDirChanged(self):
+        for name in ("cache1", "cache2"):
+            cache_dir = os.path.join(self.dir.name, name)
+            os.environ["PITIVI_USER_CACHE_DIR"] = cache_dir
+            self.assertEqual(get_file_hash(self.path), hash_file(self.path))
+            self.assertTrue(
+                os.path.exists(os.path.join(cache_dir, "fingerprints.db")))
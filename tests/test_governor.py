@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# Pitivi video editor
+#
+#       tests/test_governor.py
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+from unittest import TestCase
+
+from gi.repository import GLib
+
+from pitivi.utils.governor import BackgroundWorkGovernor, \
+    GOVERNOR_MAX_CPU_USAGE
+
+
+class FakeCPUUsageTracker(object):
+
+    def __init__(self):
+        self.value = 0
+
+    def usage(self):
+        return self.value
+
+    def reset(self):
+        pass
+
+
+class FakeJob(object):
+
+    def __init__(self):
+        self.paused = False
+
+    def pauseWork(self):
+        self.paused = True
+
+    def resumeWork(self):
+        self.paused = False
+
+
+class TestBackgroundWorkGovernor(TestCase):
+
+    def setUp(self):
+        self.governor = BackgroundWorkGovernor(max_jobs=2)
+        self.governor.cpu_usage_tracker = FakeCPUUsageTracker()
+        self.jobs = [FakeJob(), FakeJob()]
+        for job in self.jobs:
+            self.governor.register(job)
+
+    def tearDown(self):
+        for job in self.jobs:
+            self.governor.unregister(job)
+
+    def evaluate(self, latency_ms=0):
+        self.governor._last_evaluation = GLib.get_monotonic_time() - \
+            (250 + latency_ms) * 1000
+        self.governor._evaluateCb()
+
+    def testBudget(self):
+        # All the jobs run until the machine is loaded.
+        self.assertEqual(self.governor.budget, 2)
+        self.assertEqual([job.paused for job in self.jobs], [False, False])
+        # Not more than the maximum.
+        self.evaluate()
+        self.assertEqual(self.governor.budget, 2)
+
+        self.governor.cpu_usage_tracker.value = GOVERNOR_MAX_CPU_USAGE + 1
+        self.evaluate()
+        self.assertEqual([job.paused for job in self.jobs], [False, True])
+        # At least one job while the system is loaded.
+        self.evaluate()
+        self.assertEqual(self.governor.budget, 1)
+
+        # The main loop is late, still one job runs.
+        self.evaluate(latency_ms=1000)
+        self.assertEqual(self.governor.budget, 1)
+        self.assertEqual([job.paused for job in self.jobs], [False, True])
+
+        # The paused jobs are resumed when others are done.
+        self.governor.unregister(self.jobs[0])
+        self.assertFalse(self.jobs[1].paused)
+
+    def testLatency(self):
+        jobs = [FakeJob() for unused_i in range(6)]
+        self.governor.setPoolSize("previewers", 6)
+        for job in jobs:
+            self.governor.register(job)
+        self.jobs += jobs
+        self.assertEqual(self.governor.budget, 6)
+        # Halved, the latest jobs are paused.
+        self.evaluate(latency_ms=1000)
+        self.assertEqual(self.governor.budget, 3)
+        self.assertEqual([job.paused for job in self.jobs],
+                         [False] * 3 + [True] * 5)
+        self.evaluate(latency_ms=1000)
+        self.evaluate(latency_ms=1000)
+        self.assertEqual(self.governor.budget, 1)
+
+    def testPoolSizes(self):
+        governor = BackgroundWorkGovernor(max_jobs=2)
+        governor.setPoolSize("previewers", 4)
+        governor.setPoolSize("aligner", 2)
+        self.assertEqual(governor.max_jobs, 6)
+        self.assertEqual(governor.budget, 6)
+        governor.setPoolSize("aligner", 0)
+        self.assertEqual(governor.budget, 4)
+        governor.setPoolSize("previewers", 0)
+        self.assertEqual(governor.max_jobs, 2)
+
+    def testUserActivity(self):
+        self.evaluate()
+        self.assertEqual(self.governor.budget, 2)
+        self.governor.userActive()
+        self.assertEqual([job.paused for job in self.jobs], [False, True])
+        self.evaluate()
+        self.assertEqual(self.governor.budget, 1)
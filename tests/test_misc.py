@@ -17,9 +17,11 @@
 # Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
 # Boston, MA 02110-1301, USA.
 
+import os
+import tempfile
 import unittest
 
-from pitivi.utils.misc import binary_search
+from pitivi.utils.misc import binary_search, hash_file
 
 
 class BinarySearchTest(unittest.TestCase):
@@ -41,3 +43,15 @@ class BinarySearchTest(unittest.TestCase):
         self.assertEqual(binary_search([10, 20, 30], 11), 0)
         self.assertEqual(binary_search([10, 20, 30], 24), 1)
         self.assertEqual(binary_search([10, 20, 30], 40), 2)
+
+
+class HashFileTest(unittest.TestCase):
+
+    def testHashOnlyTheBeginning(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "media")
+            with open(path, "wb") as media:
+                media.write(b"x" * 300000 + b"y")
+            filehash = hash_file(path)
+            os.truncate(path, 256 * 1024)
+            self.assertEqual(hash_file(path), filehash)
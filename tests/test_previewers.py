@@ -0,0 +1,851 @@
+# -*- coding: utf-8 -*-
+# Pitivi video editor
+#
+#       tests/test_previewers.py
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+import mock
+import numpy
+import os
+import pickle
+import shutil
+import sqlite3
+import struct
+import tempfile
+import time
+from unittest import TestCase
+
+from gi.repository import GES
+from gi.repository import GLib
+from gi.repository import GObject
+from gi.repository import GdkPixbuf
+from gi.repository import Gst
+
+from pitivi.timeline.previewers import PreviewGeneratorManager, \
+    VideoPreviewer, WishQueue, PREVIEW_GENERATOR_SIGNALS, THUMB_MARGIN_PX, \
+    WAVEFORM_TILE_WIDTH, get_waveform_tile_range, render_waveform_tile, \
+    renderer
+from pitivi.utils.fingerprint import get_file_hash
+from pitivi.utils.misc import path_from_uri
+from pitivi.utils.previewcaches import COMMIT_BATCH_SIZE, \
+    PreviewCachesManager, ThumbnailsDatabase, get_preview_caches_manager
+from pitivi.utils.previewclient import decode_messages, encode_message
+from pitivi.utils.thumbnails import THUMB_HEIGHT, THUMB_LEVELS, \
+    THUMB_PERIOD, PixbufMemoryCache, RawThumbnailCache, RawThumbnailFile, ThumbnailCache
+from pitivi.utils.ui import EXPANDED_SIZE
+from pitivi.utils.waveforms import WAVEFORM_BLOCK_DURATION, \
+    WAVEFORM_CLIPPED, WAVEFORM_COLUMNS, WAVEFORM_DECIMATION, WAVEFORM_MAX, \
+    WAVEFORM_MIN, WAVEFORM_MIN_LEVEL_BLOCKS, WAVEFORM_RMS, Waveform, \
+    WaveformBuilder, import_legacy_wavefile, mix_waveform, save_waveform
+from tests import common
+
+
+def createPixbuf(width=16, height=9):
+    pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8,
+                                  width, height)
+    pixbuf.fill(0x336699ff)
+    return pixbuf
+
+
+class FakeGenerator(GObject.Object):
+
+    __gsignals__ = PREVIEW_GENERATOR_SIGNALS
+
+    def __init__(self, track_type=GES.TrackType.VIDEO):
+        GObject.Object.__init__(self)
+        self.track_type = track_type
+        self.running = False
+
+    def startGeneration(self):
+        self.running = True
+
+    def stopGeneration(self):
+        self.running = False
+        self.emit("done")
+
+
+class FakeSettings(GObject.Object):
+
+    __gsignals__ = {
+        "previewersMaxVideoJobsChanged": (GObject.SIGNAL_RUN_LAST, None, ()),
+        "previewersMaxAudioJobsChanged": (GObject.SIGNAL_RUN_LAST, None, ()),
+        "previewersCacheBudgetChanged": (GObject.SIGNAL_RUN_LAST, None, ()),
+    }
+
+    previewersMaxVideoJobs = 2
+    previewersMaxAudioJobs = 1
+    previewersCacheBudget = 4
+
+
+class TestPreviewGeneratorManager(TestCase):
+
+    def setUp(self):
+        self.manager = PreviewGeneratorManager()
+        self.settings = FakeSettings()
+        self.manager.setSettings(self.settings)
+
+    def testConcurrentJobs(self):
+        generators = [FakeGenerator() for unused_i in range(3)]
+        for generator in generators:
+            self.manager.addPipeline(generator)
+        self.assertEqual([g.running for g in generators], [True, True, False])
+
+        generators[0].stopGeneration()
+        self.assertEqual([g.running for g in generators], [False, True, True])
+
+    def testTrackTypesAreIndependent(self):
+        audio = [FakeGenerator(GES.TrackType.AUDIO) for unused_i in range(2)]
+        video = FakeGenerator()
+        for generator in audio + [video]:
+            self.manager.addPipeline(generator)
+        self.assertEqual([g.running for g in audio], [True, False])
+        self.assertTrue(video.running)
+
+    def testFairness(self):
+        self.settings.previewersMaxVideoJobs = 1
+        first, second = FakeGenerator(), FakeGenerator()
+        self.manager.addPipeline(first)
+        self.manager.addPipeline(second)
+        first.stopGeneration()
+        # The first generator asks again, it has to wait for the second one.
+        self.manager.addPipeline(first)
+        self.assertTrue(second.running)
+        self.assertFalse(first.running)
+
+    def testRemovePipeline(self):
+        self.settings.previewersMaxVideoJobs = 1
+        first, second, third = FakeGenerator(), FakeGenerator(), FakeGenerator()
+        for generator in (first, second, third):
+            self.manager.addPipeline(generator)
+
+        # Removing a waiting generator means it will never be started.
+        self.manager.removePipeline(second)
+        # Removing a running generator frees its slot.
+        self.manager.removePipeline(first)
+        self.assertFalse(second.running)
+        self.assertTrue(third.running)
+
+    def testMaxJobsChanged(self):
+        self.settings.previewersMaxVideoJobs = 1
+        generators = [FakeGenerator() for unused_i in range(3)]
+        for generator in generators:
+            self.manager.addPipeline(generator)
+        self.assertEqual([g.running for g in generators], [True, False, False])
+
+        self.settings.previewersMaxVideoJobs = 3
+        self.settings.emit("previewersMaxVideoJobsChanged")
+        self.assertEqual([g.running for g in generators], [True, True, True])
+
+
+class TestVideoPreviewer(TestCase):
+
+    def testDaemonJobDone(self):
+        for success in (True, False):
+            previewer = mock.MagicMock()
+            previewer.uri = "file:///tmp/clip.ogv"
+            previewer._daemon_refresh_id = None
+            VideoPreviewer._daemonJobDoneCb(previewer, success)
+            # The thumbnails the daemon skipped are generated locally.
+            self.assertIsNone(previewer._daemon)
+            previewer._update.assert_called_once_with()
+
+    def _createPreviewer(self):
+        previewer = mock.MagicMock()
+        previewer.duration = 100 * THUMB_PERIOD
+        previewer.thumb_period = THUMB_PERIOD
+        previewer.queue = set(range(0, previewer.duration, THUMB_PERIOD))
+        previewer.wishlist = WishQueue()
+        previewer.thumbs = {}
+        previewer._thumbnailing = True
+        previewer._linear = False
+        previewer._wishlistCoverage = \
+            lambda: VideoPreviewer._wishlistCoverage(previewer)
+
+        def setLinear(linear):
+            previewer._linear = linear
+        previewer._startLinearDecoding.side_effect = lambda: setLinear(True)
+        previewer._stopLinearDecoding.side_effect = lambda: setLinear(False)
+        return previewer
+
+    def testDecodingMode(self):
+        previewer = self._createPreviewer()
+        VideoPreviewer._updateDecodingMode(previewer)
+        self.assertEqual(previewer._wishlistCoverage(), 0)
+        self.assertFalse(previewer._linear)
+
+        # Zoomed in, a few close thumbnails are wished.
+        for time in range(10 * THUMB_PERIOD, 20 * THUMB_PERIOD, THUMB_PERIOD):
+            previewer.wishlist.add(time)
+        VideoPreviewer._updateDecodingMode(previewer)
+        self.assertAlmostEqual(previewer._wishlistCoverage(), 0.09)
+        self.assertFalse(previewer._startLinearDecoding.called)
+
+        # Zoomed out, few thumbnails are wished but they span the clip.
+        previewer.wishlist.add(0)
+        previewer.wishlist.add(90 * THUMB_PERIOD)
+        VideoPreviewer._updateDecodingMode(previewer)
+        self.assertAlmostEqual(previewer._wishlistCoverage(), 0.9)
+        self.assertTrue(previewer._linear)
+        VideoPreviewer._updateDecodingMode(previewer)
+        self.assertEqual(previewer._startLinearDecoding.call_count, 1)
+
+        # Zoomed in again.
+        previewer.wishlist.remove(0)
+        previewer.wishlist.remove(90 * THUMB_PERIOD)
+        VideoPreviewer._updateDecodingMode(previewer)
+        self.assertFalse(previewer._linear)
+        self.assertEqual(previewer._stopLinearDecoding.call_count, 1)
+
+    def testLinearThumbnail(self):
+        previewer = self._createPreviewer()
+        previewer._frame_duration = Gst.SECOND // 25
+        previewer.wishlist.add(2 * THUMB_PERIOD)
+        pixbuf = createPixbuf()
+        VideoPreviewer._setLinearThumbnail(
+            previewer, 2 * THUMB_PERIOD + Gst.SECOND // 50, pixbuf)
+        previewer.thumb_cache.put.assert_called_once_with(
+            2 * THUMB_PERIOD, pixbuf, True)
+        self.assertNotIn(2 * THUMB_PERIOD, previewer.queue)
+        self.assertNotIn(2 * THUMB_PERIOD, previewer.wishlist)
+
+        # A frame away from its slot, for example after the key unit seek.
+        previewer.thumb_cache.reset_mock()
+        VideoPreviewer._setLinearThumbnail(
+            previewer, 3 * THUMB_PERIOD + THUMB_PERIOD // 3, pixbuf)
+        previewer.thumb_cache.put.assert_called_once_with(
+            3 * THUMB_PERIOD, pixbuf, False)
+        self.assertNotIn(3 * THUMB_PERIOD, previewer.queue)
+
+        # Already served.
+        previewer.thumb_cache.reset_mock()
+        VideoPreviewer._setLinearThumbnail(previewer, 3 * THUMB_PERIOD, pixbuf)
+        self.assertFalse(previewer.thumb_cache.put.called)
+
+
+class TestWishQueue(TestCase):
+
+    def testPriorities(self):
+        wishes = WishQueue()
+        wishes.setPoints((50, 0))
+        for time in range(0, 100, 10):
+            wishes.add(time)
+        wishes.remove(50)
+        self.assertNotIn(50, wishes)
+        self.assertEqual([wishes.pop() for unused_i in range(len(wishes))],
+                         [0, 10, 40, 60, 20, 30, 70, 80, 90])
+        self.assertRaises(IndexError, wishes.pop)
+
+    def testReprioritize(self):
+        wishes = WishQueue()
+        wishes.setPoints((0,))
+        for time in (0, 50, 100):
+            wishes.add(time)
+        wishes.setPoints((100,))
+        self.assertEqual(wishes.pop(), 100)
+        self.assertEqual(wishes.pop(), 50)
+        self.assertEqual(len(wishes), 1)
+
+    def testBounds(self):
+        wishes = WishQueue()
+        wishes.setPoints((50,))
+        for time in (30, 50, 10, 90):
+            wishes.add(time)
+        wishes.remove(90)
+        self.assertEqual(wishes.bounds(), (10, 50))
+
+
+class TestPixbufMemoryCache(TestCase):
+
+    def testBudget(self):
+        pixbuf = createPixbuf()
+        size = pixbuf.get_rowstride() * pixbuf.get_height()
+        memory = PixbufMemoryCache(2 * size)
+        memory.put("a", pixbuf)
+        memory.put("b", createPixbuf())
+        self.assertEqual(memory.size, 2 * size)
+
+        # "a" becomes the most recently used, so "b" has to go.
+        self.assertIs(memory.get("a"), pixbuf)
+        memory.put("c", createPixbuf())
+        self.assertEqual(memory.size, 2 * size)
+        self.assertIn("a", memory)
+        self.assertNotIn("b", memory)
+        self.assertIn("c", memory)
+
+    def testCounters(self):
+        memory = PixbufMemoryCache(1024 * 1024)
+        memory.put("a", createPixbuf())
+        memory.get("a")
+        memory.get("b")
+        self.assertEqual(memory.hits, 1)
+        self.assertEqual(memory.misses, 1)
+
+
+class TestThumbnailCache(TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.old_cache_dir = os.environ.get("PITIVI_USER_CACHE_DIR")
+        os.environ["PITIVI_USER_CACHE_DIR"] = self.cache_dir
+        self.uri = common.TestCase.getSampleUri("tears_of_steel.webm")
+
+    def tearDown(self):
+        if self.old_cache_dir is None:
+            del os.environ["PITIVI_USER_CACHE_DIR"]
+        else:
+            os.environ["PITIVI_USER_CACHE_DIR"] = self.old_cache_dir
+        shutil.rmtree(self.cache_dir)
+
+    def testThumbHeight(self):
+        # The thumbnails generated by the daemon fill an expanded track.
+        self.assertEqual(THUMB_HEIGHT + 2 * THUMB_MARGIN_PX, EXPANDED_SIZE)
+
+    def testMemoryTier(self):
+        memory = PixbufMemoryCache(1024 * 1024)
+        cache = ThumbnailCache(self.uri, memory)
+        cache[0] = createPixbuf()
+        cache.commit()
+        self.assertIn(0, cache)
+        cache[0]
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+        # Another cache for the same file has to read it from disk,
+        # and then keeps it in memory.
+        other_memory = PixbufMemoryCache(1024 * 1024)
+        other_cache = ThumbnailCache(self.uri, other_memory)
+        pixbuf = other_cache[0]
+        self.assertEqual(pixbuf.get_width(), 16)
+        other_cache[0]
+        self.assertEqual((other_cache.hits, other_cache.misses), (1, 1))
+        self.assertRaises(KeyError, other_cache.__getitem__, 1)
+
+    def testRanges(self):
+        cache = ThumbnailCache(self.uri, PixbufMemoryCache(1024 * 1024))
+        for key in (0, 10, 20, 25, 30):
+            cache[key] = createPixbuf()
+        cache.commit()
+        self.assertEqual(sorted(cache.getRange(10, 30)), [10, 20, 25])
+        self.assertEqual(sorted(cache.getRange(5, 31, 10)), [10, 20, 30])
+        self.assertEqual(cache.missing(range(0, 50, 5)), [5, 15, 35, 40, 45])
+
+        # Read the thumbnails from the disk.
+        other_cache = ThumbnailCache(self.uri, PixbufMemoryCache(1024 * 1024))
+        self.assertEqual(sorted(other_cache.getRange(0, 40, 10)),
+                         [0, 10, 20, 30])
+        self.assertEqual(other_cache.misses, 4)
+        self.assertEqual(sorted(other_cache.getRange(0, 40, 10)),
+                         [0, 10, 20, 30])
+        self.assertEqual(other_cache.hits, 4)
+        self.assertEqual(other_cache.missing(range(0, 50, 5)),
+                         [5, 15, 35, 40, 45])
+
+    def testApproximate(self):
+        cache = ThumbnailCache(self.uri, PixbufMemoryCache(1024 * 1024))
+        cache.put(0, createPixbuf(), False)
+        cache.put(10, createPixbuf(), True)
+        cache.put(20, createPixbuf(), False)
+        cache.commit()
+        self.assertEqual(cache.approximate(), [0, 20])
+
+        # Approximate thumbnails are cached all the same.
+        self.assertEqual(cache.missing([0, 10, 20, 30]), [30])
+
+        cache[20] = createPixbuf()
+        cache.commit()
+        other_cache = ThumbnailCache(self.uri, PixbufMemoryCache(1024 * 1024))
+        self.assertEqual(other_cache.approximate(), [0])
+
+    def testLevels(self):
+        cache = ThumbnailCache(self.uri, PixbufMemoryCache(1024 * 1024))
+        for key in (0, 10, 20):
+            cache.put(key, createPixbuf(32, 18), False)
+        cache.commit()
+
+        # The smaller thumbnails are scaled down from the level 0 ones.
+        pixbufs = cache.getRange(0, 30, 10, 2)
+        self.assertEqual(sorted(pixbufs), [0, 10, 20])
+        self.assertEqual(pixbufs[10].get_height(), 18 // THUMB_LEVELS[2][0])
+        self.assertEqual(cache.getRange(0, 30, 10, 0)[10].get_height(), 18)
+
+        # They survive a restart.
+        other_cache = ThumbnailCache(self.uri, PixbufMemoryCache(1024 * 1024))
+        pixbufs = other_cache.getRange(0, 30, 10, 2)
+        self.assertEqual(pixbufs[0].get_height(), 18 // THUMB_LEVELS[2][0])
+
+        # Refining a thumbnail replaces the smaller ones.
+        other_cache.put(0, createPixbuf(64, 36), True)
+        pixbufs = other_cache.getRange(0, 30, 10, 2)
+        self.assertEqual(pixbufs[0].get_height(), 36 // THUMB_LEVELS[2][0])
+        self.assertEqual(other_cache.approximate(), [10, 20])
+
+    def testLegacyDatabase(self):
+        filehash = get_file_hash(Gst.uri_get_location(self.uri))
+        legacy_dir = os.path.join(self.cache_dir, "thumbs")
+        os.makedirs(legacy_dir)
+        legacy_path = os.path.join(legacy_dir, filehash)
+        legacy = sqlite3.connect(legacy_path)
+        success, jpeg = createPixbuf().save_to_bufferv("jpeg", [], [])
+        legacy.execute("CREATE TABLE Thumbs (Time INTEGER NOT NULL PRIMARY KEY,"
+                       " Jpeg BLOB NOT NULL)")
+        legacy.execute("INSERT INTO Thumbs VALUES (10, ?)",
+                       (sqlite3.Binary(jpeg),))
+        legacy.commit()
+        legacy.close()
+
+        cache = ThumbnailCache(self.uri, PixbufMemoryCache(1024 * 1024))
+        self.assertIn(10, cache)
+        self.assertEqual(cache.approximate(), [])
+        self.assertFalse(os.path.exists(legacy_path))
+
+    def testRawCache(self):
+        cache = RawThumbnailCache(self.uri, PixbufMemoryCache(1024 * 1024))
+        for key in (0, 10, 20):
+            cache.put(key, createPixbuf(32, 18), key != 10)
+        cache.commit()
+
+        other_cache = RawThumbnailCache(self.uri,
+                                        PixbufMemoryCache(1024 * 1024))
+        self.assertIn(10, other_cache)
+        self.assertEqual(other_cache.approximate(), [10])
+        self.assertEqual(other_cache.missing([0, 5, 10]), [5])
+        pixbufs = other_cache.getRange(0, 30, 10)
+        self.assertEqual(sorted(pixbufs), [0, 10, 20])
+        self.assertEqual(pixbufs[10].get_pixels(),
+                         createPixbuf(32, 18).add_alpha(
+                             False, 0, 0, 0).get_pixels())
+        pixbufs = other_cache.getRange(0, 30, 10, 1)
+        self.assertEqual(pixbufs[0].get_height(), 18 // THUMB_LEVELS[1][0])
+
+
+class TestRawThumbnailFile(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "0")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testSlotReused(self):
+        thumbs = RawThumbnailFile(self.path)
+        pixbuf = createPixbuf()
+        thumbs.put(0, pixbuf, True)
+        thumbs.put(10, pixbuf, True)
+        thumbs.remove(0)
+        thumbs.put(20, pixbuf, False)
+        self.assertEqual(thumbs.slots, {10: (1, True), 20: (0, False)})
+        # The pixbufs own their pixels, overwriting the slot is harmless.
+        first = thumbs.get(20)
+        thumbs.put(20, createPixbuf().add_alpha(True, 0x33, 0x66, 0x99), True)
+        self.assertEqual(first.get_pixels(), thumbs.get(10).get_pixels())
+        thumbs.close()
+
+    def testCompact(self):
+        thumbs = RawThumbnailFile(self.path)
+        pixbuf = createPixbuf()
+        for unused in range(10):
+            thumbs.put(0, pixbuf, False)
+        thumbs.put(10, pixbuf, True)
+        thumbs.close()
+        index_path = self.path + ".idx"
+        record_size = RawThumbnailFile.RECORD.size
+        header_size = RawThumbnailFile.HEADER.size
+        self.assertEqual(os.path.getsize(index_path),
+                         header_size + 11 * record_size)
+
+        thumbs = RawThumbnailFile(self.path)
+        self.assertEqual(os.path.getsize(index_path),
+                         header_size + 2 * record_size)
+        self.assertEqual(thumbs.slots, {0: (0, False), 10: (1, True)})
+        self.assertEqual(thumbs.get(10).get_pixels(),
+                         pixbuf.add_alpha(False, 0, 0, 0).get_pixels())
+        thumbs.close()
+
+
+class TestRenderer(TestCase):
+    """Tests the C module, which is built before running the tests."""
+
+    ENVELOPE = 0xff339900
+    RMS = 0xff66cc33
+
+    def getPixel(self, surface, x, y):
+        surface.flush()
+        offset = y * surface.get_stride() + x * 4
+        # The ARGB32 pixels are native-endian 32-bit values.
+        return struct.unpack_from("=I", surface.get_data(), offset)[0]
+
+    def testFillEnvelopeSurface(self):
+        # The min, max and RMS of four blocks, in percents of the full scale.
+        blocks = numpy.array([[-50, 50, 0],
+                              [-50, 50, 20],
+                              [0, 200, 0],
+                              [0, 0, 0]], dtype=numpy.float32)
+        surface = renderer.fill_envelope_surface(blocks, 4, 100)
+        self.assertEqual((surface.get_width(), surface.get_height()),
+                         (4, 100))
+
+        self.assertEqual(self.getPixel(surface, 0, 24), 0)
+        self.assertEqual(self.getPixel(surface, 0, 25), self.ENVELOPE)
+        self.assertEqual(self.getPixel(surface, 0, 50), self.ENVELOPE)
+        self.assertEqual(self.getPixel(surface, 0, 75), self.ENVELOPE)
+        self.assertEqual(self.getPixel(surface, 0, 76), 0)
+
+        self.assertEqual(self.getPixel(surface, 1, 39), self.ENVELOPE)
+        self.assertEqual(self.getPixel(surface, 1, 40), self.RMS)
+        self.assertEqual(self.getPixel(surface, 1, 59), self.RMS)
+        self.assertEqual(self.getPixel(surface, 1, 60), self.ENVELOPE)
+
+        # The values above the full scale are clipped.
+        self.assertEqual(self.getPixel(surface, 2, 0), self.ENVELOPE)
+        self.assertEqual(self.getPixel(surface, 2, 50), self.ENVELOPE)
+        self.assertEqual(self.getPixel(surface, 2, 51), 0)
+
+        # Silence is a single line.
+        self.assertEqual(self.getPixel(surface, 3, 49), 0)
+        self.assertEqual(self.getPixel(surface, 3, 50), self.ENVELOPE)
+        self.assertEqual(self.getPixel(surface, 3, 51), 0)
+
+    def testBlocksPerPixel(self):
+        # A lane of a (blocks, channels, columns) waveform, not contiguous.
+        blocks = numpy.zeros((8, 2, 2), dtype=numpy.float32)
+        blocks[:, 1, 0] = -10
+        blocks[:, 1, 1] = 10
+        # The extremes of the blocks drawn on the second pixel.
+        blocks[5, 1, 0] = -50
+        blocks[6, 1, 1] = 50
+        surface = renderer.fill_envelope_surface(blocks[:, 1, :], 2, 100)
+        self.assertEqual(self.getPixel(surface, 0, 44), 0)
+        self.assertEqual(self.getPixel(surface, 0, 45), self.ENVELOPE)
+        self.assertEqual(self.getPixel(surface, 0, 55), self.ENVELOPE)
+        self.assertEqual(self.getPixel(surface, 0, 56), 0)
+        self.assertEqual(self.getPixel(surface, 1, 25), self.ENVELOPE)
+        self.assertEqual(self.getPixel(surface, 1, 75), self.ENVELOPE)
+
+    def testInvalidBlocks(self):
+        self.assertRaises(ValueError, renderer.fill_envelope_surface,
+                          numpy.zeros((4, 3), dtype=numpy.float64), 4, 100)
+        self.assertRaises(ValueError, renderer.fill_envelope_surface,
+                          numpy.zeros((4,), dtype=numpy.float32), 4, 100)
+        self.assertRaises(ValueError, renderer.fill_envelope_surface,
+                          numpy.zeros((4, 3), dtype=numpy.float32), 0, 100)
+
+
+class TestWaveform(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "waveform")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testBuilder(self):
+        # 2.5 frames per block.
+        builder = WaveformBuilder(250, 2)
+        self.assertIsNone(builder.getBlocks())
+        samples = numpy.zeros((6, 2), numpy.float32)
+        samples[:, 0] = [0.5, -0.5, 0.5, 0.125, 0.125, -1.0]
+        samples[:, 1] = [0.0, 0.0, 0.0, 0.25, 0.25, 0.25]
+        builder.addSamples(samples[:1])
+        builder.addSamples(samples[1:])
+        blocks = builder.getBlocks()
+        self.assertEqual(blocks.shape, (3, 2, WAVEFORM_COLUMNS))
+        self.assertEqual(blocks[:, 0, WAVEFORM_MIN].tolist(), [-50, 12.5, -100])
+        self.assertEqual(blocks[:, 1, WAVEFORM_MIN].tolist(), [0, 0, 25])
+        self.assertAlmostEqual(blocks[1, 0, WAVEFORM_MAX], 50)
+        self.assertAlmostEqual(blocks[1, 1, WAVEFORM_MAX], 25)
+        self.assertAlmostEqual(blocks[0, 0, WAVEFORM_RMS], 50)
+        self.assertAlmostEqual(blocks[2, 1, WAVEFORM_RMS], 25)
+        # Only the first channel clipped, in the last block.
+        self.assertEqual(blocks[..., WAVEFORM_CLIPPED].tolist(),
+                         [[0, 0], [0, 0], [1, 0]])
+
+        mixed = mix_waveform(blocks)
+        self.assertEqual(mixed.shape, (3, 1, WAVEFORM_COLUMNS))
+        self.assertEqual(mixed[:, 0, WAVEFORM_MIN].tolist(), [-50, 0, -100])
+        self.assertAlmostEqual(mixed[2, 0, WAVEFORM_MAX], 25)
+        self.assertAlmostEqual(mixed[0, 0, WAVEFORM_RMS], 25)
+        self.assertEqual(mixed[:, 0, WAVEFORM_CLIPPED].tolist(), [0, 0, 1])
+
+    def testLevels(self):
+        num_blocks = WAVEFORM_MIN_LEVEL_BLOCKS * WAVEFORM_DECIMATION + 1
+        blocks = numpy.zeros((num_blocks, 2, WAVEFORM_COLUMNS), numpy.float32)
+        blocks[:, 0, WAVEFORM_MAX] = numpy.arange(num_blocks)
+        blocks[:, 0, WAVEFORM_MIN] = -blocks[:, 0, WAVEFORM_MAX]
+        blocks[:, 0, WAVEFORM_RMS] = 1
+        blocks[WAVEFORM_DECIMATION, 1, WAVEFORM_CLIPPED] = 1
+        save_waveform(self.path, blocks)
+
+        waveform = Waveform(self.path)
+        self.assertEqual(len(waveform), num_blocks)
+        self.assertEqual(waveform.channels, 2)
+        self.assertEqual(len(waveform.levels), 3)
+        self.assertEqual(len(waveform.levels[1]), WAVEFORM_MIN_LEVEL_BLOCKS + 1)
+        self.assertEqual(waveform.levels[1][0, 0, WAVEFORM_MAX],
+                         WAVEFORM_DECIMATION - 1)
+        self.assertEqual(waveform.levels[1][1, 0, WAVEFORM_MIN],
+                         1 - 2 * WAVEFORM_DECIMATION)
+        self.assertAlmostEqual(waveform.levels[1][0, 0, WAVEFORM_RMS], 1)
+        self.assertEqual(waveform.levels[1][:3, 1, WAVEFORM_CLIPPED].tolist(),
+                         [0, 1, 0])
+
+        # A block per pixel at least.
+        self.assertEqual(len(waveform.getBlocks(0, 100, 100)), 100)
+        self.assertEqual(len(waveform.getBlocks(0, 800, 100)), 100)
+        self.assertEqual(len(waveform.getBlocks(4, 804, 100)), 101)
+        self.assertEqual(len(waveform.getBlocks(0, num_blocks, 10)), 65)
+
+    def testTileRange(self):
+        width = WAVEFORM_TILE_WIDTH
+        # Two blocks per pixel.
+        self.assertEqual(get_waveform_tile_range(0, 2, 4 * width),
+                         (0, 2 * width, width))
+        self.assertEqual(get_waveform_tile_range(1, 2, 4 * width),
+                         (2 * width, 4 * width, width))
+        # The last tile is narrower.
+        self.assertEqual(get_waveform_tile_range(1, 2, 3 * width),
+                         (2 * width, 3 * width, width // 2))
+        self.assertEqual(get_waveform_tile_range(2, 2, 3 * width), (0, 0, 0))
+        # Many pixels per block.
+        self.assertEqual(get_waveform_tile_range(0, 1 / width, 3),
+                         (0, 1, width))
+        self.assertEqual(get_waveform_tile_range(2, 1 / width, 3),
+                         (2, 3, width))
+        self.assertEqual(get_waveform_tile_range(0, 0.01, 1), (0, 1, 100))
+
+    def testRenderTile(self):
+        num_blocks = WAVEFORM_TILE_WIDTH + 10
+        blocks = numpy.zeros((num_blocks, 2, WAVEFORM_COLUMNS), numpy.float32)
+        save_waveform(self.path, blocks)
+        waveform = Waveform(self.path)
+        # A block per pixel.
+        zoomratio = Gst.SECOND / WAVEFORM_BLOCK_DURATION
+        surface = render_waveform_tile(waveform, zoomratio, 0)
+        self.assertEqual(surface.get_width(), WAVEFORM_TILE_WIDTH)
+        self.assertEqual(surface.get_height(), EXPANDED_SIZE)
+        surface = render_waveform_tile(waveform, zoomratio, 1)
+        self.assertEqual(surface.get_width(), 10)
+        self.assertIsNone(render_waveform_tile(waveform, zoomratio, 2))
+
+    def testLegacyWavefile(self):
+        with open(self.path + ".wave", "wb") as wavefile:
+            pickle.dump([1.0, 2.0, 3.0], wavefile)
+        import_legacy_wavefile(self.path)
+        self.assertFalse(os.path.exists(self.path + ".wave"))
+        waveform = Waveform(self.path)
+        self.assertEqual(waveform.channels, 1)
+        self.assertEqual(waveform.levels[0][:, 0, WAVEFORM_RMS].tolist(),
+                         [1, 2, 3])
+
+    def testMixedDownWaveform(self):
+        os.makedirs(self.path)
+        numpy.save(os.path.join(self.path, "0.npy"),
+                   numpy.ones((10, 3), numpy.float32))
+        waveform = Waveform(self.path)
+        self.assertEqual(waveform.channels, 1)
+        self.assertEqual(waveform.getBlocks(0, 10, 10).shape, (10, 1, 3))
+
+
+class TestPreviewDaemonProtocol(TestCase):
+
+    def testDecodeMessages(self):
+        data = encode_message({"type": "waveform", "uri": "file:///a"}) + \
+            encode_message({"type": "thumbnails", "uri": "file:///b"})
+        messages, rest = decode_messages(data[:-5])
+        self.assertEqual(messages, [{"type": "waveform", "uri": "file:///a"}])
+        messages, rest = decode_messages(rest + data[-5:])
+        self.assertEqual(messages, [{"type": "thumbnails", "uri": "file:///b"}])
+        self.assertEqual(rest, b"")
+
+    def testGarbageIsSkipped(self):
+        messages, rest = decode_messages(b"garbage\n{}\n")
+        self.assertEqual(messages, [{}])
+        self.assertEqual(rest, b"")
+
+
+class TestPreviewCachesManager(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.media_dir = os.path.join(self.dir, "media")
+        os.mkdir(self.media_dir)
+        self.cache_dir = os.path.join(self.dir, "cache")
+        os.makedirs(os.path.join(self.cache_dir, "waves"))
+        self.manager = PreviewCachesManager(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def createStore(self, name, size, age):
+        path = os.path.join(self.cache_dir, "waves", name)
+        with open(path, "wb") as store:
+            store.write(b"x" * size)
+        media = os.path.join(self.media_dir, name)
+        open(media, "w").close()
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path, "file://" + media
+
+    def testBudget(self):
+        old, unused_uri = self.createStore("old", 1000, 3 * 3600)
+        older, unused_uri = self.createStore("older", 1000, 4 * 3600)
+        recent, unused_uri = self.createStore("recent", 1000, 60)
+        self.manager.budget = 2500
+        self.assertEqual(self.manager.enforceBudget(), 1000)
+        self.assertFalse(os.path.exists(older))
+        self.assertTrue(os.path.exists(old))
+
+        # The recently used stores are kept even when over budget.
+        self.manager.budget = 1
+        self.assertEqual(self.manager.enforceBudget(), 1000)
+        self.assertTrue(os.path.exists(recent))
+
+    def testUsedStoresAreKept(self):
+        path, uri = self.createStore("used", 1000, 4 * 3600)
+        self.manager.touch(path, uri)
+        self.manager.budget = 1
+        self.assertEqual(self.manager.enforceBudget(), 0)
+        self.assertTrue(os.path.exists(path))
+
+    def testSettings(self):
+        settings = FakeSettings()
+        self.manager.setSettings(settings)
+        self.assertEqual(self.manager.budget, 4 * 1024 * 1024)
+        settings.previewersCacheBudget = 1
+        settings.emit("previewersCacheBudgetChanged")
+        self.assertEqual(self.manager.budget, 1024 * 1024)
+
+    def testPruneMissing(self):
+        path, uri = self.createStore("deleted", 1000, 4 * 3600)
+        other = PreviewCachesManager(self.cache_dir)
+        other.touch(path, uri)
+        self.assertEqual(self.manager.pruneMissing(), 0)
+        os.remove(path_from_uri(uri))
+        self.assertEqual(self.manager.pruneMissing(), 1000)
+        self.assertFalse(os.path.exists(path))
+
+    def testInBackground(self):
+        path, uri = self.createStore("deleted", 1000, 4 * 3600)
+        self.manager.touch(path, uri)
+        os.remove(path_from_uri(uri))
+        other = PreviewCachesManager(self.cache_dir)
+        mainloop = GLib.MainLoop()
+        results = []
+
+        def doneCb(freed):
+            results.append(freed)
+            if len(results) == 2:
+                mainloop.quit()
+
+        # The second scan waits for the first one.
+        other.pruneMissingInBackground(doneCb)
+        other.enforceBudgetInBackground(doneCb)
+        GLib.timeout_add_seconds(10, mainloop.quit)
+        mainloop.run()
+        self.assertEqual(results, [1000, 0])
+        self.assertFalse(os.path.exists(path))
+
+    def testCacheDirChanged(self):
+        unused_path, uri = self.createStore("a", 1000, 0)
+        old_cache_dir = os.environ.get("PITIVI_USER_CACHE_DIR")
+        os.environ["PITIVI_USER_CACHE_DIR"] = self.cache_dir
+        try:
+            manager = get_preview_caches_manager()
+            self.assertIs(get_preview_caches_manager(), manager)
+            os.environ["PITIVI_USER_CACHE_DIR"] = os.path.join(
+                self.cache_dir, "other")
+            other = get_preview_caches_manager()
+            self.assertIsNot(other, manager)
+            other.touch(os.path.join(self.cache_dir, "other", "waves", "a"),
+                        uri)
+        finally:
+            if old_cache_dir is None:
+                del os.environ["PITIVI_USER_CACHE_DIR"]
+            else:
+                os.environ["PITIVI_USER_CACHE_DIR"] = old_cache_dir
+
+    def testPendingThumbnails(self):
+        db = ThumbnailsDatabase(os.path.join(self.cache_dir, "thumbs.db"))
+        manager = PreviewCachesManager(self.cache_dir, db)
+        db.write("INSERT INTO Thumbnails (Asset, Level, Time, Jpeg) "
+                 "VALUES ('a', 0, 0, 'jpeg')")
+        commit_id = db._commit_id
+        manager.budget = 1024 * 1024
+        self.assertEqual(manager.enforceBudget(), 0)
+        # The scan left the batch of the main loop alone.
+        self.assertEqual(db._pending, 1)
+        self.assertEqual(db._commit_id, commit_id)
+        db.commit()
+        self.assertEqual(db.assetSizes(), {"a": 4})
+
+
+class TestThumbnailsDatabase(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "thumbs.db")
+        self.db = ThumbnailsDatabase(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def count(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute("SELECT COUNT(*) FROM Thumbnails").fetchone()[0]
+        finally:
+            conn.close()
+
+    def write(self, asset, time):
+        self.db.write("INSERT INTO Thumbnails (Asset, Level, Time, Jpeg) "
+                      "VALUES (?, 0, ?, ?)", (asset, time, b"jpeg"))
+
+    def testBatches(self):
+        for time in range(COMMIT_BATCH_SIZE - 1):
+            self.write("a", time)
+        self.assertEqual(self.count(), 0)
+        # The reads see the pending writes, without committing them.
+        self.assertEqual(len(self.db.query(
+            "SELECT Time FROM Thumbnails WHERE Asset = ?", ("a",))),
+            COMMIT_BATCH_SIZE - 1)
+        self.assertEqual(self.count(), 0)
+
+        for time in range(COMMIT_BATCH_SIZE):
+            self.write("b", time)
+        self.assertEqual(self.count(), COMMIT_BATCH_SIZE)
+        self.db.commit()
+        self.assertEqual(self.count(), 2 * COMMIT_BATCH_SIZE - 1)
+
+    def testScaledDownDropped(self):
+        for level in (1, 2, 0):
+            self.db.write("INSERT OR REPLACE INTO Thumbnails "
+                          "(Asset, Level, Time, Jpeg) VALUES (?, ?, 0, ?)",
+                          ("a", level, b"jpeg"))
+        self.assertEqual(self.db.query("SELECT Level FROM Thumbnails"), [(0,)])
+        self.db.write("INSERT OR REPLACE INTO Thumbnails "
+                      "(Asset, Level, Time, Jpeg) VALUES ('a', 1, 0, 'jpeg')")
+        self.db.commit()
+        self.assertEqual(self.count(), 2)
+
+    def testRemoveAsset(self):
+        self.write("a", 0)
+        self.write("b", 0)
+        self.write("b", 1)
+        self.db.commit()
+        self.assertEqual(self.db.assetSizes(), {"a": 4, "b": 8})
+        self.db.removeAsset("b")
+        self.assertEqual(self.db.assetSizes(), {"a": 4})
@@ -24,7 +24,7 @@ from unittest import TestCase
 
 from pitivi.utils.system import System, getSystem, GnomeSystem, \
     INHIBIT_LOGOUT, INHIBIT_SUSPEND, INHIBIT_SESSION_IDLE, \
-    INHIBIT_USER_SWITCHING
+    INHIBIT_USER_SWITCHING, SystemCPUUsageTracker
 
 
 class TestSystem(TestCase):
@@ -133,3 +133,12 @@ class TestGnomeSystem(TestCase):
         self.assertFalse(self.system.session_iface.IsInhibited(
             INHIBIT_LOGOUT | INHIBIT_USER_SWITCHING | INHIBIT_SUSPEND |
             INHIBIT_SESSION_IDLE))
+
+
+class TestSystemCPUUsageTracker(TestCase):
+
+    def testUsage(self):
+        tracker = SystemCPUUsageTracker()
+        usage = tracker.usage()
+        self.assertGreaterEqual(usage, 0)
+        self.assertLessEqual(usage, 100)